@@ -3,11 +3,28 @@ Kizuki-Log AI Bridge
 Constitution v1.0 に基づく LLM API ブリッジモジュール
 """
 
+import functools
+import hashlib
+import http.client
+import inspect
+import io
 import json
 import os
+import queue
+import random
+import socket
+import sqlite3
+import ssl
+import threading
+import time
+import urllib.parse
 import urllib.request
 import urllib.error
 import sys
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from email.utils import parsedate_to_datetime
 
 # ──────────────────────────────────────────────
 # .env ファイルの簡易ローダー
@@ -28,6 +45,189 @@ def load_env(env_path=None):
                 os.environ.setdefault(key.strip(), value.strip())
 
 
+# ──────────────────────────────────────────────
+# 設定スナップショット
+# ──────────────────────────────────────────────
+def parse_provider_chain(text: str) -> tuple:
+    """'groq, openai:gpt-4o-mini' → (('groq', ''), ('openai', 'gpt-4o-mini'))（未対応のプロバイダは無視）"""
+    chain = []
+    for item in (text or '').split(','):
+        provider, _, model = item.strip().partition(':')
+        provider = provider.strip().lower()
+        if not provider:
+            continue
+        if provider not in provider_names():
+            print(f"⚠ AI_FALLBACK_CHAIN の未対応のプロバイダを無視します: {provider}")
+            continue
+        chain.append((provider, model.strip()))
+    return tuple(chain)
+
+
+# 無料枠の上限（AI_RATE_LIMITS で上書き。有料プランでは引き上げる）
+DEFAULT_RATE_LIMITS = 'gemini=15/1000000, groq=30/12000'
+
+
+def parse_rate_limits(text: str) -> tuple:
+    """'gemini=15/1000000, groq=30' → (('gemini', 15, 1000000), ('groq', 30, 0))（0 は無制限）"""
+    limits = []
+    for item in (text or '').split(','):
+        provider, _, values = item.strip().partition('=')
+        provider = provider.strip().lower()
+        if not provider:
+            continue
+        rpm, _, tpm = values.partition('/')
+        try:
+            limits.append((provider, float(rpm or 0), float(tpm or 0)))
+        except ValueError:
+            print(f"⚠ AI_RATE_LIMITS の書式が不正なため無視します: {item.strip()}")
+    return tuple(limits)
+
+
+def _env_number(env, name, default, cast=float):
+    try:
+        return cast(env.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+@dataclass(frozen=True)
+class AIConfig:
+    """
+    AI呼び出しの設定（不変）。
+    起動時に一度だけ読み込み、リクエストごとのプロバイダ・モデル指定は
+    with_overrides() で派生させる。os.environ を書き換えないため、
+    同時に処理している別のリクエストへ影響しない。
+    """
+    provider: str = 'gemini'
+    fallback_provider: str = ''
+    openai_api_key: str = ''
+    anthropic_api_key: str = ''
+    gemini_api_key: str = ''
+    groq_api_key: str = ''
+    openai_model: str = 'gpt-4o'
+    anthropic_model: str = 'claude-3-5-sonnet-20241022'
+    gemini_model: str = 'gemini-2.0-flash'
+    groq_model: str = 'llama-3.3-70b-versatile'
+    openai_base_url: str = 'https://api.openai.com/v1'
+    anthropic_base_url: str = 'https://api.anthropic.com/v1'
+    # AI_CUSTOM_PROVIDERS で登録したプロバイダのモデル指定 ((provider, model), ...)。無ければクライアントの既定
+    extra_models: tuple = ()
+    temperature: float = 0.7
+    # プロバイダ側のプロンプトキャッシュ（Anthropic の cache_control、Gemini の cachedContents）を使う
+    prompt_cache: bool = True
+    # 再試行とフォールバック（resilient_call）
+    fallback_chain: tuple = ()    # ((provider, model または ''), ...)。空なら fallback_provider だけ
+    retry_attempts: int = 3       # 1プロバイダあたりの試行回数
+    retry_base_delay: float = 1.0
+    retry_max_delay: float = 20.0
+    request_timeout: float = 60.0  # 1回の呼び出しの待ち時間（秒）
+    deadline: float = 180.0        # フォールバックを含めた全体の締め切り（秒）
+    # クライアント側のレート制限（RateLimiter）
+    rate_limits: tuple = ()        # ((provider, RPM, TPM), ...)。0 は無制限
+    rate_limit_max_wait: float = 30.0  # これより長く待つ必要があれば次のプロバイダへ
+    # 週次分析のプロンプトの上限（トークン数の概算）。超える分は優先度の低い記述から縮める
+    weekly_max_tokens: int = 24000
+    # 週次分析の方式: full（日誌の原文をすべて送る）/ map_reduce（日ごとの解析結果の要約だけを送る）
+    weekly_mode: str = 'full'
+    # ヘッジ要求（hedged_call。指導コメント生成で使う）
+    hedge: bool = False
+    hedge_percentile: float = 95.0  # 主プロバイダの直近の応答時間のこのパーセンタイルを過ぎたら次のプロバイダにも送る
+    hedge_delay: float = 3.0        # 応答時間の記録が少ないうちに使う待ち時間（秒）
+
+    @classmethod
+    def from_env(cls, environ=None):
+        """環境変数から設定を作る"""
+        env = os.environ if environ is None else environ
+        provider = env.get('AI_PROVIDER', 'gemini').strip().lower()
+        return cls(
+            provider=provider if provider in provider_names() else 'gemini',
+            fallback_provider=env.get('AI_FALLBACK_PROVIDER', '').strip().lower(),
+            openai_api_key=env.get('OPENAI_API_KEY', ''),
+            anthropic_api_key=env.get('ANTHROPIC_API_KEY', ''),
+            gemini_api_key=env.get('GEMINI_API_KEY', ''),
+            groq_api_key=env.get('GROQ_API_KEY', ''),
+            openai_model=env.get('OPENAI_MODEL', cls.openai_model).strip(),
+            anthropic_model=env.get('ANTHROPIC_MODEL', cls.anthropic_model).strip(),
+            gemini_model=env.get('GEMINI_MODEL', cls.gemini_model).strip(),
+            groq_model=env.get('GROQ_MODEL', cls.groq_model).strip(),
+            openai_base_url=env.get('OPENAI_BASE_URL', cls.openai_base_url).strip().rstrip('/'),
+            anthropic_base_url=env.get('ANTHROPIC_BASE_URL', cls.anthropic_base_url).strip().rstrip('/'),
+            prompt_cache=env.get('AI_PROMPT_CACHE', 'on').strip().lower() not in ('0', 'off', 'false', 'no'),
+            fallback_chain=parse_provider_chain(env.get('AI_FALLBACK_CHAIN', '')),
+            retry_attempts=max(1, _env_number(env, 'AI_RETRY_ATTEMPTS', cls.retry_attempts, int)),
+            retry_base_delay=_env_number(env, 'AI_RETRY_BASE_DELAY', cls.retry_base_delay),
+            retry_max_delay=_env_number(env, 'AI_RETRY_MAX_DELAY', cls.retry_max_delay),
+            request_timeout=_env_number(env, 'AI_REQUEST_TIMEOUT', cls.request_timeout),
+            deadline=_env_number(env, 'AI_DEADLINE', cls.deadline),
+            rate_limits=parse_rate_limits(env.get('AI_RATE_LIMITS', DEFAULT_RATE_LIMITS)),
+            rate_limit_max_wait=_env_number(env, 'AI_RATE_LIMIT_MAX_WAIT', cls.rate_limit_max_wait),
+            weekly_max_tokens=max(1000, _env_number(env, 'AI_WEEKLY_MAX_TOKENS', cls.weekly_max_tokens, int)),
+            weekly_mode=env.get('AI_WEEKLY_MODE', cls.weekly_mode).strip().lower(),
+            hedge=env.get('AI_HEDGE', 'off').strip().lower() in ('1', 'on', 'true', 'yes'),
+            hedge_percentile=min(99.9, max(1.0, _env_number(env, 'AI_HEDGE_PERCENTILE', cls.hedge_percentile))),
+            hedge_delay=_env_number(env, 'AI_HEDGE_DELAY', cls.hedge_delay),
+        )
+
+    def model_for(self, provider: str) -> str:
+        model = getattr(self, f'{provider}_model', None)
+        if model is None:
+            model = dict(self.extra_models).get(provider) or get_provider(provider).default_model
+        return model
+
+    def attempt_chain(self, default_fallback: str = '') -> list:
+        """
+        試す順の設定の一覧。先頭は self.provider、続いて fallback_chain
+        （未設定なら fallback_provider、それも無ければ default_fallback）。同じプロバイダ・モデルは一度だけ。
+        """
+        fallbacks = self.fallback_chain or (((self.fallback_provider or default_fallback), ''),)
+        chain = []
+        for provider, model in ((self.provider, ''),) + tuple(fallbacks):
+            if provider not in provider_names():
+                continue
+            config = self.with_overrides(provider, model)
+            if all((c.provider, c.model_for(c.provider)) != (provider, config.model_for(provider)) for c in chain):
+                chain.append(config)
+        return chain
+
+    def with_overrides(self, provider: str = None, model: str = None) -> 'AIConfig':
+        """プロバイダ・モデルを差し替えた新しい設定を返す（元の設定は変わらない）"""
+        config = self
+        if provider:
+            provider = provider.strip().lower()
+            if provider not in provider_names():
+                raise ValueError(f"未対応のプロバイダです: {provider}")
+            config = replace(config, provider=provider)
+        if model:
+            field = f'{config.provider}_model'
+            if hasattr(config, field):
+                config = replace(config, **{field: model.strip()})
+            else:
+                extra = tuple((p, m) for p, m in config.extra_models if p != config.provider)
+                config = replace(config, extra_models=extra + ((config.provider, model.strip()),))
+        return config
+
+
+_config = None
+_config_lock = threading.Lock()
+
+
+def get_config(reload: bool = False) -> AIConfig:
+    """.env と環境変数から設定を一度だけ読み込み、以降は同じスナップショットを返す"""
+    global _config
+    with _config_lock:
+        if _config is None or reload:
+            load_env()
+            register_env_providers()
+            _config = AIConfig.from_env()
+            response_cache.configure()
+        return _config
+
+
+def resolve_config(config: AIConfig = None, provider: str = None, model: str = None) -> AIConfig:
+    """呼び出しごとの設定を決める（明示された config > 起動時の設定）"""
+    return (config or get_config()).with_overrides(provider, model)
+
+
 # ──────────────────────────────────────────────
 # システムプロンプト（Constitution §3, §4, §5, §6）
 # ──────────────────────────────────────────────
@@ -253,214 +453,1650 @@ def build_user_prompt(week: int, log_achieved: str, log_unachieved: str,
 
 
 # ──────────────────────────────────────────────
-# LLM API 呼び出し
+# 計測（/metrics で Prometheus テキスト形式として公開）
+# ──────────────────────────────────────────────
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Metrics:
+    """スレッドセーフなカウンタ・ヒストグラム・ゲージの集計（標準ライブラリのみ）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}        # name -> (type, help, buckets)
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket_counts, sum, count]
+        self._gauges = {}      # name -> 出力時に [(labels, value), ...] を返す関数
+
+    def counter(self, name, help_text):
+        self._meta.setdefault(name, ('counter', help_text, None))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._meta.setdefault(name, ('histogram', help_text, tuple(buckets)))
+
+    def gauge(self, name, help_text, collect):
+        """現在値を出力時に collect() で集める（[(ラベルの辞書, 値), ...] を返す関数）"""
+        self._meta.setdefault(name, ('gauge', help_text, None))
+        self._gauges[name] = collect
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self._meta[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        """Prometheus テキスト形式（version 0.0.4）で出力する"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: [list(v[0]), v[1], v[2]] for key, v in self._histograms.items()}
+
+        lines = []
+        for name, (kind, help_text, buckets) in sorted(self._meta.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for (n, labels), value in sorted(counters.items()):
+                    if n == name:
+                        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            if kind == 'gauge':
+                for labels, value in sorted((tuple(sorted(l.items())), v) for l, v in self._gauges[name]()):
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            for (n, labels), (counts, total, count) in sorted(histograms.items()):
+                if n != name:
+                    continue
+                for bound, bucket_count in zip(buckets, counts):
+                    le = labels + (('le', _format_value(bound)),)
+                    lines.append(f"{name}_bucket{_format_labels(le)} {bucket_count}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = Metrics()
+metrics.counter('kizuki_ai_provider_requests_total', 'AIプロバイダへの呼び出し回数（結果別）')
+metrics.histogram('kizuki_ai_provider_duration_seconds', 'AIプロバイダの応答時間（ストリーミングは完了まで）')
+metrics.histogram('kizuki_ai_provider_first_chunk_seconds', 'ストリーミングで最初の断片が届くまでの時間')
+metrics.histogram('kizuki_ai_provider_request_bytes', 'AIプロバイダに送ったプロンプトのサイズ', SIZE_BUCKETS)
+metrics.histogram('kizuki_ai_provider_response_bytes', 'AIプロバイダから受け取った応答のサイズ', SIZE_BUCKETS)
+
+
+def _elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def _call_status(error):
+    if error is None:
+        return 'ok'
+    if isinstance(error, GeneratorExit):
+        return 'cancelled'
+    if isinstance(error, urllib.error.HTTPError):
+        return str(error.code)
+    return type(error).__name__
+
+
+class LatencyWindow:
+    """プロバイダごとの直近の応答時間（成功した一括呼び出しのみ）。ヘッジ要求の待ち時間を決めるのに使う"""
+
+    def __init__(self, size=200):
+        self._lock = threading.Lock()
+        self._samples = {}  # provider -> deque（古いものから捨てる）
+        self.size = size
+
+    def add(self, provider, seconds):
+        with self._lock:
+            samples = self._samples.get(provider)
+            if samples is None:
+                samples = self._samples[provider] = deque(maxlen=self.size)
+            samples.append(seconds)
+
+    def percentile(self, provider, percent, min_samples=20):
+        """percent パーセンタイルの秒数。記録が min_samples 件に満たなければ None"""
+        with self._lock:
+            samples = sorted(self._samples.get(provider, ()))
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+provider_latency = LatencyWindow()
+
+
+def _record_provider_call(provider, mode, started, error, prompt_bytes, response_bytes):
+    elapsed = time.perf_counter() - started
+    metrics.inc('kizuki_ai_provider_requests_total', provider=provider, mode=mode, status=_call_status(error))
+    metrics.observe('kizuki_ai_provider_duration_seconds', elapsed, provider=provider, mode=mode)
+    metrics.observe('kizuki_ai_provider_request_bytes', prompt_bytes, provider=provider)
+    if error is None:
+        metrics.observe('kizuki_ai_provider_response_bytes', response_bytes, provider=provider)
+        if mode == 'call':
+            provider_latency.add(provider, elapsed)
+
+
+def instrument_provider(provider):
+    """プロバイダの call / stream の所要時間・結果・サイズを記録するデコレータ"""
+    def decorator(fn):
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def stream_wrapper(system_prompt, user_prompt, *args, **kwargs):
+                prompt_bytes = len(system_prompt.encode('utf-8')) + len(user_prompt.encode('utf-8'))
+                started = time.perf_counter()
+                received = 0
+                error = None
+                try:
+                    for text in fn(system_prompt, user_prompt, *args, **kwargs):
+                        if not received:
+                            metrics.observe('kizuki_ai_provider_first_chunk_seconds',
+                                            time.perf_counter() - started, provider=provider)
+                        received += len(text.encode('utf-8'))
+                        yield text
+                except (Exception, GeneratorExit) as e:
+                    error = e
+                    raise
+                finally:
+                    _record_provider_call(provider, 'stream', started, error, prompt_bytes, received)
+            return stream_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(system_prompt, user_prompt, *args, **kwargs):
+            prompt_bytes = len(system_prompt.encode('utf-8')) + len(user_prompt.encode('utf-8'))
+            started = time.perf_counter()
+            try:
+                result = fn(system_prompt, user_prompt, *args, **kwargs)
+            except Exception as e:
+                _record_provider_call(provider, 'call', started, e, prompt_bytes, 0)
+                raise
+            response_bytes = len(json.dumps(result, ensure_ascii=False).encode('utf-8'))
+            _record_provider_call(provider, 'call', started, None, prompt_bytes, response_bytes)
+            return result
+        return wrapper
+    return decorator
+
+
+# ──────────────────────────────────────────────
+# HTTP 接続プール（プロバイダのホストごとに keep-alive 接続を再利用する）
 # ──────────────────────────────────────────────
+metrics.counter('kizuki_ai_http_connections_total', 'AIプロバイダへのHTTP接続（new: 新規にTCP/TLS接続、reused: プールから再利用）')
 
-def call_openai(system_prompt: str, user_prompt: str) -> dict:
-    """OpenAI API (GPT-4o) を呼び出す"""
-    api_key = os.environ.get('OPENAI_API_KEY', '')
-    if not api_key or api_key.startswith('sk-xxxx'):
-        raise ValueError("OPENAI_API_KEY が設定されていません。.env ファイルを確認してください。")
-    
-    payload = {
-        "model": "gpt-4o",
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
-        "temperature": 0.7,
-        "response_format": {"type": "json_object"}
-    }
-    
-    data = json.dumps(payload).encode('utf-8')
-    req = urllib.request.Request(
-        'https://api.openai.com/v1/chat/completions',
-        data=data,
-        headers={
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {api_key}'
-        },
-        method='POST'
-    )
-    
-    with urllib.request.urlopen(req, timeout=60) as resp:
-        result = json.loads(resp.read().decode('utf-8'))
-    
-    content = result['choices'][0]['message']['content']
-    return json.loads(content)
 
+class _KeepAliveMixin:
+    """ヘッダーと本文を別々に送るため、Nagle アルゴリズムで再利用時に遅延しないようにする"""
 
-def call_anthropic(system_prompt: str, user_prompt: str) -> dict:
-    """Anthropic API (Claude 3.5 Sonnet) を呼び出す"""
-    api_key = os.environ.get('ANTHROPIC_API_KEY', '')
-    if not api_key or api_key.startswith('sk-ant-xxxx'):
-        raise ValueError("ANTHROPIC_API_KEY が設定されていません。.env ファイルを確認してください。")
-    
-    payload = {
-        "model": "claude-3-5-sonnet-20241022",
-        "max_tokens": 4096,
-        "system": system_prompt,
-        "messages": [
-            {"role": "user", "content": user_prompt}
-        ]
+    def connect(self):
+        super().connect()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class KeepAliveHTTPConnection(_KeepAliveMixin, http.client.HTTPConnection):
+    pass
+
+
+class KeepAliveHTTPSConnection(_KeepAliveMixin, http.client.HTTPSConnection):
+    pass
+
+
+class CancelToken:
+    """
+    別スレッドから呼び出しを打ち切るための目印（ヘッジ要求で負けた側を止める）。
+    このトークンを持つスレッドが使っている接続を閉じ、応答待ちの読み込みを失敗させる。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conns = set()
+        self.cancelled = False
+
+    def register(self, conn) -> bool:
+        with self._lock:
+            if self.cancelled:
+                return False
+            self._conns.add(conn)
+            return True
+
+    def discard(self, conn):
+        with self._lock:
+            self._conns.discard(conn)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            conns = list(self._conns)
+        for conn in conns:
+            if conn.sock is not None:
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+_cancel_local = threading.local()
+
+
+def current_cancel_token():
+    """このスレッドの呼び出しに付いている CancelToken（無ければ None）"""
+    return getattr(_cancel_local, 'token', None)
+
+
+class PooledResponse:
+    """プールの接続から得たレスポンス（urlopen の戻り値と同じように read・行単位の反復・with が使える）"""
+
+    def __init__(self, pool, key, conn, resp, url, token=None):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self._token = token
+        self.url = url
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.headers
+
+    def getcode(self):
+        return self.status
+
+    def read(self, *args):
+        return self._resp.read(*args)
+
+    def __iter__(self):
+        return iter(self._resp)
+
+    def close(self):
+        """本文を読み切っていれば接続をプールに戻し、途中なら接続ごと閉じる"""
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if self._token is not None:
+            self._token.discard(conn)
+        if self._resp.isclosed() and not self._resp.will_close and not (self._token and self._token.cancelled):
+            self._pool.release(self._key, conn)
+        else:
+            self._resp.close()
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ConnectionPool:
+    """ホストごとの keep-alive 接続プール（スレッドセーフ）
+
+    urllib.request.urlopen と同じ Request を受け取り、同じ例外（HTTPError / URLError）を返す。
+    接続は1回のリクエストの間だけ1つのスレッドが占有し、本文を読み切ったら次の呼び出しに回す。
+    """
+
+    def __init__(self, max_idle_per_host=8, idle_timeout=50.0, context=None):
+        self.max_idle_per_host = max_idle_per_host
+        # サーバー側に切られる前に手放す（多くのAPIはアイドル60秒前後で切断する）
+        self.idle_timeout = idle_timeout
+        self.context = context or ssl.create_default_context()
+        self._lock = threading.Lock()
+        self._idle = {}  # (scheme, host, port) -> [(接続, 返却時刻), ...]
+
+    def urlopen(self, req, timeout=60):
+        parts = urllib.parse.urlsplit(req.full_url)
+        if parts.scheme not in ('http', 'https') or self._uses_proxy(parts):
+            # プロキシ経由の環境では従来どおり urllib に任せる
+            return urllib.request.urlopen(req, timeout=timeout)
+
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        token = current_cancel_token()
+        for attempt in range(2):
+            conn, reused = self._acquire(key, timeout)
+            if token is not None and not token.register(conn):
+                conn.close()
+                raise urllib.error.URLError('cancelled')
+            try:
+                conn.request(req.get_method(), path, body=req.data, headers=dict(req.header_items()))
+                resp = conn.getresponse()
+                break
+            except (ConnectionResetError, BrokenPipeError, http.client.BadStatusLine) as e:
+                conn.close()
+                if token is not None:
+                    token.discard(conn)
+                # アイドル中にサーバーが閉じていた接続なら、新しい接続で1度だけやり直す
+                if reused and attempt == 0 and not (token and token.cancelled):
+                    continue
+                raise urllib.error.URLError(e)
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                if token is not None:
+                    token.discard(conn)
+                raise urllib.error.URLError(e)
+
+        response = PooledResponse(self, key, conn, resp, req.full_url, token)
+        if resp.status >= 400:
+            body = resp.read()
+            response.close()
+            raise urllib.error.HTTPError(req.full_url, resp.status, resp.reason, resp.headers, io.BytesIO(body))
+        return response
+
+    def release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def _acquire(self, key, timeout):
+        scheme, host, port = key
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, released_at = idle.pop()
+                if now - released_at < self.idle_timeout:
+                    break
+                conn.close()
+            else:
+                conn = None
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            metrics.inc('kizuki_ai_http_connections_total', host=host, connection='reused')
+            return conn, True
+
+        if scheme == 'https':
+            conn = KeepAliveHTTPSConnection(host, port, timeout=timeout, context=self.context)
+        else:
+            conn = KeepAliveHTTPConnection(host, port, timeout=timeout)
+        metrics.inc('kizuki_ai_http_connections_total', host=host, connection='new')
+        return conn, False
+
+    @staticmethod
+    def _uses_proxy(parts):
+        proxies = urllib.request.getproxies()
+        return parts.scheme in proxies and not urllib.request.proxy_bypass(parts.hostname or '')
+
+
+http_pool = ConnectionPool()
+
+
+def open_url(req, timeout=60):
+    """プロバイダAPIへのリクエストを接続プール経由で送る（urllib.request.urlopen の代わり）"""
+    return http_pool.urlopen(req, timeout=timeout)
+
+
+# ──────────────────────────────────────────────
+# 応答キャッシュ（同じプロンプトの再解析で API を呼ばない）
+# ──────────────────────────────────────────────
+metrics.counter('kizuki_ai_cache_requests_total', 'AI応答キャッシュの参照結果（hit_memory / hit_disk / miss / refresh）')
+
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ai_cache.db')
+
+
+def response_cache_key(config: AIConfig, provider: str, system_prompt: str, user_prompt: str) -> str:
+    """(プロバイダ, モデル, システムプロンプト, ユーザープロンプト, temperature) のハッシュ"""
+    material = json.dumps([provider, config.model_for(provider), system_prompt, user_prompt, config.temperature],
+                          ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    検証済みのAI応答を保存するキャッシュ。
+    メモリ上の LRU（max_memory 件）を SQLite（path）の手前に置き、
+    ttl 秒を過ぎたものは使わない。SQLite 側は合計 max_bytes を超えたら
+    最後に使われた時刻が古いものから削除する。
+    """
+
+    def __init__(self, path=CACHE_FILE, ttl=7 * 24 * 3600, max_memory=256, max_bytes=50 * 1024 * 1024,
+                 enabled=True):
+        self.path = path
+        self.ttl = ttl
+        self.max_memory = max_memory
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+    def configure(self, environ=None):
+        """KIZUKI_AI_CACHE / KIZUKI_AI_CACHE_TTL / KIZUKI_AI_CACHE_MAX_MB を反映する（get_config から呼ばれる）"""
+        env = os.environ if environ is None else environ
+        self.ttl = _env_number(env, 'KIZUKI_AI_CACHE_TTL', 7 * 24 * 3600)
+        self.max_bytes = int(_env_number(env, 'KIZUKI_AI_CACHE_MAX_MB', 50) * 1024 * 1024)
+        self.enabled = env.get('KIZUKI_AI_CACHE', 'on').strip().lower() not in ('0', 'off', 'false', 'no')
+        return self
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed_at)")
+            self._db.commit()
+        return self._db
+
+    def get(self, key: str):
+        """キャッシュ済みの応答（毎回新しい dict）を返す。無ければ None"""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._memory.move_to_end(key)
+                metrics.inc('kizuki_ai_cache_requests_total', result='hit_memory')
+                return json.loads(entry[0])
+            self._memory.pop(key, None)
+            try:
+                db = self._connect()
+                row = db.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is None or now - row[1] >= self.ttl:
+                    if row is not None:
+                        db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                        db.commit()
+                    metrics.inc('kizuki_ai_cache_requests_total', result='miss')
+                    return None
+                db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"⚠ AIキャッシュの読み込みに失敗しました: {e}")
+                metrics.inc('kizuki_ai_cache_requests_total', result='miss')
+                return None
+            self._remember(key, row[0], row[1])
+            metrics.inc('kizuki_ai_cache_requests_total', result='hit_disk')
+            return json.loads(row[0])
+
+    def put(self, key: str, value: dict):
+        """応答を保存する（エラー結果は呼び出し側で除くこと）"""
+        if not self.enabled:
+            return
+        text = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._remember(key, text, now)
+            try:
+                db = self._connect()
+                db.execute("INSERT OR REPLACE INTO responses (key, value, size, created_at, accessed_at) "
+                           "VALUES (?, ?, ?, ?, ?)", (key, text, len(text.encode('utf-8')), now, now))
+                self._evict(db, now)
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"⚠ AIキャッシュの保存に失敗しました: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if os.path.exists(self.path):
+                db = self._connect()
+                db.execute("DELETE FROM responses")
+                db.commit()
+
+    def _remember(self, key, text, created_at):
+        self._memory[key] = (text, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory:
+            self._memory.popitem(last=False)
+
+    def _evict(self, db, now):
+        db.execute("DELETE FROM responses WHERE created_at <= ?", (now - self.ttl,))
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in db.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall():
+            if total <= self.max_bytes:
+                break
+            db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._memory.pop(key, None)
+            total -= size
+
+
+response_cache = ResponseCache().configure()
+
+
+def lookup_cached_response(config: AIConfig, system_prompt: str, user_prompt: str, force_refresh: bool = False,
+                           trace: dict = None):
+    """
+    config.provider で同じプロンプトを解析済みならその結果を返す（force_refresh なら常に None）。
+    trace に辞書を渡すと cache（hit / miss / refresh）を書き込む。
+    """
+    if force_refresh:
+        if response_cache.enabled:
+            metrics.inc('kizuki_ai_cache_requests_total', result='refresh')
+        cached = None
+    else:
+        cached = response_cache.get(response_cache_key(config, config.provider, system_prompt, user_prompt))
+    if trace is not None:
+        trace['cache'] = 'refresh' if force_refresh else ('hit' if cached is not None else 'miss')
+    return cached
+
+
+def store_cached_response(config: AIConfig, provider: str, system_prompt: str, user_prompt: str, result: dict):
+    """検証を通った結果を、実際に応答したプロバイダのキーで保存する"""
+    response_cache.put(response_cache_key(config, provider, system_prompt, user_prompt), result)
+
+
+# ──────────────────────────────────────────────
+# プロバイダ側のプロンプトキャッシュと使用トークン数
+# ──────────────────────────────────────────────
+# 固定のシステムプロンプトを先頭に置き、2回目以降はプロバイダ側でキャッシュから読ませる。
+#   Anthropic: system ブロックに cache_control を付ける
+#   Gemini:    cachedContents にシステムプロンプトを登録し、cachedContent で参照する
+#   OpenAI / Groq: 先頭が同じプロンプトは自動でキャッシュされる（報告される cached_tokens を記録するだけ）
+metrics.counter('kizuki_ai_prompt_tokens_total',
+                'AIプロバイダに送った入力トークン数（cache: hit=キャッシュから読まれた分, write=キャッシュに書き込まれた分, miss=それ以外）')
+metrics.counter('kizuki_ai_output_tokens_total', 'AIプロバイダが生成した出力トークン数')
+
+
+def normalize_usage(provider: str, raw: dict) -> dict:
+    """プロバイダごとの usage 表記を input / cached / cache_write / output のトークン数にそろえる"""
+    raw = raw or {}
+    if provider == 'anthropic':
+        cached = raw.get('cache_read_input_tokens') or 0
+        written = raw.get('cache_creation_input_tokens') or 0
+        return {
+            'input_tokens': (raw.get('input_tokens') or 0) + cached + written,
+            'cached_tokens': cached,
+            'cache_write_tokens': written,
+            'output_tokens': raw.get('output_tokens') or 0,
+        }
+    if provider == 'gemini':
+        return {
+            'input_tokens': raw.get('promptTokenCount') or 0,
+            'cached_tokens': raw.get('cachedContentTokenCount') or 0,
+            'cache_write_tokens': 0,
+            'output_tokens': raw.get('candidatesTokenCount') or 0,
+        }
+    details = raw.get('prompt_tokens_details') or {}
+    return {
+        'input_tokens': raw.get('prompt_tokens') or 0,
+        'cached_tokens': details.get('cached_tokens') or 0,
+        'cache_write_tokens': 0,
+        'output_tokens': raw.get('completion_tokens') or 0,
     }
-    
-    data = json.dumps(payload).encode('utf-8')
-    req = urllib.request.Request(
-        'https://api.anthropic.com/v1/messages',
-        data=data,
-        headers={
-            'Content-Type': 'application/json',
-            'x-api-key': api_key,
-            'anthropic-version': '2023-06-01'
-        },
-        method='POST'
-    )
-    
-    with urllib.request.urlopen(req, timeout=60) as resp:
-        result = json.loads(resp.read().decode('utf-8'))
-    
-    content = result['content'][0]['text']
-    # JSONブロックを抽出（```json ... ``` で囲まれている場合）
-    if '```json' in content:
-        content = content.split('```json')[1].split('```')[0].strip()
-    elif '```' in content:
-        content = content.split('```')[1].split('```')[0].strip()
-    
-    return json.loads(content)
 
 
-def call_gemini(system_prompt: str, user_prompt: str) -> dict:
-    """Google Gemini API (AI Studio) を呼び出す"""
-    api_key = os.environ.get('GEMINI_API_KEY', '')
-    if not api_key or api_key.startswith('AIzaSy-xxxx'):
-        raise ValueError("GEMINI_API_KEY が設定されていません。.env ファイルを確認してください。")
-    
-    model = os.environ.get('GEMINI_MODEL', 'gemini-2.0-flash').strip()
-    # v1beta エンドポイントを使用（2.0系はこれが安定）
-    url = f'https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}'
-    
+def record_usage(provider: str, raw: dict, usage: dict = None) -> dict:
+    """使用トークン数を計測に加え、usage に辞書を渡されていればそこにも書き込む"""
+    counts = normalize_usage(provider, raw)
+    cached, written = counts['cached_tokens'], counts['cache_write_tokens']
+    for cache, value in (('hit', cached), ('write', written),
+                         ('miss', max(0, counts['input_tokens'] - cached - written))):
+        if value:
+            metrics.inc('kizuki_ai_prompt_tokens_total', value, provider=provider, cache=cache)
+    if counts['output_tokens']:
+        metrics.inc('kizuki_ai_output_tokens_total', counts['output_tokens'], provider=provider)
+    if usage is not None:
+        usage.update(counts)
+    return counts
+
+
+# 明示的なプロンプトキャッシュが使える最小のトークン数（これより短いシステムプロンプトは登録しない）。
+# Anthropic は Sonnet の値、Gemini は 2.5 Flash の値。より大きい最小値のモデルでは作成が拒否され、retry_after のあいだ試さない
+PROMPT_CACHE_MIN_TOKENS = {'anthropic': 1024, 'gemini': 1024}
+
+
+def prompt_cacheable(provider: str, system_prompt: str) -> bool:
+    return estimate_tokens(system_prompt) >= PROMPT_CACHE_MIN_TOKENS.get(provider, 0)
+
+
+def anthropic_system(system_prompt: str, config: AIConfig):
+    """システムプロンプトをキャッシュ境界（cache_control）付きのブロックにする"""
+    if not config.prompt_cache or not prompt_cacheable('anthropic', system_prompt):
+        return system_prompt
+    return [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+
+
+class GeminiContextCache:
+    """
+    Gemini の cachedContents にシステムプロンプトを登録して使い回す。
+    (APIキー, モデル, システムプロンプト) ごとに一度だけ作り、期限の少し前に作り直す。
+    作成は別スレッドで行い、できあがるまでの呼び出しは待たずに通常どおり systemInstruction を送る。
+    作れなかったとき（プランが対応していない等）は retry_after 秒のあいだ作成を試みない。
+    """
+
+    def __init__(self, ttl=3600, retry_after=600):
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self._entries = {}
+        self._creating = set()  # 作成中のキー（同じプロンプトの作成を重ねて始めない）
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(api_key, model, system_prompt):
+        return hashlib.sha256(f"{api_key}\n{model}\n{system_prompt}".encode('utf-8')).hexdigest()
+
+    def get(self, api_key: str, model: str, system_prompt: str):
+        """使える cachedContents の名前を返す（まだ無い・作れなければ None。作成は待たない）"""
+        if not prompt_cacheable('gemini', system_prompt):
+            return None
+        key = self._key(api_key, model, system_prompt)
+        with self._lock:
+            name, until = self._entries.get(key, (None, 0))
+            if time.time() < until:
+                return name
+            if key in self._creating:
+                return None
+            self._creating.add(key)
+        threading.Thread(target=self._refresh, args=(key, api_key, model, system_prompt),
+                         name='gemini-context-cache', daemon=True).start()
+        return None
+
+    def _refresh(self, key, api_key, model, system_prompt):
+        try:
+            name = self._create(api_key, model, system_prompt)
+            until = time.time() + self.ttl - 60
+        except (urllib.error.URLError, OSError, ValueError, KeyError) as e:
+            detail = e.read().decode('utf-8', 'replace')[:200] if isinstance(e, urllib.error.HTTPError) and e.fp else e
+            print(f"⚠ Gemini のコンテキストキャッシュを作成できませんでした（{self.retry_after}秒後に再試行）: {detail}")
+            name, until = None, time.time() + self.retry_after
+        with self._lock:
+            self._entries[key] = (name, until)
+            self._creating.discard(key)
+
+    def invalidate(self, api_key: str, model: str, system_prompt: str):
+        with self._lock:
+            self._entries.pop(self._key(api_key, model, system_prompt), None)
+
+    def _create(self, api_key, model, system_prompt):
+        payload = {
+            "model": f"models/{model}",
+            "systemInstruction": {"parts": [{"text": system_prompt}]},
+            "ttl": f"{int(self.ttl)}s",
+        }
+        req = urllib.request.Request(
+            f'https://generativelanguage.googleapis.com/v1beta/cachedContents?key={api_key}',
+            data=json.dumps(payload).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+            method='POST'
+        )
+        with open_url(req, timeout=30) as resp:
+            return json.loads(resp.read().decode('utf-8'))['name']
+
+
+gemini_context_cache = GeminiContextCache()
+
+
+def gemini_payload(system_prompt: str, user_prompt: str, config: AIConfig, cached_content: str = None) -> dict:
+    """generateContent 用のリクエスト本文（cached_content があればシステムプロンプトはそちらを参照）"""
     payload = {
-        "contents": [
-            {
-                "role": "user",
-                "parts": [{"text": user_prompt}]
-            }
-        ],
-        "systemInstruction": {
-            "parts": [{"text": system_prompt}]
-        },
+        "contents": [{"role": "user", "parts": [{"text": user_prompt}]}],
         "generationConfig": {
-            "temperature": 0.7,
+            "temperature": config.temperature,
             "responseMimeType": "application/json"
         }
     }
-    
-    data = json.dumps(payload).encode('utf-8')
-    req = urllib.request.Request(
-        url,
-        data=data,
-        headers={'Content-Type': 'application/json'},
-        method='POST'
-    )
-    
-    with urllib.request.urlopen(req, timeout=60) as resp:
-        result = json.loads(resp.read().decode('utf-8'))
-    
-    content = result['candidates'][0]['content']['parts'][0]['text']
-    
+    if cached_content:
+        payload["cachedContent"] = cached_content
+    else:
+        payload["systemInstruction"] = {"parts": [{"text": system_prompt}]}
+    return payload
+
+
+def open_gemini(method: str, system_prompt: str, user_prompt: str, config: AIConfig, query: str = ''):
+    """
+    Gemini の generateContent / streamGenerateContent を呼び出してレスポンスを返す。
+    登録済みのコンテキストキャッシュが期限切れ・削除済みで拒否されたときは、
+    キャッシュを使わずに一度だけ送り直す。
+    """
+    api_key = config.gemini_api_key
+    model = config.gemini_model
+    # v1beta エンドポイントを使用（2.0系はこれが安定）
+    url = f'https://generativelanguage.googleapis.com/v1beta/models/{model}:{method}?{query}key={api_key}'
+    cached_content = gemini_context_cache.get(api_key, model, system_prompt) if config.prompt_cache else None
+
+    def send(cached_content):
+        req = urllib.request.Request(
+            url,
+            data=json.dumps(gemini_payload(system_prompt, user_prompt, config, cached_content)).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+            method='POST'
+        )
+        return open_url(req, timeout=config.request_timeout)
+
+    try:
+        return send(cached_content)
+    except urllib.error.HTTPError as e:
+        if not cached_content or e.code not in (400, 403, 404):
+            raise
+        gemini_context_cache.invalidate(api_key, model, system_prompt)
+        return send(None)
+
+
+# ──────────────────────────────────────────────
+# LLM API 呼び出し（プロバイダクライアント）
+# ──────────────────────────────────────────────
+# プロバイダごとに違うのは URL・認証・リクエスト本文・応答からのテキストと usage の取り出し方だけなので、
+# そこを ProviderClient のサブクラスに書き、送受信（接続プール）・使用トークン数の記録・JSONの取り出しは
+# 共通の call() / stream() で行う。register_provider() で登録したクライアントは
+# 計測・再試行・フォールバック・レート制限・応答キャッシュ・ヘッジの対象になる。
+
+def parse_json_content(content: str) -> dict:
+    """モデルの出力テキストからJSONを取り出して解析する"""
     # JSONブロックを抽出（```json ... ``` で囲まれている場合）
     if '```json' in content:
         content = content.split('```json')[1].split('```')[0].strip()
     elif '```' in content:
         content = content.split('```')[1].split('```')[0].strip()
-    
     return json.loads(content)
 
 
-def call_groq(system_prompt: str, user_prompt: str) -> dict:
-    """Groq API (Llama 3.3 70B) を呼び出す"""
-    api_key = os.environ.get('GROQ_API_KEY', '')
-    if not api_key or api_key.startswith('gsk_xxxx'):
-        raise ValueError("GROQ_API_KEY が設定されていません。.env ファイルを確認してください。")
-    
-    model = os.environ.get('GROQ_MODEL', 'llama-3.3-70b-versatile')
-    
-    payload = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
-        "temperature": 0.7,
-        "response_format": {"type": "json_object"}
-    }
-    
-    data = json.dumps(payload).encode('utf-8')
-    req = urllib.request.Request(
-        'https://api.groq.com/openai/v1/chat/completions',
-        data=data,
-        headers={
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {api_key}',
-            'User-Agent': 'Kizuki-Log/1.0'
-        },
-        method='POST'
+def iter_sse_data(resp):
+    """Server-Sent Events のレスポンスから data 行の中身を順に返す"""
+    for raw_line in resp:
+        line = raw_line.decode('utf-8').rstrip('\r\n')
+        if line.startswith('data:'):
+            yield line[5:].strip()
+
+
+class ProviderClient:
+    """
+    LLM プロバイダの呼び出し方。サブクラスは request()（または open()）・parse_response()・parse_stream() を実装する。
+    インスタンスは設定を持たず、呼び出しごとの AIConfig を受け取る（複数スレッドから共有してよい）。
+    """
+    name = ''
+    default_model = ''
+    key_placeholder = ''   # .env.example の例のままの APIキーは未設定として扱う
+    # 機能フラグ
+    json_mode = True       # 応答をJSONに限定できる（できなければプロンプトの指示と parse_json_content に頼る）
+    streaming = True       # ストリーミング応答に対応している（しないものは stream() が全文を1つの断片で返す）
+    prompt_cache = ''      # explicit: cache_control / cachedContents を付ける、auto: プロバイダ側で自動、'': 無し
+    batch = False          # バッチAPI（submit_batch）に対応している
+
+    def api_key(self, config: AIConfig) -> str:
+        api_key = getattr(config, f'{self.name}_api_key', '')
+        if not api_key or (self.key_placeholder and api_key.startswith(self.key_placeholder)):
+            raise ValueError(f"{self.name.upper()}_API_KEY が設定されていません。.env ファイルを確認してください。")
+        return api_key
+
+    def request(self, system_prompt: str, user_prompt: str, config: AIConfig, stream: bool = False):
+        raise NotImplementedError
+
+    def open(self, system_prompt: str, user_prompt: str, config: AIConfig, stream: bool = False):
+        """リクエストを送ってレスポンスを返す（接続プール経由）"""
+        return open_url(self.request(system_prompt, user_prompt, config, stream), timeout=config.request_timeout)
+
+    def parse_response(self, body: dict) -> tuple:
+        """一括応答から (出力テキスト, usage) を取り出す"""
+        raise NotImplementedError
+
+    def parse_stream(self, resp):
+        """ストリーミング応答からテキスト断片を順に返し、最後に usage を return する"""
+        raise NotImplementedError
+
+    def call(self, system_prompt: str, user_prompt: str, config: AIConfig = None, usage: dict = None) -> dict:
+        """一括で呼び出して解析済みのJSONを返す（usage に辞書を渡すと使用トークン数を書き込む）"""
+        config = config or get_config()
+        with self.open(system_prompt, user_prompt, config) as resp:
+            body = json.loads(resp.read().decode('utf-8'))
+        text, raw_usage = self.parse_response(body)
+        record_usage(self.name, raw_usage, usage)
+        return parse_json_content(text)
+
+    def stream(self, system_prompt: str, user_prompt: str, config: AIConfig = None, usage: dict = None):
+        """ストリーミングで呼び出し、テキスト断片を順に返す"""
+        config = config or get_config()
+        if not self.streaming:
+            yield json.dumps(self.call(system_prompt, user_prompt, config, usage), ensure_ascii=False)
+            return
+        with self.open(system_prompt, user_prompt, config, stream=True) as resp:
+            raw_usage = yield from self.parse_stream(resp)
+        if raw_usage:
+            record_usage(self.name, raw_usage, usage)
+
+
+class ChatCompletionsClient(ProviderClient):
+    """OpenAI互換の /chat/completions（OpenAI・Groq・Ollama や LM Studio などのローカルサーバー）"""
+    prompt_cache = 'auto'
+
+    def __init__(self, name: str, base_url: str, default_model: str = '', key_placeholder: str = '',
+                 api_key: str = None, headers: dict = None, json_mode: bool = True, stream_usage: bool = True,
+                 prompt_cache: str = 'auto', batch: bool = False):
+        self.name = name
+        self.base_url = base_url
+        self.default_model = default_model
+        self.key_placeholder = key_placeholder
+        self.fixed_api_key = api_key  # None なら AIConfig の {name}_api_key を使う（'' は認証なし）
+        self.headers = dict(headers or {})
+        self.json_mode = json_mode
+        self.stream_usage = stream_usage  # stream_options.include_usage に対応（最後のチャンクに usage が入る）
+        self.prompt_cache = prompt_cache
+        self.batch = batch
+
+    def api_key(self, config: AIConfig) -> str:
+        if self.fixed_api_key is not None:
+            return self.fixed_api_key
+        return super().api_key(config)
+
+    def url(self, config: AIConfig) -> str:
+        return getattr(config, f'{self.name}_base_url', None) or self.base_url
+
+    def payload(self, system_prompt: str, user_prompt: str, config: AIConfig) -> dict:
+        payload = {
+            "model": config.model_for(self.name),
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            "temperature": config.temperature
+        }
+        if self.json_mode:
+            payload["response_format"] = {"type": "json_object"}
+        return payload
+
+    def request_headers(self, config: AIConfig) -> dict:
+        api_key = self.api_key(config)
+        headers = {'Content-Type': 'application/json'}
+        if api_key:
+            headers['Authorization'] = f'Bearer {api_key}'
+        headers.update(self.headers)
+        return headers
+
+    def request(self, system_prompt, user_prompt, config, stream=False):
+        headers = self.request_headers(config)
+        payload = self.payload(system_prompt, user_prompt, config)
+        if stream:
+            payload["stream"] = True
+            if self.stream_usage:
+                payload["stream_options"] = {"include_usage": True}
+        return urllib.request.Request(
+            self.url(config) + '/chat/completions',
+            data=json.dumps(payload).encode('utf-8'),
+            headers=headers,
+            method='POST'
+        )
+
+    def parse_response(self, body):
+        return body['choices'][0]['message']['content'], body.get('usage')
+
+    def parse_stream(self, resp):
+        raw_usage = None
+        for data in iter_sse_data(resp):
+            if data == '[DONE]':
+                break
+            chunk = json.loads(data)
+            # OpenAI は最後のチャンクの usage、Groq は x_groq.usage に使用量が入る
+            raw_usage = chunk.get('usage') or (chunk.get('x_groq') or {}).get('usage') or raw_usage
+            choices = chunk.get('choices') or [{}]
+            text = (choices[0].get('delta') or {}).get('content')
+            if text:
+                yield text
+        return raw_usage
+
+
+class AnthropicClient(ProviderClient):
+    """Anthropic Messages API（システムプロンプトはキャッシュ対象）"""
+    name = 'anthropic'
+    default_model = 'claude-3-5-sonnet-20241022'
+    key_placeholder = 'sk-ant-xxxx'
+    json_mode = False
+    prompt_cache = 'explicit'
+    batch = True
+
+    def payload(self, system_prompt: str, user_prompt: str, config: AIConfig) -> dict:
+        return {
+            "model": config.model_for(self.name),
+            "max_tokens": 4096,
+            "temperature": config.temperature,
+            "system": anthropic_system(system_prompt, config),
+            "messages": [{"role": "user", "content": user_prompt}]
+        }
+
+    def request_headers(self, config: AIConfig) -> dict:
+        return {'x-api-key': self.api_key(config), 'anthropic-version': '2023-06-01'}
+
+    def request(self, system_prompt, user_prompt, config, stream=False):
+        headers = dict(self.request_headers(config), **{'Content-Type': 'application/json'})
+        payload = self.payload(system_prompt, user_prompt, config)
+        if stream:
+            payload["stream"] = True
+        return urllib.request.Request(
+            config.anthropic_base_url + '/messages',
+            data=json.dumps(payload).encode('utf-8'),
+            headers=headers,
+            method='POST'
+        )
+
+    def parse_response(self, body):
+        return body['content'][0]['text'], body.get('usage')
+
+    def parse_stream(self, resp):
+        raw_usage = {}
+        for data in iter_sse_data(resp):
+            event = json.loads(data)
+            if event.get('type') == 'content_block_delta':
+                text = event.get('delta', {}).get('text')
+                if text:
+                    yield text
+            elif event.get('type') == 'message_start':
+                # 入力側（キャッシュの読み書きを含む）は message_start、出力トークン数は message_delta に入る
+                raw_usage.update(event.get('message', {}).get('usage') or {})
+            elif event.get('type') == 'message_delta':
+                raw_usage.update(event.get('usage') or {})
+            elif event.get('type') == 'message_stop':
+                break
+        return raw_usage
+
+
+class GeminiClient(ProviderClient):
+    """Google Gemini API (AI Studio)（システムプロンプトはコンテキストキャッシュに登録）"""
+    name = 'gemini'
+    default_model = 'gemini-2.0-flash'
+    key_placeholder = 'AIzaSy-xxxx'
+    prompt_cache = 'explicit'
+
+    def open(self, system_prompt, user_prompt, config, stream=False):
+        self.api_key(config)
+        if stream:
+            return open_gemini('streamGenerateContent', system_prompt, user_prompt, config, query='alt=sse&')
+        return open_gemini('generateContent', system_prompt, user_prompt, config)
+
+    def parse_response(self, body):
+        return body['candidates'][0]['content']['parts'][0]['text'], body.get('usageMetadata')
+
+    def parse_stream(self, resp):
+        raw_usage = None
+        for data in iter_sse_data(resp):
+            chunk = json.loads(data)
+            raw_usage = chunk.get('usageMetadata') or raw_usage
+            for candidate in chunk.get('candidates', []):
+                for part in candidate.get('content', {}).get('parts', []):
+                    if part.get('text'):
+                        yield part['text']
+        return raw_usage
+
+
+# 登録済みのクライアント（名前 → クライアント）と、計測を付けた呼び出し関数（resilient_call などが使う）
+_provider_clients = {}
+CALL_FUNCTIONS = {}
+STREAM_FUNCTIONS = {}
+_registry_lock = threading.Lock()
+
+
+def register_provider(client: ProviderClient) -> ProviderClient:
+    """クライアントを登録する（同じ名前なら置き換える）"""
+    with _registry_lock:
+        _provider_clients[client.name] = client
+        CALL_FUNCTIONS[client.name] = instrument_provider(client.name)(client.call)
+        STREAM_FUNCTIONS[client.name] = instrument_provider(client.name)(client.stream)
+    return client
+
+
+def get_provider(name: str) -> ProviderClient:
+    try:
+        return _provider_clients[name]
+    except KeyError:
+        raise ValueError(f"未対応のプロバイダです: {name}") from None
+
+
+def provider_names() -> tuple:
+    return tuple(_provider_clients)
+
+
+register_provider(GeminiClient())
+register_provider(ChatCompletionsClient('openai', 'https://api.openai.com/v1', 'gpt-4o', 'sk-xxxx', batch=True))
+register_provider(AnthropicClient())
+register_provider(ChatCompletionsClient('groq', 'https://api.groq.com/openai/v1', 'llama-3.3-70b-versatile', 'gsk_xxxx',
+                                        headers={'User-Agent': 'Kizuki-Log/1.0'}, stream_usage=False))
+BUILTIN_PROVIDERS = provider_names()
+
+
+def register_env_providers(environ=None) -> list:
+    """
+    AI_CUSTOM_PROVIDERS=ollama,lmstudio に並べた OpenAI互換サーバーを登録する。
+    名前ごとに {NAME}_BASE_URL（必須）・{NAME}_MODEL・{NAME}_API_KEY（無ければ認証なし）・
+    {NAME}_JSON_MODE（response_format に対応していなければ off）を読む。
+    """
+    env = os.environ if environ is None else environ
+    registered = []
+    for name in (env.get('AI_CUSTOM_PROVIDERS') or '').split(','):
+        name = name.strip().lower()
+        if not name:
+            continue
+        prefix = name.upper().replace('-', '_')
+        base_url = env.get(f'{prefix}_BASE_URL', '').strip().rstrip('/')
+        if name in BUILTIN_PROVIDERS or not base_url:
+            print(f"⚠ AI_CUSTOM_PROVIDERS の {name} を無視します（組み込みのプロバイダ名か、{prefix}_BASE_URL が未設定）")
+            continue
+        register_provider(ChatCompletionsClient(
+            name, base_url,
+            default_model=env.get(f'{prefix}_MODEL', '').strip(),
+            api_key=env.get(f'{prefix}_API_KEY', '').strip(),
+            json_mode=env.get(f'{prefix}_JSON_MODE', 'on').strip().lower() not in ('0', 'off', 'false', 'no'),
+            stream_usage=False,
+            prompt_cache=''
+        ))
+        registered.append(name)
+    return registered
+
+
+# 従来の関数名（デバッグスクリプトなどから直接呼ぶ用）
+call_openai = CALL_FUNCTIONS['openai']
+call_anthropic = CALL_FUNCTIONS['anthropic']
+call_gemini = CALL_FUNCTIONS['gemini']
+call_groq = CALL_FUNCTIONS['groq']
+stream_openai = STREAM_FUNCTIONS['openai']
+stream_anthropic = STREAM_FUNCTIONS['anthropic']
+stream_gemini = STREAM_FUNCTIONS['gemini']
+stream_groq = STREAM_FUNCTIONS['groq']
+
+
+def validate_journal_result(result: dict) -> dict:
+    """analyze_journal の応答に必須フィールドが揃っているか確認する"""
+    if 'sos_alert' in result:
+        return result  # SOS アラートはそのまま返す
+
+    required_keys = ['translation_for_instructor', 'mentoring_support', 'mentoring_seeds']
+    for key in required_keys:
+        if key not in result:
+            raise ValueError(f"APIレスポンスに必須フィールド '{key}' がありません")
+    return result
+
+
+# ──────────────────────────────────────────────
+# レート制限（プロバイダごとの RPM / TPM をクライアント側で守る）
+# ──────────────────────────────────────────────
+# 上限を超えるリクエストは 429 で断られると分かっているため、送らずにサーバー内で順番を待たせる。
+metrics.histogram('kizuki_ai_rate_limit_wait_seconds', 'レート制限で送信を待たせた時間')
+metrics.counter('kizuki_ai_rate_limited_total',
+                'レート制限の発動回数（action: waited=待ってから送信, rejected=待ち時間が長いため次のプロバイダへ, blocked=429を受けて送信を停止）')
+
+# 出力トークン数の見込み（実際の使用量が分かったら差分を精算する）
+EXPECTED_OUTPUT_TOKENS = 1000
+
+
+# 概算の係数（日本語は1文字≒1トークン、英数字・記号は3〜4文字≒1トークン。どのプロバイダでも多めに見積もる側）
+WIDE_CHAR_TOKENS = 1.0
+NARROW_CHARS_PER_TOKEN = 3.5
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    トークン数の概算。UTF-8 のバイト数と文字数の差から非ASCII文字（日本語）の数を出すため、
+    1文字ずつのループを回さず長文でも速い。
+    """
+    if not text:
+        return 0
+    chars = len(text)
+    wide = min(chars, (len(text.encode('utf-8')) - chars) // 2)  # 日本語は3バイト = 1文字あたり2バイト多い
+    return int(wide * WIDE_CHAR_TOKENS + (chars - wide) / NARROW_CHARS_PER_TOKEN) + 1
+
+
+class RateLimited(Exception):
+    """レート制限の待ち時間が長すぎるため送信しなかった"""
+
+    def __init__(self, provider: str, wait: float):
+        super().__init__(f"{provider} のリクエスト上限に達しています（あと約{wait:.0f}秒で再開）。しばらくしてからお試しください。")
+        self.provider = provider
+        self.wait = wait
+
+
+class TokenBucket:
+    """1分あたり per_minute 個まで補充されるバケツ（残量は予約によって負にもなる）"""
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        if now > self.updated:
+            self.level = min(self.per_minute, self.level + (now - self.updated) * self.per_minute / 60.0)
+            self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        # 1回で上限を超える量は、満タンになるまで待てば通す
+        deficit = min(amount, self.per_minute) - self.level
+        return max(0.0, deficit * 60.0 / self.per_minute)
+
+
+class RateLimiter:
+    """
+    プロバイダごとのリクエスト数（RPM）・トークン数（TPM）のバケツ。全スレッドで共有する。
+    acquire() は必要な量を予約して待ち時間だけ眠り、release() で実際の使用トークン数との差を精算する。
+    予約は呼び出し順に積まれるため、待っているスレッドは先着順に送信される。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}        # (provider, 'requests' | 'tokens') -> TokenBucket
+        self._blocked_until = {}  # provider -> monotonic 時刻（429 の Retry-After）
+
+    def _bucket(self, provider, limit, per_minute):
+        bucket = self._buckets.get((provider, limit))
+        if not per_minute:
+            self._buckets.pop((provider, limit), None)
+            return None
+        if bucket is None:
+            bucket = self._buckets[(provider, limit)] = TokenBucket(per_minute)
+        elif bucket.per_minute != per_minute:
+            bucket.per_minute = per_minute  # 設定の再読み込み
+        return bucket
+
+    def acquire(self, config: AIConfig, tokens: int, trace: dict = None):
+        """
+        config.provider に1リクエスト・tokens トークンを予約し、必要なだけ待つ。
+        待ち時間が rate_limit_max_wait（と締め切り）を超えるなら予約せずに RateLimited を送出する。
+        """
+        provider = config.provider
+        rpm, tpm = dict((p, (r, t)) for p, r, t in config.rate_limits).get(provider, (0, 0))
+        now = time.monotonic()
+        with self._lock:
+            buckets = [(b, amount) for b, amount in ((self._bucket(provider, 'requests', rpm), 1),
+                                                     (self._bucket(provider, 'tokens', tpm), tokens)) if b]
+            for bucket, _ in buckets:
+                bucket.refill(now)
+            wait = max([b.wait_time(amount) for b, amount in buckets]
+                       + [self._blocked_until.get(provider, now) - now, 0.0])
+            if wait > min(config.rate_limit_max_wait, config.deadline - 1):
+                metrics.inc('kizuki_ai_rate_limited_total', provider=provider, action='rejected')
+                raise RateLimited(provider, wait)
+            for bucket, amount in buckets:
+                bucket.level -= amount
+        if wait > 0:
+            metrics.inc('kizuki_ai_rate_limited_total', provider=provider, action='waited')
+            metrics.observe('kizuki_ai_rate_limit_wait_seconds', wait, provider=provider)
+            if trace is not None:
+                trace['rate_limit_wait_ms'] = trace.get('rate_limit_wait_ms', 0) + round(wait * 1000, 1)
+            time.sleep(wait)
+        return (provider, tokens)
+
+    def release(self, reservation, usage: dict = None, error: Exception = None):
+        """予約したトークン数を実際の使用量で精算する（失敗して使用量が無ければ返却）"""
+        if reservation is None:
+            return
+        provider, reserved = reservation
+        used = (usage or {}).get('input_tokens', 0) + (usage or {}).get('output_tokens', 0)
+        with self._lock:
+            bucket = self._buckets.get((provider, 'tokens'))
+            if bucket is not None:
+                bucket.level = min(bucket.per_minute, bucket.level + reserved - used)
+            if isinstance(error, urllib.error.HTTPError) and error.code == 429:
+                # プロバイダに断られたら、Retry-After の間は他のスレッドも送らない
+                retry_after = parse_retry_after(error.headers)
+                if retry_after:
+                    self._blocked_until[provider] = max(self._blocked_until.get(provider, 0),
+                                                        time.monotonic() + retry_after)
+                    metrics.inc('kizuki_ai_rate_limited_total', provider=provider, action='blocked')
+
+    def levels(self):
+        """計測用: (provider, limit) ごとの (現在の残量, 1分あたりの上限)"""
+        now = time.monotonic()
+        with self._lock:
+            for bucket in self._buckets.values():
+                bucket.refill(now)
+            return {key: (bucket.level, bucket.per_minute) for key, bucket in self._buckets.items()}
+
+
+rate_limiter = RateLimiter()
+metrics.gauge('kizuki_ai_rate_limit_available', 'レート制限のバケツの残量（負なら予約待ちがある）',
+              lambda: [({'provider': p, 'limit': limit}, level) for (p, limit), (level, _) in rate_limiter.levels().items()])
+metrics.gauge('kizuki_ai_rate_limit_per_minute', 'レート制限の1分あたりの上限',
+              lambda: [({'provider': p, 'limit': limit}, cap) for (p, limit), (_, cap) in rate_limiter.levels().items()])
+
+
+def estimate_request_tokens(system_prompt: str, user_prompt: str) -> int:
+    return estimate_tokens(system_prompt) + estimate_tokens(user_prompt) + EXPECTED_OUTPUT_TOKENS
+
+
+# ──────────────────────────────────────────────
+# 再試行とフォールバック（3つの解析関数で共通）
+# ──────────────────────────────────────────────
+metrics.counter('kizuki_ai_retries_total', 'AI呼び出しの再試行・フォールバック（action: retry / fallback、reason: 失敗の種類）')
+
+# 同じプロバイダで再試行する HTTP ステータス（429 は Retry-After が短いときだけ）
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504, 529)
+
+
+class InvalidResponse(ValueError):
+    """応答は届いたが、JSONとして読めない・必須フィールドが無い"""
+
+
+class Cancelled(Exception):
+    """ヘッジ要求で相手が先に応答したため打ち切った"""
+
+
+def parse_retry_after(headers) -> float:
+    """Retry-After ヘッダ（秒数または HTTP 日付）を待ち秒数にする。無ければ None"""
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(config: AIConfig, attempt: int) -> float:
+    """attempt 回目の失敗後の待ち時間（上限付き指数バックオフ＋フルジッター）"""
+    return random.uniform(0, min(config.retry_max_delay, config.retry_base_delay * 2 ** (attempt - 1)))
+
+
+def classify_failure(error: Exception, config: AIConfig, attempt: int):
+    """
+    失敗を (reason, 同じプロバイダで待つ秒数) に分類する。
+    待つ秒数が None なら再試行せず次のプロバイダへ進む。
+    """
+    if isinstance(error, urllib.error.HTTPError):
+        retry_after = parse_retry_after(error.headers)
+        if error.code not in RETRYABLE_STATUS:
+            return str(error.code), None
+        if retry_after is not None:
+            # 長く待たされる（クォータ切れなど）なら待たずに次のプロバイダへ
+            if retry_after > config.retry_max_delay:
+                return str(error.code), None
+            # 429 の Retry-After は rate_limiter が全スレッド分まとめて待たせる
+            return str(error.code), 0.0 if error.code == 429 else retry_after
+        if error.code == 429:
+            return '429', None
+        return str(error.code), backoff_delay(config, attempt)
+    if isinstance(error, RateLimited):
+        return 'rate_limited', None
+    if isinstance(error, (InvalidResponse, json.JSONDecodeError, KeyError, IndexError, TypeError)):
+        return 'invalid_response', backoff_delay(config, attempt)
+    if isinstance(error, (TimeoutError, socket.timeout)):
+        return 'timeout', backoff_delay(config, attempt)
+    if isinstance(error, urllib.error.URLError):
+        reason = 'timeout' if isinstance(error.reason, (TimeoutError, socket.timeout)) else 'connection'
+        return reason, backoff_delay(config, attempt)
+    if isinstance(error, (ConnectionError, http.client.HTTPException)):
+        return 'connection', backoff_delay(config, attempt)
+    # APIキー未設定などの設定エラーは再試行しても変わらない
+    return type(error).__name__, None
+
+
+def _attempts(config: AIConfig, default_fallback: str, label: str, trace: dict):
+    """
+    試す順に (設定, 試行回数, 締め切りまでの残り秒数) を返し、失敗を send() で受け取る。
+    resilient_call / resilient_stream の共通部分。
+    """
+    deadline = time.monotonic() + config.deadline
+    chain = config.attempt_chain(default_fallback)
+    total = 0
+    for index, attempt_config in enumerate(chain):
+        provider = attempt_config.provider
+        for attempt in range(1, attempt_config.retry_attempts + 1):
+            remaining = deadline - time.monotonic()
+            if remaining < 1:
+                return
+            total += 1
+            trace['provider'] = provider
+            trace['attempts'] = total
+            error = yield replace(attempt_config, request_timeout=min(attempt_config.request_timeout, remaining),
+                                  deadline=remaining)
+            reason, delay = classify_failure(error, attempt_config, attempt)
+            if delay is not None and attempt < attempt_config.retry_attempts \
+                    and time.monotonic() + delay < deadline - 1:
+                print(f"⚠️  {label}: {provider} で失敗しました（{reason}）。{delay:.1f}秒後に再試行します "
+                      f"({attempt}/{attempt_config.retry_attempts})")
+                metrics.inc('kizuki_ai_retries_total', provider=provider, action='retry', reason=reason)
+                time.sleep(delay)
+                continue
+            if index + 1 < len(chain):
+                print(f"⚠️  {label}: {provider} で失敗しました（{reason}）。"
+                      f"{chain[index + 1].provider} にフォールバックします...")
+                metrics.inc('kizuki_ai_retries_total', provider=provider, action='fallback', reason=reason)
+            break
+
+
+def resilient_call(system_prompt: str, user_prompt: str, config: AIConfig, validate=None, trace: dict = None,
+                   default_fallback: str = '', label: str = 'AI'):
+    """
+    config.attempt_chain() の順にプロバイダを試し、(検証済みの結果, 応答した設定) を返す。
+    一時的な失敗（5xx・タイムアウト・接続エラー・壊れたJSON、Retry-After の短い 429）は
+    同じプロバイダでバックオフしながら再試行し、それ以外や回数切れは次のプロバイダへ進む。
+    1回ごとの待ち時間は request_timeout、全体は deadline 秒で打ち切る。
+    送信前に rate_limiter で順番を待ち、待ち時間が長すぎるプロバイダは飛ばす。
+    すべて失敗したら最後の（設定エラーより実際の呼び出しの）例外を送出する。
+    """
+    trace = {} if trace is None else trace
+    attempts = _attempts(config, default_fallback, label, trace)
+    errors = []
+    tokens = estimate_request_tokens(system_prompt, user_prompt)
+    attempt_config = next(attempts, None)
+    token = current_cancel_token()
+    while attempt_config is not None:
+        reservation, usage = None, {}
+        try:
+            reservation = rate_limiter.acquire(attempt_config, tokens, trace)
+            if token is not None and token.cancelled:
+                rate_limiter.release(reservation)
+                attempts.close()
+                raise Cancelled()
+            result = CALL_FUNCTIONS[attempt_config.provider](system_prompt, user_prompt,
+                                                              config=attempt_config, usage=usage)
+            rate_limiter.release(reservation, usage)
+            trace.update(usage)
+            if validate is not None:
+                try:
+                    result = validate(result)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    raise InvalidResponse(str(e)) from e
+            attempts.close()
+            return result, attempt_config
+        except Cancelled:
+            raise
+        except Exception as e:
+            if not isinstance(e, InvalidResponse):
+                rate_limiter.release(reservation, usage, e)
+            if token is not None and token.cancelled:
+                attempts.close()
+                raise Cancelled() from e
+            errors.append(e)
+            attempt_config = _send(attempts, e)
+    raise _final_error(errors, config)
+
+
+def resilient_stream(system_prompt: str, user_prompt: str, config: AIConfig, trace: dict = None,
+                     default_fallback: str = '', label: str = 'AI'):
+    """
+    resilient_call のストリーミング版。("delta", 断片) を順に返し、
+    最後に (全文, 応答した設定) を return する（yield from で受け取る）。
+    断片を返し始めた後の失敗はやり直せないため、そのまま送出する。
+    """
+    trace = {} if trace is None else trace
+    attempts = _attempts(config, default_fallback, label, trace)
+    errors = []
+    tokens = estimate_request_tokens(system_prompt, user_prompt)
+    attempt_config = next(attempts, None)
+    while attempt_config is not None:
+        chunks, reservation, usage = [], None, {}
+        try:
+            reservation = rate_limiter.acquire(attempt_config, tokens, trace)
+            try:
+                for text in STREAM_FUNCTIONS[attempt_config.provider](system_prompt, user_prompt,
+                                                                       config=attempt_config, usage=usage):
+                    chunks.append(text)
+                    yield ("delta", text)
+            finally:
+                trace.update(usage)
+            rate_limiter.release(reservation, usage)
+            reservation = None
+            attempts.close()
+            return ''.join(chunks), attempt_config
+        except Exception as e:
+            rate_limiter.release(reservation, usage, e)
+            reservation = None
+            if chunks:
+                raise
+            errors.append(e)
+            attempt_config = _send(attempts, e)
+        finally:
+            if reservation is not None:
+                # 受け取り側が途中で読むのをやめた（GeneratorExit）: usage はまだ届いていないので、
+                # 送ったプロンプトとそれまでに受け取った断片の分で精算する
+                rate_limiter.release(reservation, usage or {
+                    'input_tokens': tokens - EXPECTED_OUTPUT_TOKENS,
+                    'output_tokens': estimate_tokens(''.join(chunks)),
+                })
+    raise _final_error(errors, config)
+
+
+def _send(attempts, error):
+    try:
+        return attempts.send(error)
+    except StopIteration:
+        return None
+
+
+def _final_error(errors, config):
+    if not errors:
+        return TimeoutError(f"AI呼び出しが {config.deadline:g} 秒以内に完了しませんでした")
+    # 後ろのプロバイダのAPIキー未設定などで、実際の失敗理由が隠れないようにする
+    for error in reversed(errors):
+        if classify_failure(error, config, 1)[1] is not None \
+                or isinstance(error, (urllib.error.HTTPError, RateLimited)):
+            return error
+    return errors[-1]
+
+
+# ──────────────────────────────────────────────
+# ヘッジ要求（応答の遅い主プロバイダを待たずに、次のプロバイダにも同じプロンプトを送る）
+# ──────────────────────────────────────────────
+metrics.counter('kizuki_ai_hedged_requests_total',
+                'ヘッジ要求の結果（hedged: yes=次のプロバイダにも送った, no=待ち時間内に応答, '
+                'skipped=次のプロバイダがレート制限中, fallback=主プロバイダが失敗）と応答したプロバイダ')
+metrics.histogram('kizuki_ai_hedge_delay_seconds', 'ヘッジ要求を送るまでの待ち時間')
+
+
+def hedge_delay(config: AIConfig) -> float:
+    """主プロバイダの直近の応答時間の hedge_percentile（記録が少ないうちは hedge_delay）"""
+    delay = provider_latency.percentile(config.provider, config.hedge_percentile)
+    return config.hedge_delay if delay is None else delay
+
+
+def _single_provider(config: AIConfig, rest=()) -> AIConfig:
+    """config.provider（と rest の設定）だけを試す設定にする"""
+    chain = tuple((c.provider, c.model_for(c.provider)) for c in (config,) + tuple(rest))
+    return replace(config, fallback_chain=chain)
+
+
+def hedged_call(system_prompt: str, user_prompt: str, config: AIConfig, validate=None, trace: dict = None,
+                default_fallback: str = '', label: str = 'AI'):
+    """
+    resilient_call のヘッジ版（config.hedge が無効、またはフォールバック先が無ければ resilient_call と同じ）。
+    主プロバイダが hedge_delay() 秒以内に応答しなければ、同じプロンプトを attempt_chain() の次のプロバイダにも送り、
+    先に検証を通った方を採用して、もう一方は接続を閉じて打ち切る。
+    次のプロバイダが rate_limiter で待たされる状態ならヘッジは送らない。主プロバイダが失敗したら通常のフォールバックになる。
+    trace に hedged（yes / no / skipped / fallback）・hedge_delay_ms・hedge_winner（応答したプロバイダ）・
+    hedge_cancelled（打ち切ったプロバイダ）を書き込む。リクエストログに残り、待ち時間の調整に使う。
+    """
+    trace = {} if trace is None else trace
+    chain = config.attempt_chain(default_fallback)
+    if not config.hedge or len(chain) < 2:
+        return resilient_call(system_prompt, user_prompt, config, validate, trace, default_fallback, label)
+
+    primary = _single_provider(chain[0])
+    deadline = time.monotonic() + config.deadline
+    delay = min(hedge_delay(chain[0]), config.deadline)
+    results = queue.Queue()
+    legs = {}  # 'primary' | 'secondary' -> (CancelToken, trace)
+    running = set()
+
+    def start(name, leg_config):
+        token, leg_trace = CancelToken(), {}
+        legs[name] = (token, leg_trace)
+        running.add(name)
+        leg_config = replace(leg_config, deadline=max(1.0, deadline - time.monotonic()))
+
+        def run():
+            _cancel_local.token = token
+            try:
+                results.put((name, resilient_call(system_prompt, user_prompt, leg_config, validate, leg_trace,
+                                                  label=label), None))
+            except Exception as e:
+                results.put((name, None, e))
+
+        threading.Thread(target=run, name=f'hedge-{name}', daemon=True).start()
+
+    start('primary', primary)
+    hedged = 'no'
+    hedge_at = time.monotonic() + delay
+    name, outcome, errors = None, None, []
+    while outcome is None and running:
+        now = time.monotonic()
+        waiting_hedge = 'secondary' not in legs
+        try:
+            name, outcome, error = results.get(timeout=max(0.0, (hedge_at if waiting_hedge else deadline) - now))
+        except queue.Empty:
+            if not waiting_hedge:
+                break  # 締め切り
+            # 待ち時間内に応答が無い: 待たずに送れるときだけ次のプロバイダにも送る
+            start('secondary', replace(_single_provider(chain[1], chain[2:]), rate_limit_max_wait=0.0))
+            hedged = 'yes'
+            metrics.observe('kizuki_ai_hedge_delay_seconds', delay, provider=chain[0].provider)
+            print(f"⏱  {label}: {chain[0].provider} が {delay:.1f}秒以内に応答しないため、{chain[1].provider} にも送ります")
+            continue
+        running.discard(name)
+        if error is None:
+            break
+        errors.append(error)
+        if name == 'secondary' and hedged == 'yes' and isinstance(error, RateLimited):
+            hedged = 'skipped'
+        if name == 'primary' and hedged in ('no', 'skipped'):
+            # 主プロバイダが失敗した: 次のプロバイダへ通常どおりフォールバックする（レート制限の順番も待つ）
+            hedged = 'fallback'
+            start('secondary', _single_provider(chain[1], chain[2:]))
+
+    # まだ応答を待っている側（負けた側・締め切りを過ぎた側）は接続を閉じて打ち切る
+    cancelled = [legs[other][1].get('provider') for other in running]
+    for other in running:
+        legs[other][0].cancel()
+    winner = outcome[1].provider if outcome is not None else None
+    trace.update(hedged=hedged, hedge_delay_ms=round(delay * 1000, 1), hedge_winner=winner,
+                 hedge_cancelled=','.join(p for p in cancelled if p) or None)
+    metrics.inc('kizuki_ai_hedged_requests_total', primary=chain[0].provider, winner=winner or 'none', hedged=hedged)
+    if outcome is None:
+        raise _final_error(errors, config)
+
+    trace.update(legs[name][1])
+    return outcome
+
+
+def analyze_journal_stream(week: int, log_achieved: str, log_unachieved: str,
+                           instructor_notes: str = "", provider: str = None,
+                           model: str = None, config: AIConfig = None, force_refresh: bool = False,
+                           trace: dict = None):
+    """
+    analyze_journal のストリーミング版。
+    ("delta", テキスト断片) を生成途中に順次返し、最後に ("result", 解析結果) を返す。
+    エラー時は analyze_journal と同じ形式の辞書を ("result", ...) で返す。
+    キャッシュにあればその結果を一つの断片として返す。trace は analyze_journal と同じ。
+    """
+    trace = {} if trace is None else trace
+    try:
+        config = resolve_config(config, provider, model)
+    except ValueError as e:
+        yield ("result", {
+            "error": True,
+            "message": str(e),
+            "suggestion": "プロバイダの指定を確認してください。"
+        })
+        return
+    provider = config.provider
+    user_prompt = build_user_prompt(
+        week, log_achieved, log_unachieved, instructor_notes
     )
-    
-    with urllib.request.urlopen(req, timeout=60) as resp:
-        result = json.loads(resp.read().decode('utf-8'))
-    
-    content = result['choices'][0]['message']['content']
-    return json.loads(content)
+    trace['provider'] = provider
+    cached = lookup_cached_response(config, SYSTEM_PROMPT, user_prompt, force_refresh, trace)
+    if cached is not None:
+        yield ("delta", json.dumps(cached, ensure_ascii=False, indent=2))
+        yield ("result", cached)
+        return
+
+    try:
+        # まだ何も返していない間の失敗だけ、再試行・フォールバックで最初からやり直す
+        content, answered = yield from resilient_stream(SYSTEM_PROMPT, user_prompt, config, trace, label='日誌解析')
+        result = validate_journal_result(parse_json_content(content))
+        store_cached_response(answered, answered.provider, SYSTEM_PROMPT, user_prompt, result)
+        yield ("result", result)
+
+    except urllib.error.HTTPError as e:
+        error_body = e.read().decode('utf-8') if e.fp else ''
+        yield ("result", {
+            "error": True,
+            "message": f"API エラー ({e.code}): {error_body[:200]}",
+            "suggestion": "APIキーの設定と残高を確認してください。"
+        })
+    except RateLimited as e:
+        yield ("result", {
+            "error": True,
+            "message": str(e),
+            "suggestion": "別のAIエンジンを選ぶか、AI_FALLBACK_CHAIN を設定してください。"
+        })
+    except urllib.error.URLError as e:
+        yield ("result", {
+            "error": True,
+            "message": f"接続エラー: {str(e.reason)}",
+            "suggestion": "インターネット接続を確認してください。"
+        })
+    except json.JSONDecodeError as e:
+        yield ("result", {
+            "error": True,
+            "message": f"JSON解析エラー: {str(e)}",
+            "suggestion": "AIの応答形式が不正でした。再度お試しください。"
+        })
+    except Exception as e:
+        yield ("result", {
+            "error": True,
+            "message": f"予期しないエラー: {str(e)}",
+            "suggestion": "開発者に連絡してください。"
+        })
 
 
 def analyze_journal(week: int, log_achieved: str, log_unachieved: str,
-                    instructor_notes: str = "") -> dict:
+                    instructor_notes: str = "", provider: str = None,
+                    model: str = None, config: AIConfig = None, force_refresh: bool = False,
+                    trace: dict = None) -> dict:
     """
     メインの解析関数。
     Constitution §5.2 準拠のJSON を返す。
+    provider / model を指定するとこの呼び出しだけ設定を差し替える。
+    同じプロンプトの結果がキャッシュにあれば API を呼ばずに返す（force_refresh で無視）。
+    trace に辞書を渡すと、応答したプロバイダ・キャッシュの利用・使用トークン数
+    （input / cached / cache_write / output）を書き込む。
     """
-    load_env()
-    
-    provider = os.environ.get('AI_PROVIDER', 'gemini').lower()
+    trace = {} if trace is None else trace
+    config = resolve_config(config, provider, model)
+    provider = config.provider
     user_prompt = build_user_prompt(
         week, log_achieved, log_unachieved, instructor_notes
     )
-    
-    # プロバイダ → 呼び出し関数のマッピング
-    provider_map = {
-        'gemini': call_gemini,
-        'openai': call_openai,
-        'anthropic': call_anthropic,
-        'groq': call_groq,
-    }
-    
-    # フォールバック設定（メインが429エラーの場合に使用）
-    fallback_provider = os.environ.get('AI_FALLBACK_PROVIDER', '').lower()
+    trace['provider'] = provider
+    cached = lookup_cached_response(config, SYSTEM_PROMPT, user_prompt, force_refresh, trace)
+    if cached is not None:
+        return cached
     
     try:
-        call_fn = provider_map.get(provider, call_gemini)
-        try:
-            result = call_fn(SYSTEM_PROMPT, user_prompt)
-        except urllib.error.HTTPError as e:
-            if e.code == 429 and fallback_provider and fallback_provider in provider_map:
-                print(f"⚠️  {provider} がクォータ制限中。{fallback_provider} にフォールバックします...")
-                fallback_fn = provider_map[fallback_provider]
-                result = fallback_fn(SYSTEM_PROMPT, user_prompt)
-            else:
-                raise
-        
-        # レスポンスの検証
-        if 'sos_alert' in result:
-            return result  # SOS アラートはそのまま返す
-        
-        # 必須フィールドの存在チェック
-        required_keys = ['translation_for_instructor', 'mentoring_support', 'mentoring_seeds']
-        for key in required_keys:
-            if key not in result:
-                raise ValueError(f"APIレスポンスに必須フィールド '{key}' がありません")
-        
+        # 検証に通らない応答も再試行・フォールバックの対象にする
+        result, answered = resilient_call(SYSTEM_PROMPT, user_prompt, config, validate=validate_journal_result,
+                                          trace=trace, label='日誌解析')
+        store_cached_response(answered, answered.provider, SYSTEM_PROMPT, user_prompt, result)
         return result
         
     except urllib.error.HTTPError as e:
@@ -470,6 +2106,12 @@ def analyze_journal(week: int, log_achieved: str, log_unachieved: str,
             "message": f"API エラー ({e.code}): {error_body[:200]}",
             "suggestion": "APIキーの設定と残高を確認してください。"
         }
+    except RateLimited as e:
+        return {
+            "error": True,
+            "message": str(e),
+            "suggestion": "別のAIエンジンを選ぶか、AI_FALLBACK_CHAIN を設定してください。"
+        }
     except urllib.error.URLError as e:
         return {
             "error": True,
@@ -490,73 +2132,283 @@ def analyze_journal(week: int, log_achieved: str, log_unachieved: str,
         }
 
 
-def analyze_weekly(week_number: int, journals: list) -> dict:
+# ──────────────────────────────────────────────
+# 週次分析のプロンプトの大きさの調整
+# ──────────────────────────────────────────────
+# プロバイダごとのコンテキスト長（入力＋出力のトークン数。既定のモデルの値）
+CONTEXT_WINDOWS = {
+    'gemini': 1000000,
+    'openai': 128000,
+    'anthropic': 200000,
+    'groq': 128000,
+}
+WEEKLY_OUTPUT_TOKENS = 4096
+
+# 縮める順（優先度の低い記述から）と、1日あたり最低限残すトークン数
+WEEKLY_TRIM_ORDER = (
+    ('instructor_notes', 60),
+    ('practical_content', 200),
+    ('unachieved_point', 100),
+    ('step0_judgments', 150),
+)
+ELLIPSIS = '…（中略）…'
+
+
+def prompt_budget(config: AIConfig, system_prompt: str, max_tokens: int) -> int:
     """
-    1週間分の日誌リストを分析し、週次レビューとスコアを返す。
-    journals: [ { "date": "...", "practical_content": "...", "step0_judgments": [...] }, ... ]
+    ユーザープロンプトに使えるトークン数。コンテキスト長・max_tokens・
+    レート制限の TPM（1回で TPM を超えるリクエストは送れない）のうち最も小さいものから、システムプロンプトの分を引く。
     """
-    load_env()
-    
-    # ユーザープロンプトの構築
-    journal_texts = []
-    judgments_summary = []
-    
-    for j in journals:
-        date = j.get('date', '不明')
-        content = j.get('practical_content', '')
-        unachieved = j.get('unachieved_point', '')
-        notes = j.get('instructor_notes', '')
-        
-        entry = f"--- 日付: {date} ---\n[実習内容]\n{content}\n[反省]\n{unachieved}\n[指導者メモ]\n{notes}\n"
-        
-        juds = j.get('step0_judgments', [])
-        if juds:
-            entry += "[確定判定]\n"
-            for jud in juds:
-                entry += f"  - Lv.{jud.get('level')} | {jud.get('concept_source')} | {jud.get('evidence')}\n"
-        
-        journal_texts.append(entry)
+    provider = config.provider
+    limit = min(CONTEXT_WINDOWS.get(provider, 32000) - WEEKLY_OUTPUT_TOKENS, max_tokens)
+    tpm = dict((p, t) for p, _, t in config.rate_limits).get(provider)
+    if tpm:
+        limit = min(limit, int(tpm) - EXPECTED_OUTPUT_TOKENS)
+    return max(0, limit - estimate_tokens(system_prompt))
+
+
+def condense(text: str, max_tokens: int) -> str:
+    """text を max_tokens 程度に縮める（冒頭を多めに、末尾も少し残して間を省く。文の区切りで切る）"""
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    if max_tokens <= estimate_tokens(ELLIPSIS):
+        return '（省略）'
+    keep = max(0, int(len(text) * (max_tokens - estimate_tokens(ELLIPSIS)) / tokens))
+    head, tail = text[:keep * 2 // 3], text[len(text) - keep // 3:] if keep // 3 else ''
+    cut = head.rfind('。')
+    if cut >= len(head) // 2:
+        head = head[:cut + 1]
+    cut = tail.find('。')
+    if 0 <= cut < len(tail) // 2:
+        tail = tail[cut + 1:]
+    return head + ELLIPSIS + tail
+
+
+def _weekly_sections(journal: dict) -> dict:
+    judgments = ''.join(f"  - Lv.{jud.get('level')} | {jud.get('concept_source')} | {jud.get('evidence')}\n"
+                        for jud in journal.get('step0_judgments') or [])
+    return {
+        'practical_content': journal.get('practical_content', ''),
+        'unachieved_point': journal.get('unachieved_point', ''),
+        'instructor_notes': journal.get('instructor_notes', ''),
+        'step0_judgments': judgments,
+    }
+
+
+def _weekly_entry(date, sections: dict) -> str:
+    entry = (f"--- 日付: {date} ---\n[実習内容]\n{sections['practical_content']}\n[反省]\n"
+             f"{sections['unachieved_point']}\n[指導者メモ]\n{sections['instructor_notes']}\n")
+    if sections['step0_judgments']:
+        entry += "[確定判定]\n" + sections['step0_judgments']
+    return entry
+
 
-    user_prompt = f"""【重要事項】
+def _cap_for(sizes: list, excess: int, floor: int) -> int:
+    """各日の大きさを cap で頭打ちにして excess 以上減らせる最大の cap（floor 未満にはしない）"""
+    low, high = floor, max(sizes, default=floor)
+    if sum(max(0, size - floor) for size in sizes) <= excess:
+        return floor
+    while low < high:
+        cap = (low + high + 1) // 2
+        if sum(max(0, size - cap) for size in sizes) >= excess:
+            low = cap
+        else:
+            high = cap - 1
+    return low
+
+
+def fit_weekly_entries(journals: list, budget: int, frame_tokens: int = 0):
+    """
+    1日分ずつの記述を budget トークン（frame_tokens は日誌以外の定型文の分）に収める。
+    WEEKLY_TRIM_ORDER の順に、長い日から同じ上限で頭打ちにして縮める（短い日はそのまま残る）。
+    最低限の量まで縮めても収まらなければ、同じ順に最低限の量も削る。
+    戻り値は (日付ごとの記述のリスト, 縮める前のトークン数, 縮めた後のトークン数)
+    """
+    days = [(j.get('date', '不明'), _weekly_sections(j)) for j in journals]
+
+    def total():
+        return frame_tokens + sum(estimate_tokens(_weekly_entry(date, sections)) for date, sections in days)
+
+    before = current = total()
+    for use_floor in (True, False):
+        for field, floor in WEEKLY_TRIM_ORDER:
+            if current <= budget:
+                break
+            sizes = [estimate_tokens(sections[field]) for _, sections in days]
+            cap = _cap_for(sizes, current - budget, floor if use_floor else 0)
+            for (_, sections), size in zip(days, sizes):
+                if size > cap:
+                    sections[field] = condense(sections[field], cap)
+            current = total()
+    return [_weekly_entry(date, sections) for date, sections in days], before, current
+
+
+def weekly_user_prompt(week_number: int, journal_texts: list, summarized: bool = False) -> str:
+    """週次分析のユーザープロンプト（journal_texts は日付ごとの記述。summarized なら日ごとの解析の要約）"""
+    note = SUMMARY_NOTE if summarized else ''
+    return f"""【重要事項】
 これは全11週間にわたる薬局実習のうち、「第 {week_number} 週目」のまとめ分析です。
 ({week_number}/11週目という現在地を強く意識してください。序盤・中盤の週である場合、「実習全体を通して」や「初日から最終日で大きく変化した」といった完了形の評価は不適切です)
 
 以下の第 {week_number} 週目の実習記録と判定データを精査し、週次レビューを作成してください：
-
+{note}
 {"".join(journal_texts)}
 
 ---
 上記を元に、指定されたJSON形式で週次レビューを出力してください。
 """
 
-    provider = os.environ.get('AI_PROVIDER', 'gemini').lower()
-    # 週次分析は文脈が長くなるため、可能であればより賢いモデルを選択（ここでは共通の仕組みを利用）
-    
-    provider_map = {
-        'gemini': call_gemini,
-        'openai': call_openai,
-        'anthropic': call_anthropic,
-        'groq': call_groq,
-    }
-    
-    fallback_provider = os.environ.get('AI_FALLBACK_PROVIDER', '').lower()
+
+# ──────────────────────────────────────────────
+# 週次分析の map-reduce（日ごとの解析結果を集めて、要約だけを週次分析に送る）
+# ──────────────────────────────────────────────
+WEEKLY_MAP_WORKERS = 4
+# 解析結果が無い（失敗した）日は原文を縮めて送る
+RAW_ENTRY_TOKENS = 600
+
+SUMMARY_NOTE = """
+※ 各日の記録は、日誌を1日ずつ解析した結果の要約です。『』内は学生の日誌・指導者メモからの引用なので、そのまま引用に使えます。
+  [判定] は指導者が確定した Step 0 判定（未確定の日は AI の判定候補）です。
+"""
+
+
+def usable_analysis(analysis) -> bool:
+    """analyze_journal の結果として週次分析に使えるか（エラーでない）"""
+    return isinstance(analysis, dict) and not analysis.get('error') \
+        and ('translation_for_instructor' in analysis or bool(analysis.get('sos_alert')))
+
+
+def day_summary(journal: dict, analysis: dict) -> str:
+    """1日分の解析結果を、週次分析に送る短い記述にする"""
+    lines = [f"--- 日付: {journal.get('date', '不明')} ---"]
+    if analysis.get('sos_alert'):
+        lines.append(f"[SOS] {analysis.get('alert_reason', '')}")
+    translation = analysis.get('translation_for_instructor') or {}
+    for label, key in (('気づき', 'professional_insight'), ('成長', 'growth_evidence'), ('注意', 'attention_points')):
+        if translation.get(key):
+            lines.append(f"[{label}] {translation[key]}")
+    praise = (analysis.get('mentoring_support') or {}).get('praise_points')
+    if praise:
+        lines.append(f"[褒める点] {praise}")
+    notes = journal.get('instructor_notes', '')
+    if notes:
+        lines.append(f"[指導者メモ] {condense(notes, 150)}")
+    judgments = journal.get('step0_judgments') or []
+    source = judgments if judgments else [d for d in analysis.get('step0_drafts') or [] if isinstance(d, dict)]
+    label = '判定' if judgments else '判定候補（AI）'
+    for item in source:
+        lines.append(f"[{label}] Lv.{item.get('level')} | {item.get('concept_source')} | {item.get('evidence')}")
+    return '\n'.join(lines) + '\n'
+
+
+def map_day_analyses(week_number: int, journals: list, config: AIConfig, on_day_analysis=None,
+                     trace: dict = None) -> list:
+    """
+    日誌ごとの解析結果（journal['ai_analysis']）を集める。無い日だけ analyze_journal を並行して実行し、
+    on_day_analysis(journal, analysis) で呼び出し元に保存させる（次回からは再解析しない）。
+    解析できなかった日は None。
+    """
+    trace = {} if trace is None else trace
+    analyses = [j.get('ai_analysis') if usable_analysis(j.get('ai_analysis')) else None for j in journals]
+    missing = [i for i, analysis in enumerate(analyses) if analysis is None]
+    trace['map_reused'] = len(journals) - len(missing)
+    trace['map_analyzed'] = len(missing)
+    if not missing:
+        return analyses
+
+    started = time.perf_counter()
+
+    def analyze(journal):
+        return analyze_journal(journal.get('week_number') or week_number, journal.get('practical_content', ''),
+                               journal.get('unachieved_point', ''), journal.get('instructor_notes', ''),
+                               config=config)
+
+    with ThreadPoolExecutor(max_workers=min(WEEKLY_MAP_WORKERS, len(missing)),
+                            thread_name_prefix='weekly-map') as executor:
+        for i, analysis in zip(missing, executor.map(analyze, [journals[i] for i in missing])):
+            if not usable_analysis(analysis):
+                print(f"  ⚠ 週次分析: {journals[i].get('date', '不明')} の日誌を解析できませんでした: "
+                      f"{analysis.get('message', '')}")
+                continue
+            analyses[i] = analysis
+            if on_day_analysis is not None:
+                try:
+                    on_day_analysis(journals[i], analysis)
+                except Exception as e:
+                    print(f"  ⚠ 週次分析: 日ごとの解析結果を保存できませんでした: {e}")
+    trace['map_failed'] = sum(1 for i in missing if analyses[i] is None)
+    trace['map_ms'] = _elapsed_ms(started)
+    return analyses
+
+
+def weekly_summaries(journals: list, analyses: list, budget: int, frame_tokens: int = 0):
+    """
+    日ごとの要約（解析できなかった日は原文を縮めたもの）を budget に収めて返す。
+    戻り値は fit_weekly_entries と同じ (記述のリスト, 縮める前のトークン数, 縮めた後のトークン数)
+    """
+    texts = []
+    for journal, analysis in zip(journals, analyses):
+        if analysis is not None:
+            texts.append(day_summary(journal, analysis))
+        else:
+            texts.append(fit_weekly_entries([journal], RAW_ENTRY_TOKENS)[0][0])
+    sizes = [estimate_tokens(text) for text in texts]
+    before = frame_tokens + sum(sizes)
+    if before <= budget:
+        return texts, before, before
+    cap = _cap_for(sizes, before - budget, 0)
+    texts = [condense(text, cap) if size > cap else text for text, size in zip(texts, sizes)]
+    return texts, before, frame_tokens + sum(estimate_tokens(text) for text in texts)
+
+
+def validate_weekly_result(result: dict) -> dict:
+    """analyze_weekly の応答の最低限のバリデーション"""
+    if 'weekly_review' not in result or 'internal_scores' not in result:
+        raise ValueError("週次レビューの必須フィールドが不足しています。")
+    return result
+
+
+def analyze_weekly(week_number: int, journals: list, provider: str = None,
+                   model: str = None, config: AIConfig = None, force_refresh: bool = False,
+                   trace: dict = None, mode: str = None, on_day_analysis=None) -> dict:
+    """
+    1週間分の日誌リストを分析し、週次レビューとスコアを返す。
+    journals: [ { "date": "...", "practical_content": "...", "step0_judgments": [...], "ai_analysis": {...} }, ... ]
+    mode（既定は AI_WEEKLY_MODE）が map_reduce なら、日ごとの解析結果（ai_analysis）の要約だけを送る。
+    解析結果の無い日は先に並行して解析し、on_day_analysis(journal, analysis) で保存させる。
+    日誌が変わっていなければキャッシュ済みの結果を返す（force_refresh で無視）。trace は analyze_journal と同じ。
+    """
+    trace = {} if trace is None else trace
+    config = resolve_config(config, provider, model)
+    mode = (mode or config.weekly_mode or 'full').strip().lower()
+    summarized = mode == 'map_reduce'
+    trace['weekly_mode'] = 'map_reduce' if summarized else 'full'
     
+    # ユーザープロンプトの構築（プロバイダの上限に収まらない週は、優先度の低い記述から縮める）
+    budget = prompt_budget(config, WEEKLY_SYSTEM_PROMPT, config.weekly_max_tokens)
+    frame_tokens = estimate_tokens(weekly_user_prompt(week_number, [], summarized))
+    if summarized:
+        analyses = map_day_analyses(week_number, journals, config, on_day_analysis, trace)
+        journal_texts, before, after = weekly_summaries(journals, analyses, budget, frame_tokens)
+    else:
+        journal_texts, before, after = fit_weekly_entries(journals, budget, frame_tokens)
+    trace['prompt_tokens_est'] = after
+    if after < before:
+        trace['trimmed_tokens_est'] = before - after
+        print(f"✂️  週次分析: プロンプトを約 {before} → {after} トークンに縮めました（上限 {budget}）")
+    user_prompt = weekly_user_prompt(week_number, journal_texts, summarized)
+
+    provider = config.provider
+    trace['provider'] = provider
+    cached = lookup_cached_response(config, WEEKLY_SYSTEM_PROMPT, user_prompt, force_refresh, trace)
+    if cached is not None:
+        return cached
+    # 週次分析は文脈が長くなるため、可能であればより賢いモデルを選択（ここでは共通の仕組みを利用）
     try:
-        call_fn = provider_map.get(provider, call_gemini)
-        try:
-            result = call_fn(WEEKLY_SYSTEM_PROMPT, user_prompt)
-        except urllib.error.HTTPError as e:
-            if e.code == 429 and fallback_provider and fallback_provider in provider_map:
-                print(f"⚠️  週次分析: {provider} がクォータ制限中。{fallback_provider} にフォールバックします...")
-                fallback_fn = provider_map[fallback_provider]
-                result = fallback_fn(WEEKLY_SYSTEM_PROMPT, user_prompt)
-            else:
-                raise
-        
-        # 最低限のバリデーション
-        if 'weekly_review' not in result or 'internal_scores' not in result:
-             raise ValueError("週次レビューの必須フィールドが不足しています。")
-        
+        result, answered = resilient_call(WEEKLY_SYSTEM_PROMPT, user_prompt, config, validate=validate_weekly_result,
+                                          trace=trace, label='週次分析')
+        store_cached_response(answered, answered.provider, WEEKLY_SYSTEM_PROMPT, user_prompt, result)
         return result
 
     except urllib.error.HTTPError as e:
@@ -574,13 +2426,27 @@ def analyze_weekly(week_number: int, journals: list) -> dict:
         }
 
 
-def generate_daily_comment(current_step0, student_summary):
+def validate_daily_comment(result) -> dict:
+    """generate_daily_comment の応答に daily_comment（文字列）があるか確認する"""
+    data = result if isinstance(result, dict) else json.loads(result)
+    if not isinstance(data.get('daily_comment'), str):
+        raise ValueError("APIレスポンスに必須フィールド 'daily_comment' がありません")
+    return data
+
+
+def generate_daily_comment(current_step0, student_summary, provider: str = None,
+                           model: str = None, config: AIConfig = None, trace: dict = None,
+                           force_refresh: bool = False):
     """
     Step0（指導者判定済）の結果と、過去の文脈（Seed履歴）を踏まえて
     最終的な「今日の指導コメント（1〜2文）」を生成する。
+    trace に辞書を渡すと、段階ごとの所要時間（ms）・プロンプトのサイズ・使用したプロバイダ・
+    キャッシュの利用（hit / miss / refresh）・使用トークン数・ヘッジ要求の結果（hedged など）を書き込む。
     """
-    load_env()
-    provider = os.environ.get('AI_PROVIDER', 'gemini')
+    trace = {} if trace is None else trace
+    config = resolve_config(config, provider, model)
+    provider = config.provider
+    started = time.perf_counter()
     
     prompt = f"""あなたは、地域密着型薬局の熟練指導薬剤師です。
 学生が提出した日誌をもとに作成された「指導者のStep0（注目ポイント）」と、「直近の指導文脈（過去のSeed）」を踏まえ、
@@ -611,53 +2477,205 @@ def generate_daily_comment(current_step0, student_summary):
   "daily_comment": "生成した指導コメント（1〜2文）"
 }}
 """
-    provider_map = {
-        'gemini': call_gemini,
-        'openai': call_openai,
-        'anthropic': call_anthropic,
-        'groq': call_groq,
-    }
-    
-    fallback_provider = os.environ.get('AI_FALLBACK_PROVIDER', 'groq').lower()
+    system_prompt = "あなたは熟練指導薬剤師です。JSONのみを出力します。"
+    trace['prompt_ms'] = _elapsed_ms(started)
+    trace['prompt_bytes'] = len(prompt.encode('utf-8'))
+    trace['provider'] = provider
+
+    cached = lookup_cached_response(config, system_prompt, prompt, force_refresh, trace)
+    if cached is not None:
+        return cached
     
     try:
-        call_fn = provider_map.get(provider, call_gemini)
-        
-        try:
-            response = call_fn(
-                system_prompt="あなたは熟練指導薬剤師です。JSONのみを出力します。",
-                user_prompt=prompt
-            )
-        except urllib.error.HTTPError as e:
-            if e.code == 429 and fallback_provider and fallback_provider in provider_map:
-                print(f"⚠️  指導コメント生成: {provider} がクォータ制限中。{fallback_provider} にフォールバックします...")
-                fallback_fn = provider_map[fallback_provider]
-                response = fallback_fn(
-                    system_prompt="あなたは熟練指導薬剤師です。JSONのみを出力します。",
-                    user_prompt=prompt
-                )
-            else:
-                raise
-                
-        data = response if isinstance(response, dict) else json.loads(response)
+        started = time.perf_counter()
+        # フォールバック先が未設定なら Groq を使う
+        # AI_HEDGE=on なら、応答の遅いときはフォールバック先にも同時に送る
+        data, answered = hedged_call(system_prompt, prompt, config, validate=validate_daily_comment,
+                                     trace=trace, default_fallback='groq', label='指導コメント生成')
+        trace['provider_ms'] = _elapsed_ms(started)
+        store_cached_response(answered, answered.provider, system_prompt, prompt, data)
         return data
 
     except Exception as e:
         print(f"Daily comment generation error: {e}")
+        trace['error'] = type(e).__name__
         return {
             "error": True,
             "daily_comment": f"コメント生成に失敗しました: {str(e)}"
         }
 
 
+# ──────────────────────────────────────────────
+# バッチAPI（夜間の一括再解析。同期呼び出しより安く、レート制限も別枠）
+# ──────────────────────────────────────────────
+# プロンプトを JSONL にまとめて送信し、完了を待って結果を custom_id ごとに受け取る。
+# 結果が返るまで数分〜最大24時間かかるため、画面からの解析ではなく scripts/data/analyze_cohort.py --batch-api で使う。
+BATCH_PROVIDERS = tuple(name for name in provider_names() if get_provider(name).batch)
+
+metrics.counter('kizuki_ai_batch_requests_total',
+                'バッチAPIで送信・受信したリクエスト数（result: submitted / succeeded / errored）')
+
+
+def _batch_client(config: AIConfig) -> ProviderClient:
+    client = get_provider(config.provider)
+    if not client.batch:
+        raise ValueError(f"バッチAPIに対応していないプロバイダです: {config.provider}（{', '.join(BATCH_PROVIDERS)} のみ）")
+    return client
+
+
+def batch_request_line(custom_id: str, system_prompt: str, user_prompt: str, config: AIConfig) -> dict:
+    """バッチの1リクエスト分（本文は同期呼び出しと同じ）"""
+    payload = _batch_client(config).payload(system_prompt, user_prompt, config)
+    if config.provider == 'anthropic':
+        return {"custom_id": custom_id, "params": payload}
+    return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": payload}
+
+
+def _batch_headers(config: AIConfig) -> dict:
+    client = _batch_client(config)
+    if config.provider == 'anthropic':
+        return client.request_headers(config)
+    return {'Authorization': f'Bearer {client.api_key(config)}'}
+
+
+def _batch_api(config: AIConfig, url: str, payload=None, body: bytes = None, content_type: str = 'application/json',
+               raw: bool = False):
+    """バッチAPIへのリクエスト（payload は JSON として送る。raw なら応答を bytes のまま返す）"""
+    headers = _batch_headers(config)
+    if payload is not None:
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    if body is not None:
+        headers['Content-Type'] = content_type
+    req = urllib.request.Request(url, data=body, headers=headers, method='POST' if body is not None else 'GET')
+    with open_url(req, timeout=config.request_timeout) as resp:
+        data = resp.read()
+    return data if raw else json.loads(data.decode('utf-8'))
+
+
+def submit_batch(requests: list, config: AIConfig = None) -> str:
+    """
+    [(custom_id, system_prompt, user_prompt), ...] をバッチとして送信し、バッチIDを返す。
+    OpenAI は JSONL をファイルとしてアップロードしてから /batches、Anthropic は /messages/batches に直接送る。
+    """
+    config = config or get_config()
+    lines = [batch_request_line(custom_id, system_prompt, user_prompt, config)
+             for custom_id, system_prompt, user_prompt in requests]
+    if not lines:
+        raise ValueError("バッチに含めるリクエストがありません")
+
+    if config.provider == 'anthropic':
+        batch = _batch_api(config, config.anthropic_base_url + '/messages/batches', {"requests": lines})
+    else:
+        _batch_headers(config)  # APIキーの確認（JSONL を組み立てる前に失敗させる）
+        jsonl = ''.join(json.dumps(line, ensure_ascii=False) + '\n' for line in lines).encode('utf-8')
+        boundary = f'kizuki-{hashlib.sha256(jsonl).hexdigest()[:24]}'
+        body = (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="purpose"\r\n\r\nbatch\r\n'
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="kizuki_batch.jsonl"\r\n'
+            'Content-Type: application/jsonl\r\n\r\n'
+        ).encode('utf-8') + jsonl + f'\r\n--{boundary}--\r\n'.encode('utf-8')
+        uploaded = _batch_api(config, config.openai_base_url + '/files', body=body,
+                              content_type=f'multipart/form-data; boundary={boundary}')
+        batch = _batch_api(config, config.openai_base_url + '/batches', {
+            "input_file_id": uploaded['id'],
+            "endpoint": "/v1/chat/completions",
+            "completion_window": "24h"
+        })
+    metrics.inc('kizuki_ai_batch_requests_total', len(lines), provider=config.provider, result='submitted')
+    return batch['id']
+
+
+def batch_status(batch_id: str, config: AIConfig = None) -> dict:
+    """
+    バッチの状態。{"status": プロバイダの状態, "ended": 結果を取り出せるか, "counts": 件数, "raw": 応答}
+    OpenAI の failed（入力の検証エラー）は ended=True で、結果は0件になる。
+    """
+    config = config or get_config()
+    if config.provider == 'anthropic':
+        batch = _batch_api(config, f'{config.anthropic_base_url}/messages/batches/{batch_id}')
+        status = batch.get('processing_status', '')
+        return {"status": status, "ended": status == 'ended',
+                "counts": batch.get('request_counts') or {}, "raw": batch}
+    batch = _batch_api(config, f'{config.openai_base_url}/batches/{batch_id}')
+    status = batch.get('status', '')
+    return {"status": status, "ended": status in ('completed', 'failed', 'expired', 'cancelled'),
+            "counts": batch.get('request_counts') or {}, "raw": batch}
+
+
+def wait_for_batch(batch_id: str, config: AIConfig = None, poll_interval: float = 60.0,
+                   timeout: float = None, on_poll=None) -> dict:
+    """バッチが終わるまで poll_interval 秒ごとに状態を確認する（timeout 秒を過ぎたら TimeoutError）"""
+    config = config or get_config()
+    started = time.monotonic()
+    while True:
+        status = batch_status(batch_id, config)
+        if on_poll:
+            on_poll(status)
+        if status['ended']:
+            return status
+        if timeout is not None and time.monotonic() - started + poll_interval > timeout:
+            raise TimeoutError(f"バッチ {batch_id} が {timeout:g} 秒以内に完了しませんでした（状態: {status['status']}）")
+        time.sleep(poll_interval)
+
+
+def _batch_result_lines(status: dict, config: AIConfig):
+    """終わったバッチの結果ファイル（JSONL）を1行ずつ辞書で返す"""
+    raw = status['raw']
+    if config.provider == 'anthropic':
+        urls = [raw['results_url']] if raw.get('results_url') else []
+    else:
+        urls = [f"{config.openai_base_url}/files/{raw[key]}/content"
+                for key in ('output_file_id', 'error_file_id') if raw.get(key)]
+    for url in urls:
+        for line in _batch_api(config, url, raw=True).decode('utf-8').splitlines():
+            if line.strip():
+                yield json.loads(line)
+
+
+def fetch_batch_results(status: dict, config: AIConfig = None, validate=None):
+    """
+    終わったバッチ（batch_status の戻り値）の結果を (custom_id, 解析結果, エラーメッセージ) で順に返す。
+    成功した行は JSON として解析し validate で確認する。失敗した行は解析結果が None になる。
+    """
+    config = config or get_config()
+    provider = config.provider
+    for line in _batch_result_lines(status, config):
+        custom_id = line.get('custom_id')
+        try:
+            if provider == 'anthropic':
+                outcome = line.get('result') or {}
+                if outcome.get('type') != 'succeeded':
+                    error = outcome.get('error') or {}
+                    raise InvalidResponse(f"{outcome.get('type', 'unknown')}: {json.dumps(error, ensure_ascii=False)[:200]}")
+                message = outcome['message']
+                record_usage(provider, message.get('usage'))
+                result = parse_json_content(message['content'][0]['text'])
+            else:
+                response = line.get('response') or {}
+                if line.get('error') or response.get('status_code') != 200:
+                    error = line.get('error') or response.get('body')
+                    raise InvalidResponse(f"{response.get('status_code', 'error')}: "
+                                          f"{json.dumps(error, ensure_ascii=False)[:200]}")
+                body = response['body']
+                record_usage(provider, body.get('usage'))
+                result = parse_json_content(body['choices'][0]['message']['content'])
+            if validate:
+                result = validate(result)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            metrics.inc('kizuki_ai_batch_requests_total', provider=provider, result='errored')
+            yield custom_id, None, str(e)
+            continue
+        metrics.inc('kizuki_ai_batch_requests_total', provider=provider, result='succeeded')
+        yield custom_id, result, None
+
+
 # ──────────────────────────────────────────────
 # CLIテスト用
 # ──────────────────────────────────────────────
 if __name__ == '__main__':
     if '--test' in sys.argv:
         print("=== Kizuki-Log AI Bridge テスト ===")
-        load_env()
-        print(f"プロバイダ: {os.environ.get('AI_PROVIDER', 'gemini')}")
+        print(f"プロバイダ: {get_config().provider}")
         
         # サンプル日誌（中﨑さん Week 1 のデータを匿名化）
         test_result = analyze_journal(
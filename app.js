@@ -24,9 +24,25 @@ function generateStableId(name) {
     return Math.abs(hash) + 100000;
 }
 
+/**
+ * 学生の詳細（日誌・週次レビューなど）を、表示に必要になった時点で読み込む。
+ * 一覧取得時点の学生オブジェクトには journals がないので、それを目印にする。
+ */
+async function ensureStudentLoaded(student) {
+    if (!student || student.journals) return student;
+    const response = await fetch(`/api/students/${encodeURIComponent(student.id)}`, { cache: 'no-cache' });
+    if (!response.ok) {
+        throw new Error(`学生データの取得に失敗しました (${response.status})`);
+    }
+    Object.assign(student, await response.json());
+    resumePendingJobs(student);
+    return student;
+}
+
 async function init() {
     try {
-        const response = await fetch('./dashboard_data.json?t=' + Date.now());
+        // 初回表示は学生一覧だけを取得し、日誌などは学生の選択時に読み込む
+        const response = await fetch('/api/students', { cache: 'no-cache' });
         dashboardData = await response.json();
 
         // 各学生に初期設定を付与（既存データ移行用）
@@ -47,13 +63,15 @@ async function init() {
         const visibleStudents = dashboardData.students.filter(s => !HIDDEN_STUDENT_IDS.includes(s.id));
         const firstStudent = visibleStudents[0];
         if (firstStudent) {
+            await ensureStudentLoaded(firstStudent);
             updateDashboard(firstStudent);
             syncSettingsForm(firstStudent);
         }
 
-        document.getElementById('student-select').addEventListener('change', (e) => {
+        document.getElementById('student-select').addEventListener('change', async (e) => {
             const student = dashboardData.students.find(s => s.id == e.target.value);
             if (student) {
+                await ensureStudentLoaded(student);
                 updateDashboard(student);
                 syncSettingsForm(student);
                 clearDailyInterface();
@@ -84,6 +102,55 @@ async function init() {
     } catch (error) {
         console.error('Error loading dashboard data:', error);
     }
+
+    checkSyncConflicts();
+    setInterval(checkSyncConflicts, SYNC_STATUS_POLL_INTERVAL_MS);
+}
+
+// ─── 同期の競合の通知 ───
+// 同期で取り込んだ変更と、この端末の未送信の変更が同じ項目を書き換えていた場合、
+// サーバーはこの端末の値を残す。上書きされなかった他の端末の値をここで知らせる。
+const SYNC_STATUS_POLL_INTERVAL_MS = 60 * 1000;
+const SYNC_CONFLICTS_SEEN_KEY = 'kizuki_sync_conflicts_seen';
+
+async function checkSyncConflicts() {
+    let status;
+    try {
+        const response = await fetch('/sync_status', { cache: 'no-store' });
+        if (!response.ok) return;
+        status = await response.json();
+    } catch (e) {
+        return;
+    }
+    const seen = localStorage.getItem(SYNC_CONFLICTS_SEEN_KEY) || '';
+    const conflicts = (status.conflicts || []).filter(c => (c.merged_at || '') > seen);
+    const banner = document.getElementById('sync-conflict-banner');
+    if (!banner) return;
+    if (!conflicts.length) {
+        banner.hidden = true;
+        return;
+    }
+
+    const describe = (value) => {
+        if (value === null || value === undefined) return '（削除）';
+        const text = typeof value === 'string' ? value : JSON.stringify(value);
+        return text.length > 80 ? text.slice(0, 80) + '…' : text;
+    };
+    const items = conflicts.map(c => {
+        const kept = c.kept === 'local' ? 'この端末の値を残しました' : '他の端末の値を残しました';
+        const other = c.kept === 'local' ? c.remote : c.local;
+        return `<li><code>${escapeHtml(c.file || '')} ${escapeHtml(c.path || '')}</code>（${kept}。もう一方の値: ${escapeHtml(describe(other))}）</li>`;
+    }).join('');
+    banner.innerHTML = `
+        <strong>⚠ 他の端末と同じ項目が別々に編集されていました（${conflicts.length}件）</strong>
+        <ul>${items}</ul>
+        <button type="button" class="sync-conflict-dismiss">確認しました</button>`;
+    banner.hidden = false;
+    banner.querySelector('.sync-conflict-dismiss').addEventListener('click', () => {
+        const latest = conflicts.reduce((max, c) => ((c.merged_at || '') > max ? c.merged_at : max), seen);
+        localStorage.setItem(SYNC_CONFLICTS_SEEN_KEY, latest);
+        banner.hidden = true;
+    });
 }
 
 function setupEventListeners() {
@@ -142,7 +209,7 @@ function setupEventListeners() {
     // 保存ボタン
     const saveSettingsBtn = document.getElementById('save-settings-btn');
     if (saveSettingsBtn) {
-        saveSettingsBtn.addEventListener('click', () => {
+        saveSettingsBtn.addEventListener('click', async () => {
             const name = document.getElementById('student-name').value.trim();
             if (!name) {
                 alert("学生氏名を入力してください");
@@ -166,6 +233,9 @@ function setupEventListeners() {
 
             let student = dashboardData.students.find(s => s.name === name);
             const isNew = !student;
+            if (student) {
+                await ensureStudentLoaded(student);
+            }
 
             if (isNew) {
                 student = {
@@ -191,7 +261,12 @@ function setupEventListeners() {
 
             alert(isNew ? `新しい学生「${name}」を登録しました。` : `「${name}」の設定を変更しました。`);
 
-            saveDataToServer();
+            savePatchToServer({
+                type: 'student',
+                student_id: student.id,
+                name: student.name,
+                settings: student.settings
+            });
             clearDailyInterface();
             document.querySelector('.tab-btn[data-tab="storyboard"]').click();
             updateDashboard(student);
@@ -234,7 +309,14 @@ function setupEventListeners() {
                 journal.content = practicalText; // 互換性のため
                 journal.instructor_notes = instructorNotes;
 
-                await saveDataToServer();
+                await saveJournalFields(student, journal, {
+                    id: journal.id,
+                    week_number: journal.week_number,
+                    practical_content: practicalText,
+                    unachieved_point: unachievedText,
+                    content: practicalText,
+                    instructor_notes: instructorNotes
+                });
 
                 // カレンダーの再描画
                 renderCalendar(student);
@@ -274,7 +356,7 @@ function setupEventListeners() {
                 const journal = student.journals.find(j => j.date === dateStr);
                 if (journal) {
                     journal.feedback = text;
-                    await saveDataToServer();
+                    await saveJournalFields(student, journal, { feedback: text });
                     alert("フィードバックを保存しました！");
                 } else {
                     alert("先に日誌を保存してください。");
@@ -301,7 +383,7 @@ function setupEventListeners() {
                 const journal = student.journals.find(j => j.date === dateStr);
                 if (journal) {
                     journal.selected_seed = selected.value;
-                    await saveDataToServer();
+                    await saveJournalFields(student, journal, { selected_seed: selected.value });
                     alert("指導シードを保存しました！\n次回の日誌入力時に「継続フラグ」として表示されます。");
                 }
             }
@@ -344,7 +426,7 @@ function setupEventListeners() {
             journal.step0_judgments = finalJudgments;
 
             // サーバーへ送信
-            await saveDataToServer();
+            await saveJournalFields(student, journal, { step0_judgments: finalJudgments });
             alert("研究用データ（Step0）の判定を確定・保存しました！");
 
             // 保存完了のUI視覚的フィードバック
@@ -411,7 +493,8 @@ function setupEventListeners() {
                         week: 1,
                         log_achieved: '接続テスト',
                         log_unachieved: '接続テスト',
-                        provider: provider
+                        provider: provider,
+                        force_refresh: true
                     })
                 });
                 const result = await response.json();
@@ -480,41 +563,24 @@ async function performAIAnalysis(week, logAchieved, logUnachieved, previousTrigg
     analyzeBtn.textContent = '解析中...';
 
     try {
-        const selectedProvider = document.getElementById('ai-provider-select')?.value || '';
-        const response = await fetch('/analyze', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                week: week,
-                log_achieved: logAchieved,
-                log_unachieved: logUnachieved,
-                previous_triggers: previousTriggers,
-                instructor_notes: instructorNotes,
-                provider: selectedProvider
-            })
-        });
-
-        const result = await response.json();
-
-        if (result.error) {
-            renderErrorResult(result);
-        } else if (result.sos_alert) {
-            renderSOSAlert(result);
-        } else {
-            renderBriefingReport(result);
-        }
-
-        // 解析結果を保存
         const studentId = document.getElementById('student-select').value;
         const student = dashboardData.students.find(s => s.id == studentId);
         const dateStr = document.getElementById('daily-date').value;
-        if (student) {
-            const journal = student.journals.find(j => j.date === dateStr);
-            if (journal) {
-                journal.ai_analysis = result;
-                await saveDataToServer();
-            }
-        }
+
+        // 解析結果はサーバー側で日誌に保存される
+        const target = { student_id: student?.id, date: dateStr };
+        const params = {
+            week: week,
+            log_achieved: logAchieved,
+            log_unachieved: logUnachieved,
+            previous_triggers: previousTriggers,
+            instructor_notes: instructorNotes
+        };
+        // 生成途中の文章から順に表示する（ストリーミング非対応ならジョブ方式で待つ）
+        const result = await streamAIAnalysis(params, target) || await runAIJob('analyze', params, target);
+
+        applyJobResultLocally('analyze', target, result);
+        renderAnalysisResult(result);
 
     } catch (error) {
         renderErrorResult({
@@ -529,6 +595,147 @@ async function performAIAnalysis(week, logAchieved, logUnachieved, previousTrigg
     }
 }
 
+// ==================================================
+// AI 解析のストリーミング表示
+// ==================================================
+
+/**
+ * /analyze_stream（Server-Sent Events）から生成途中のテキストを受け取り、
+ * 読み取れた部分からブリーフィング・レポートに描画する。
+ * ストリーミングを使えない環境では null を返す。
+ */
+async function streamAIAnalysis(params, target) {
+    if (typeof ReadableStream === 'undefined' || typeof TextDecoder === 'undefined') return null;
+
+    const request = await buildJsonRequest({
+        ...params,
+        target: target,
+        provider: document.getElementById('ai-provider-select')?.value || '',
+        force_refresh: isForceRefresh()
+    });
+    const response = await fetch('/analyze_stream', { method: 'POST', headers: request.headers, body: request.body });
+    if ((response.headers.get('Content-Type') || '').startsWith('application/json')) {
+        return await response.json();
+    }
+    if (!response.ok || !response.body) return null;
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let generated = '';
+    let result = null;
+    let renderScheduled = false;
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let separator;
+        while ((separator = buffer.indexOf('\n\n')) >= 0) {
+            const event = parseSSEEvent(buffer.slice(0, separator));
+            buffer = buffer.slice(separator + 2);
+
+            if (event.type === 'delta') {
+                generated += event.data.text;
+                if (!renderScheduled) {
+                    renderScheduled = true;
+                    requestAnimationFrame(() => {
+                        renderScheduled = false;
+                        if (!result) renderBriefingReport(parsePartialAnalysis(generated));
+                    });
+                }
+            } else if (event.type === 'result') {
+                result = event.data;
+            }
+        }
+    }
+    return result || { error: true, message: 'AIの応答が途中で途切れました。', suggestion: '再度お試しください。' };
+}
+
+function parseSSEEvent(block) {
+    let type = 'message';
+    const dataLines = [];
+    block.split('\n').forEach(line => {
+        if (line.startsWith('event:')) type = line.slice(6).trim();
+        else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+    });
+    return { type, data: JSON.parse(dataLines.join('\n') || 'null') };
+}
+
+/**
+ * 生成途中（閉じていない）の JSON テキストから、表示に使うフィールドを読み取る。
+ */
+function parsePartialAnalysis(text) {
+    return {
+        translation_for_instructor: {
+            professional_insight: extractPartialString(text, 'professional_insight'),
+            growth_evidence: extractPartialString(text, 'growth_evidence'),
+            attention_points: extractPartialString(text, 'attention_points')
+        },
+        mentoring_support: {
+            praise_points: extractPartialString(text, 'praise_points'),
+            suggested_questions: extractPartialStringArray(text, 'suggested_questions')
+        },
+        mentoring_seeds: extractPartialStringArray(text, 'mentoring_seeds')
+    };
+}
+
+function extractPartialString(text, key) {
+    const match = new RegExp(`"${key}"\\s*:\\s*"`).exec(text);
+    if (!match) return '';
+    return readPartialJsonString(text, match.index + match[0].length).value;
+}
+
+function extractPartialStringArray(text, key) {
+    const match = new RegExp(`"${key}"\\s*:\\s*\\[`).exec(text);
+    if (!match) return [];
+
+    const items = [];
+    let i = match.index + match[0].length;
+    while (i < text.length) {
+        while (i < text.length && /[\s,]/.test(text[i])) i++;
+        if (text[i] !== '"') break;
+        const item = readPartialJsonString(text, i + 1);
+        items.push(item.value);
+        if (!item.complete) break;
+        i = item.end;
+    }
+    return items;
+}
+
+/**
+ * start から始まる JSON 文字列を、閉じ引用符まで（なければ末尾まで）読む。
+ */
+function readPartialJsonString(text, start) {
+    let raw = '';
+    let i = start;
+    while (i < text.length) {
+        const ch = text[i];
+        if (ch === '\\') {
+            const length = text[i + 1] === 'u' ? 6 : 2;
+            if (i + length > text.length) break; // エスケープの途中で途切れている
+            raw += text.slice(i, i + length);
+            i += length;
+            continue;
+        }
+        if (ch === '"') {
+            return { value: decodeJsonString(raw), end: i + 1, complete: true };
+        }
+        raw += ch;
+        i++;
+    }
+    return { value: decodeJsonString(raw), end: i, complete: false };
+}
+
+function decodeJsonString(raw) {
+    try {
+        return JSON.parse(`"${raw}"`);
+    } catch (e) {
+        return raw;
+    }
+}
+
 // ==================================================
 // Post-Step0 指導コメント生成
 // ==================================================
@@ -558,33 +765,19 @@ async function generatePostStep0Comment(student, dateStr, currentStep0, usePastS
         };
     }
     
-    // API 呼び出し
+    // API 呼び出し（生成結果はサーバー側で日誌に保存される）
     try {
-        const selectedProvider = document.getElementById('ai-provider-select')?.value || '';
-        const response = await fetch('/generate_daily_comment', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                current_step0: currentStep0,
-                student_summary: studentSummary,
-                provider: selectedProvider
-            })
-        });
-        
-        const result = await response.json();
+        const target = { student_id: student.id, date: dateStr };
+        const result = await runAIJob('generate_daily_comment', {
+            current_step0: currentStep0,
+            student_summary: studentSummary
+        }, target);
         
         if (result.error) {
-            commentText.innerHTML = `<span style="color:red">エラー: ${escapeHtml(result.message)}</span>`;
+            commentText.innerHTML = `<span style="color:red">エラー: ${escapeHtml(result.message || result.daily_comment)}</span>`;
         } else if (result.daily_comment) {
-            const generatedComment = result.daily_comment;
-            commentText.textContent = generatedComment;
-            
-            // journal に保存
-            const journal = student.journals.find(j => j.date === dateStr);
-            if (journal) {
-                journal.ai_suggested_comment = generatedComment;
-                await saveDataToServer();
-            }
+            commentText.textContent = result.daily_comment;
+            applyJobResultLocally('generate_daily_comment', target, result);
         }
     } catch (e) {
         commentText.innerHTML = `<span style="color:red">通信エラー: ${escapeHtml(e.message)}</span>`;
@@ -596,6 +789,16 @@ async function generatePostStep0Comment(student, dateStr, currentStep0, usePastS
 // レンダリング関数
 // ==================================================
 
+function renderAnalysisResult(result) {
+    if (result.error) {
+        renderErrorResult(result);
+    } else if (result.sos_alert) {
+        renderSOSAlert(result);
+    } else {
+        renderBriefingReport(result);
+    }
+}
+
 function renderBriefingReport(result) {
     const resultDiv = document.getElementById('daily-analysis-result');
     const suggestDiv = document.getElementById('daily-suggestions');
@@ -774,15 +977,151 @@ function loadPreviousTriggers() {
 }
 
 
+// ==================================================
+// AI ジョブ（サーバー側のキューで実行し、結果は日誌に保存される）
+// ==================================================
+const JOB_POLL_INTERVAL_MS = 1500;
+const PENDING_JOBS_KEY = 'kizuki_pending_jobs';
+
+function jobTargetKey(kind, target) {
+    return [kind, target.student_id, target.date ?? target.week].join(':');
+}
+
+function loadPendingJobs() {
+    try {
+        return JSON.parse(localStorage.getItem(PENDING_JOBS_KEY)) || {};
+    } catch (e) {
+        return {};
+    }
+}
+
+function setPendingJob(kind, target, jobId) {
+    const pending = loadPendingJobs();
+    if (jobId) {
+        pending[jobTargetKey(kind, target)] = { kind, target, jobId };
+    } else {
+        delete pending[jobTargetKey(kind, target)];
+    }
+    localStorage.setItem(PENDING_JOBS_KEY, JSON.stringify(pending));
+}
+
+/**
+ * 設定の「キャッシュを使わずにAIへ問い合わせ直す」が ON か
+ */
+function isForceRefresh() {
+    return document.getElementById('ai-force-refresh')?.checked || false;
+}
+
+/**
+ * AI ジョブを投稿し、完了まで待って結果を返す。
+ * 実行中のジョブIDは localStorage に控えるので、再読み込み後も結果を受け取れる。
+ */
+async function runAIJob(kind, params, target) {
+    const request = await buildJsonRequest({
+        kind: kind,
+        params: params,
+        target: target,
+        provider: document.getElementById('ai-provider-select')?.value || '',
+        force_refresh: isForceRefresh()
+    });
+    const response = await fetch('/jobs', { method: 'POST', headers: request.headers, body: request.body });
+    const job = await response.json();
+    if (job.error) return job;
+
+    setPendingJob(kind, target, job.job_id);
+    return waitForJob(kind, target, job.job_id);
+}
+
+async function waitForJob(kind, target, jobId) {
+    while (true) {
+        const response = await fetch(`/jobs/${jobId}`, { cache: 'no-store' });
+        if (response.status === 404) {
+            setPendingJob(kind, target, null);
+            return { error: true, message: 'ジョブが見つかりません（サーバーが再起動された可能性があります）。' };
+        }
+        const job = await response.json();
+        if (job.status === 'done' || job.status === 'error') {
+            setPendingJob(kind, target, null);
+            return job.result;
+        }
+        await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+    }
+}
+
+/**
+ * サーバーが保存したジョブ結果を、手元の dashboardData にも反映する。
+ */
+function applyJobResultLocally(kind, target, result) {
+    if (!result || result.error) return;
+    const student = dashboardData.students.find(s => s.id == target.student_id);
+    if (!student || !student.journals) return;
+
+    if (kind === 'review_weekly') {
+        if (!student.weekly_reviews) student.weekly_reviews = {};
+        student.weekly_reviews[target.week] = result;
+        return;
+    }
+    const journal = student.journals.find(j => j.date === target.date);
+    if (!journal) return;
+    if (kind === 'analyze') {
+        journal.ai_analysis = result;
+    } else if (kind === 'generate_daily_comment') {
+        journal.ai_suggested_comment = result.daily_comment;
+    }
+}
+
+/**
+ * 再読み込み前に投稿したジョブの完了を待ち、結果を画面に反映する。
+ */
+function resumePendingJobs(student) {
+    Object.values(loadPendingJobs())
+        .filter(p => p.target.student_id == student.id)
+        .forEach(async (p) => {
+            const result = await waitForJob(p.kind, p.target, p.jobId);
+            applyJobResultLocally(p.kind, p.target, result);
+            const selectedId = document.getElementById('student-select').value;
+            if (selectedId != student.id) return;
+            if (p.kind === 'review_weekly') {
+                updateDashboard(student);
+            } else if (document.getElementById('daily-date').value === p.target.date) {
+                loadJournalForDate(p.target.date);
+            }
+        });
+}
+
+
 // ==================================================
 // データ保存
 // ==================================================
-async function saveDataToServer() {
+// これより大きいリクエスト本文は gzip 圧縮して送る（モバイル回線対策）
+const COMPRESS_REQUEST_THRESHOLD = 8 * 1024;
+
+/**
+ * JSON のリクエスト本文を組み立てる。
+ * ブラウザが CompressionStream に対応していれば、大きな本文は gzip で送る。
+ */
+async function buildJsonRequest(payload) {
+    const json = JSON.stringify(payload);
+    const headers = { 'Content-Type': 'application/json' };
+    if (json.length < COMPRESS_REQUEST_THRESHOLD || typeof CompressionStream === 'undefined') {
+        return { headers, body: json };
+    }
+    const stream = new Blob([json]).stream().pipeThrough(new CompressionStream('gzip'));
+    headers['Content-Encoding'] = 'gzip';
+    return { headers, body: await new Response(stream).blob() };
+}
+
+/**
+ * 変更した1件分（日誌・週次レビュー・学生設定）だけをサーバーへ送る。
+ * 全データを送り直さないため、学生や週が増えても保存コストは変わらない。
+ */
+async function savePatchToServer(patch) {
     try {
+        const request = await buildJsonRequest(patch);
         const response = await fetch('/save', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(dashboardData),
+            method: 'PATCH',
+            headers: request.headers,
+            body: request.body,
         });
         if (response.ok) {
             console.log('Data saved to server successfully');
@@ -795,6 +1134,15 @@ async function saveDataToServer() {
     }
 }
 
+function saveJournalFields(student, journal, fields) {
+    return savePatchToServer({
+        type: 'journal',
+        student_id: student.id,
+        date: journal.date,
+        fields: fields
+    });
+}
+
 
 // ==================================================
 // 以下、既存機能（変更なし）
@@ -1076,26 +1424,17 @@ async function performWeeklyAnalysis(student, weekNum) {
         // 当該週の日誌を集める
         const weekJournals = student.journals.filter(j => j.week_number === weekNum);
 
-        const response = await fetch('/review_weekly', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                week_number: weekNum,
-                journals: weekJournals,
-                provider: document.getElementById('ai-provider-select')?.value || ''
-            })
-        });
-
-        const result = await response.json();
+        // 週次レビューはサーバー側で保存される
+        const target = { student_id: student.id, week: weekNum };
+        const result = await runAIJob('review_weekly', {
+            week_number: weekNum,
+            journals: weekJournals
+        }, target);
 
         if (result.error) {
             alert("エラー: " + result.message);
         } else {
-            // 保存
-            if (!student.weekly_reviews) student.weekly_reviews = {};
-            student.weekly_reviews[weekNum] = result;
-
-            await saveDataToServer();
+            applyJobResultLocally('review_weekly', target, result);
             updateDashboard(student);
             alert(`Week ${weekNum} の週次分析が完了しました！\nStory Board で確認できます。`);
         }
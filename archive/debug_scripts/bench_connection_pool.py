@@ -0,0 +1,148 @@
+"""
+ai_bridge の接続プール（keep-alive）と従来の urlopen を比較するベンチマーク
+
+ローカルに自己署名証明書の TLS スタブ（OpenAI互換 /v1/chat/completions、HTTP/1.1 keep-alive）を立て、
+同じリクエストを
+  1. urllib.request.urlopen（毎回 TCP + TLS ハンドシェイク）
+  2. ai_bridge.ConnectionPool（ホストごとに接続を再利用）
+で送り、逐次・並列それぞれの所要時間を比べる。証明書の作成に openssl コマンドを使う。
+
+使い方:
+    python archive/debug_scripts/bench_connection_pool.py [--requests 200] [--threads 4] [--latency-ms 0]
+
+ローカルでは往復遅延がほぼ 0 のため、差はハンドシェイクの計算コスト分だけになる。
+実際のAPI（往復数十〜百ms）ではハンドシェイクの往復回数分さらに差が開く。
+"""
+import argparse
+import http.server
+import json
+import os
+import shutil
+import socketserver
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import ai_bridge  # noqa: E402
+
+RESPONSE = json.dumps({"choices": [{"message": {"content": json.dumps({"daily_comment": "ok"})}}]}).encode('utf-8')
+
+
+class TLSStubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    latency = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_certificate(directory):
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+        '-keyout', key, '-out', cert, '-subj', '/CN=localhost',
+        '-addext', 'subjectAltName=IP:127.0.0.1,DNS:localhost'
+    ], check=True, capture_output=True)
+    return cert, key
+
+
+def make_request(url):
+    body = json.dumps({"model": "stub", "messages": [{"role": "user", "content": "x" * 2000}]}).encode('utf-8')
+    return urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'}, method='POST')
+
+
+def run(label, send, url, requests, threads):
+    def one(_):
+        with send(make_request(url)) as resp:
+            resp.read()
+
+    started = time.perf_counter()
+    if threads == 1:
+        for i in range(requests):
+            one(i)
+    else:
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - started
+    print(f"  {label:<28} {elapsed:7.3f}s  {elapsed / requests * 1000:7.2f} ms/req")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='スタブ側で応答前に待つ時間')
+    args = parser.parse_args()
+
+    if shutil.which('openssl') is None:
+        print("openssl が見つかりません。証明書を作成できないため終了します。")
+        return 1
+
+    workdir = tempfile.mkdtemp()
+    try:
+        cert, key = make_certificate(workdir)
+        KeepAliveHandler.latency = args.latency_ms / 1000
+        server = TLSStubServer(('127.0.0.1', 0), KeepAliveHandler)
+        server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_context.load_cert_chain(cert, key)
+        server.socket = server_context.wrap_socket(server.socket, server_side=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'https://127.0.0.1:{server.server_address[1]}/v1/chat/completions'
+
+        client_context = ssl.create_default_context(cafile=cert)
+        pool = ai_bridge.ConnectionPool(context=client_context)
+
+        def send_urlopen(req):
+            return urllib.request.urlopen(req, timeout=60, context=client_context)
+
+        # 暖機（証明書の読み込みなど初回だけのコストを除く）
+        run('warmup', send_urlopen, url, 5, 1)
+        run('warmup', pool.urlopen, url, 5, 1)
+        print(f"\n{args.requests} リクエスト（応答待ち {args.latency_ms:g} ms）")
+
+        for threads in (1, args.threads):
+            mode = '逐次' if threads == 1 else f'{threads}並列'
+            print(f"[{mode}]")
+            base = run('urlopen（毎回接続）', send_urlopen, url, args.requests, threads)
+            pooled = run('ConnectionPool（再利用）', pool.urlopen, url, args.requests, threads)
+            print(f"  → {base / pooled:.1f} 倍")
+
+        # ai_bridge.call_openai がプール経由で動くことの確認
+        ai_bridge.http_pool = pool
+        config = ai_bridge.AIConfig(provider='openai', openai_api_key='stub',
+                                    openai_base_url=url.rsplit('/chat/completions', 1)[0])
+        print("\ncall_openai 経由:", ai_bridge.call_openai('system', 'user', config=config))
+        print(ai_bridge.metrics.render().split('# HELP kizuki_ai_http_connections_total')[1].split('# HELP')[0].strip())
+        server.shutdown()
+        pool.close_all()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
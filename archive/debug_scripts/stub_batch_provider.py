@@ -0,0 +1,225 @@
+"""
+OpenAI / Anthropic のバッチAPIを真似るローカルスタブサーバー（analyze_cohort.py --batch-api の確認用）
+
+使い方:
+    python archive/debug_scripts/stub_batch_provider.py 8766 [--process-seconds 5] [--fail-every 0]
+    # 別のターミナルで（OpenAI）
+    OPENAI_BASE_URL=http://127.0.0.1:8766/v1 OPENAI_API_KEY=stub \
+        python scripts/data/analyze_cohort.py --db /tmp/cohort.db --batch-api --provider openai --poll-interval 2
+    # Anthropic
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8766/v1 ANTHROPIC_API_KEY=stub \
+        python scripts/data/analyze_cohort.py --db /tmp/cohort.db --batch-api --provider anthropic --poll-interval 2
+
+対応するエンドポイント:
+  OpenAI    POST /v1/files（multipart, purpose=batch）→ POST /v1/batches → GET /v1/batches/{id}
+            → GET /v1/files/{output_file_id | error_file_id}/content
+  Anthropic POST /v1/messages/batches → GET /v1/messages/batches/{id} → GET results_url
+バッチは作成から --process-seconds 秒たつと完了する（OpenAI は validating → in_progress → finalizing → completed、
+Anthropic は in_progress → ended）。--fail-every N を付けると N 件ごとに1件を失敗として返す。
+応答の中身は stub_stream_provider.py と同じ解析結果JSON。
+"""
+import argparse
+import email.parser
+import email.policy
+import http.server
+import itertools
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stub_stream_provider import CANNED_DAILY_COMMENT, CANNED_RESULT  # noqa: E402
+
+PROCESS_SECONDS = 5.0
+FAIL_EVERY = 0
+
+ids = itertools.count(1)
+files = {}    # file_id -> bytes
+batches = {}  # batch_id -> {"provider", "created", "requests", "output"}
+lock = threading.Lock()
+
+
+def canned_content(prompt):
+    canned = CANNED_DAILY_COMMENT if '"daily_comment"' in prompt else CANNED_RESULT
+    return json.dumps(canned, ensure_ascii=False)
+
+
+def should_fail(index):
+    return FAIL_EVERY and (index + 1) % FAIL_EVERY == 0
+
+
+def openai_results(requests):
+    """OpenAI の output_file / error_file の中身（成功と失敗で別のファイル）"""
+    output, errors = [], []
+    for index, request in enumerate(requests):
+        if should_fail(index):
+            errors.append({"id": f"batch_req_{index}", "custom_id": request['custom_id'],
+                           "response": {"status_code": 500, "body": {"error": {"message": "stub failure"}}},
+                           "error": None})
+            continue
+        messages = request['body']['messages']
+        content = canned_content(''.join(m['content'] for m in messages))
+        prompt_tokens = sum(len(m['content']) for m in messages)
+        output.append({"id": f"batch_req_{index}", "custom_id": request['custom_id'], "error": None, "response": {
+            "status_code": 200,
+            "body": {"choices": [{"message": {"role": "assistant", "content": content}}],
+                     "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content),
+                               "prompt_tokens_details": {"cached_tokens": 0}}}
+        }})
+    return output, errors
+
+
+def anthropic_results(requests):
+    results = []
+    for index, request in enumerate(requests):
+        if should_fail(index):
+            results.append({"custom_id": request['custom_id'], "result": {
+                "type": "errored", "error": {"type": "api_error", "message": "stub failure"}}})
+            continue
+        params = request['params']
+        system = ''.join(block.get('text', '') for block in params['system']) \
+            if isinstance(params['system'], list) else params['system']
+        user = params['messages'][0]['content']
+        content = canned_content(system + user)
+        results.append({"custom_id": request['custom_id'], "result": {"type": "succeeded", "message": {
+            "content": [{"type": "text", "text": content}],
+            "usage": {"input_tokens": len(system) + len(user), "output_tokens": len(content)}
+        }}})
+    return results
+
+
+def jsonl(lines):
+    return ''.join(json.dumps(line, ensure_ascii=False) + '\n' for line in lines).encode('utf-8')
+
+
+class StubServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class BatchHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_body(self, body, status=200, content_type='application/json'):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        body = self.read_body()
+        with lock:
+            if self.path == '/v1/files':
+                self.upload_file(body)
+            elif self.path == '/v1/batches':
+                self.create_openai_batch(json.loads(body))
+            elif self.path == '/v1/messages/batches':
+                self.create_anthropic_batch(json.loads(body))
+            else:
+                self.send_body({"error": {"message": f"not found: {self.path}"}}, 404)
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        with lock:
+            if parts[:2] == ['v1', 'files'] and len(parts) == 4 and parts[3] == 'content' and parts[2] in files:
+                self.send_body(files[parts[2]], content_type='application/octet-stream')
+            elif parts[:2] == ['v1', 'batches'] and len(parts) == 3 and parts[2] in batches:
+                self.send_body(self.openai_batch(parts[2]))
+            elif parts[:3] == ['v1', 'messages', 'batches'] and len(parts) >= 4 and parts[3] in batches:
+                if len(parts) == 5 and parts[4] == 'results':
+                    self.send_body(jsonl(self.finish(parts[3])), content_type='application/binary')
+                else:
+                    self.send_body(self.anthropic_batch(parts[3]))
+            else:
+                self.send_body({"error": {"message": f"not found: {self.path}"}}, 404)
+
+    def upload_file(self, body):
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('utf-8')
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(header + body)
+        fields = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                  for part in message.iter_parts()}
+        file_id = f"file-{next(ids)}"
+        files[file_id] = fields['file']
+        self.send_body({"id": file_id, "object": "file", "purpose": fields['purpose'].decode(),
+                        "bytes": len(fields['file'])})
+
+    def create_openai_batch(self, request):
+        lines = files[request['input_file_id']].decode('utf-8').splitlines()
+        batch_id = f"batch_{next(ids)}"
+        batches[batch_id] = {"provider": "openai", "created": time.time(),
+                             "requests": [json.loads(line) for line in lines if line.strip()]}
+        self.send_body(self.openai_batch(batch_id))
+
+    def create_anthropic_batch(self, request):
+        batch_id = f"msgbatch_{next(ids)}"
+        batches[batch_id] = {"provider": "anthropic", "created": time.time(), "requests": request['requests']}
+        self.send_body(self.anthropic_batch(batch_id))
+
+    def finish(self, batch_id):
+        batch = batches[batch_id]
+        if 'output' not in batch:
+            if batch['provider'] == 'openai':
+                output, errors = openai_results(batch['requests'])
+                batch['output'] = output + errors
+                for key, lines in (('output_file_id', output), ('error_file_id', errors)):
+                    if lines:
+                        batch[key] = f"file-{next(ids)}"
+                        files[batch[key]] = jsonl(lines)
+            else:
+                batch['output'] = anthropic_results(batch['requests'])
+        return batch['output']
+
+    def openai_batch(self, batch_id):
+        batch = batches[batch_id]
+        elapsed = time.time() - batch['created']
+        total = len(batch['requests'])
+        if elapsed >= PROCESS_SECONDS:
+            self.finish(batch_id)
+            failed = sum(1 for index in range(total) if should_fail(index))
+            return {"id": batch_id, "object": "batch", "status": "completed",
+                    "output_file_id": batch.get('output_file_id'), "error_file_id": batch.get('error_file_id'),
+                    "request_counts": {"total": total, "completed": total - failed, "failed": failed}}
+        status = 'validating' if elapsed < PROCESS_SECONDS * 0.2 else \
+            'in_progress' if elapsed < PROCESS_SECONDS * 0.8 else 'finalizing'
+        done = int(total * min(1.0, elapsed / PROCESS_SECONDS))
+        return {"id": batch_id, "object": "batch", "status": status, "output_file_id": None, "error_file_id": None,
+                "request_counts": {"total": total, "completed": done, "failed": 0}}
+
+    def anthropic_batch(self, batch_id):
+        batch = batches[batch_id]
+        total = len(batch['requests'])
+        if time.time() - batch['created'] >= PROCESS_SECONDS:
+            failed = sum(1 for index in range(total) if should_fail(index))
+            host = f"http://{self.headers.get('Host')}"
+            return {"id": batch_id, "type": "message_batch", "processing_status": "ended",
+                    "request_counts": {"processing": 0, "succeeded": total - failed, "errored": failed,
+                                       "canceled": 0, "expired": 0},
+                    "results_url": f"{host}/v1/messages/batches/{batch_id}/results"}
+        return {"id": batch_id, "type": "message_batch", "processing_status": "in_progress",
+                "request_counts": {"processing": total, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0},
+                "results_url": None}
+
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('port', type=int, nargs='?', default=8766)
+    parser.add_argument('--process-seconds', type=float, default=PROCESS_SECONDS, help='バッチが完了するまでの秒数')
+    parser.add_argument('--fail-every', type=int, default=0, help='N 件ごとに1件を失敗させる（0 で失敗なし）')
+    args = parser.parse_args()
+    PROCESS_SECONDS = args.process_seconds
+    FAIL_EVERY = args.fail_every
+    with StubServer(("127.0.0.1", args.port), BatchHandler) as httpd:
+        print(f"Stub batch provider at http://127.0.0.1:{args.port}/v1")
+        httpd.serve_forever()
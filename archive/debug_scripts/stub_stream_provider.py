@@ -0,0 +1,105 @@
+"""
+OpenAI互換のローカルスタブサーバー（ストリーミング表示の確認用）
+
+使い方:
+    python archive/debug_scripts/stub_stream_provider.py 8765
+    # 別のターミナルで
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub AI_PROVIDER=openai python start_server.py
+
+/v1/chat/completions に対して、用意した解析結果JSONを小さな断片に分けて
+一定間隔でストリーミング返却する（stream が false なら一括で返す）。
+指導コメント生成のプロンプトには daily_comment 形式のJSONを返す。
+usage も返し、一度見たシステムプロンプトは OpenAI の自動プロンプトキャッシュと同じく
+128 トークン単位で cached_tokens として報告する（トークン数は文字数で代用）。
+"""
+import http.server
+import json
+import socketserver
+import sys
+import time
+
+CANNED_RESULT = {
+    "translation_for_instructor": {
+        "professional_insight": "『時間がないので急いで欲しい』という言葉に、患者さんの生活の事情を受け止めようとする姿勢が見えます。",
+        "growth_evidence": "『OSCEでは想定していなかった』と書けたこと自体が、現場での気づきの始まりです。",
+        "attention_points": "『全くわからない』という言葉の裏に、不安が隠れているかもしれません。"
+    },
+    "mentoring_support": {
+        "praise_points": "初日から2件の服薬指導に落ち着いて取り組めました。",
+        "suggested_questions": [
+            "急いでいる患者さんに、最低限これだけは伝えたいと思ったことは何でしたか？",
+            "患者さんの表情で、印象に残っている場面はありますか？"
+        ]
+    },
+    "mentoring_seeds": [
+        "『急いで欲しい』と言われた瞬間、自分が何を優先したかに気づいたら覚えておいてください。",
+        "患者さんの返答が短くなったとき、その直前の自分の言葉を一度だけ振り返ってみてください。"
+    ],
+    "step0_drafts": []
+}
+
+CANNED_DAILY_COMMENT = {
+    "daily_comment": "『急いで欲しい』と言われたとき、最低限これだけは伝えたいと思ったことは何でしたか？"
+}
+
+CHUNK_SIZE = 12
+CHUNK_INTERVAL = 0.05
+
+seen_system_prompts = set()
+
+
+def make_usage(request, content):
+    messages = request.get('messages', [])
+    system = ''.join(m.get('content', '') for m in messages if m.get('role') == 'system')
+    prompt_tokens = sum(len(m.get('content', '')) for m in messages)
+    cached = len(system) // 128 * 128 if system in seen_system_prompts else 0
+    seen_system_prompts.add(system)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": len(content),
+        "total_tokens": prompt_tokens + len(content),
+        "prompt_tokens_details": {"cached_tokens": cached},
+    }
+
+
+class StubServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        prompt = ''.join(m.get('content', '') for m in request.get('messages', []))
+        canned = CANNED_DAILY_COMMENT if '"daily_comment"' in prompt else CANNED_RESULT
+        content = json.dumps(canned, ensure_ascii=False)
+        usage = make_usage(request, content)
+
+        if not request.get('stream'):
+            body = json.dumps({"choices": [{"message": {"content": content}}], "usage": usage}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for i in range(0, len(content), CHUNK_SIZE):
+            chunk = {"choices": [{"delta": {"content": content[i:i + CHUNK_SIZE]}}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+            time.sleep(CHUNK_INTERVAL)
+        if (request.get('stream_options') or {}).get('include_usage'):
+            self.wfile.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode('utf-8'))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    with StubServer(("127.0.0.1", port), StubHandler) as httpd:
+        print(f"Stub provider at http://127.0.0.1:{port}/v1")
+        httpd.serve_forever()
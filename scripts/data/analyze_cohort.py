@@ -0,0 +1,380 @@
+"""
+kizuki_log.db の journals をまとめて AI 解析し、insights / growth_triggers に書き込む
+
+  - journals を id 順に少しずつ読み出し（全件をメモリに載せない）、
+    スレッドプールで --workers 件まで同時に analyze_journal を呼ぶ
+  - 結果は --batch 件ごとに1トランザクションで書き込む
+      journal_analyses : 解析結果のJSON（このテーブルにある日誌は「解析済み」として次回は飛ばす）
+      insights         : step0_drafts（日誌の原文 evidence と判定理由 notes）
+      growth_triggers  : translation_for_instructor.growth_evidence（日誌の日付で記録、journal_id 付き）
+  - 途中で止めても（Ctrl+C、エラー）再実行すれば未解析の日誌から続ける
+  - エラーになった日誌は記録せず、次回の実行で再挑戦する
+
+プロバイダごとの RPM / TPM は ai_bridge のレート制限（AI_RATE_LIMITS）に従って待ち合わせる。
+
+--batch-api を付けると、OpenAI / Anthropic のバッチAPIで一括送信する（プロンプト変更後の夜間の再解析向け）。
+  - 対象の日誌を1つのバッチとして送信し、analysis_batches に記録する
+  - 完了を --poll-interval 秒ごとに確認し、結果を日誌ごとに上と同じ3つのテーブルへ書き込む
+  - --no-wait なら送信だけで終了する。翌朝などに同じコマンドを実行すると、回収待ちのバッチの結果を取り込む
+    （回収待ちのバッチがある間は新しいバッチを送らない）
+
+使い方:
+    python3 scripts/data/analyze_cohort.py [--db kizuki_log.db] [--workers 4] [--batch 20]
+        [--student 名前] [--week 1] [--limit 10] [--provider groq] [--force] [--force-refresh] [--dry-run]
+    python3 scripts/data/analyze_cohort.py --batch-api [--provider openai] [--no-wait] [--poll-interval 60]
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from itertools import islice
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, ROOT_DIR)
+import ai_bridge  # noqa: E402
+
+DEFAULT_DB = os.path.join(ROOT_DIR, 'kizuki_log.db')
+ACHIEVED_MARK = '【実習内容】'
+UNACHIEVED_MARK = '【達成できなかった点・反省】'  # scripts/data/ingest_all_pdfs.py の見出し
+PAGE_SIZE = 100
+STEP0_TYPE_PREFIX = 'Step0 Level '  # この CLI が書く insights.type
+
+
+def ensure_schema(conn):
+    """解析結果（チェックポイント）のテーブルと、書き込み・再実行で使うインデックスを用意する"""
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS journal_analyses (
+            journal_id INTEGER PRIMARY KEY,
+            provider TEXT,
+            result_json TEXT NOT NULL,
+            analyzed_at TEXT NOT NULL,
+            FOREIGN KEY (journal_id) REFERENCES journals (id)
+        );
+        CREATE TABLE IF NOT EXISTS analysis_batches (
+            batch_id TEXT NOT NULL,
+            journal_id INTEGER NOT NULL,
+            provider TEXT NOT NULL,
+            submitted_at TEXT NOT NULL,
+            collected_at TEXT,
+            PRIMARY KEY (batch_id, journal_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_journals_student ON journals (student_id, date);
+        CREATE INDEX IF NOT EXISTS idx_insights_journal ON insights (journal_id);
+        CREATE INDEX IF NOT EXISTS idx_growth_triggers_student ON growth_triggers (student_id, date);
+    ''')
+    # 古い DB の growth_triggers には journal_id がない。この CLI が書いた行だけを消せるように足す
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(growth_triggers)')]
+    if 'journal_id' not in columns:
+        conn.execute('ALTER TABLE growth_triggers ADD COLUMN journal_id INTEGER REFERENCES journals (id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_growth_triggers_journal ON growth_triggers (journal_id)')
+    conn.commit()
+
+
+def split_content(content_raw):
+    """content_raw を【実習内容】と【達成できなかった点・反省】に分ける"""
+    text = content_raw or ''
+    achieved, _, unachieved = text.partition(UNACHIEVED_MARK)
+    return achieved.replace(ACHIEVED_MARK, '', 1).strip(), unachieved.strip()
+
+
+def journal_filter(student=None, week=None, force=False):
+    """対象の日誌を絞り込む WHERE 句とパラメータ"""
+    conditions = ['1 = 1']
+    params = []
+    if student:
+        conditions.append('s.name = ?')
+        params.append(student)
+    if week:
+        conditions.append('j.week_number = ?')
+        params.append(week)
+    if not force:
+        conditions.append('j.id NOT IN (SELECT journal_id FROM journal_analyses)')
+        # バッチAPIで送信済み・回収待ちの日誌も除く
+        conditions.append('j.id NOT IN (SELECT journal_id FROM analysis_batches WHERE collected_at IS NULL)')
+    return ' AND '.join(conditions), params
+
+
+def iter_journals(conn, student=None, week=None, force=False):
+    """対象の日誌を id 順に PAGE_SIZE 件ずつ読み出して1件ずつ返す"""
+    where, params = journal_filter(student, week, force)
+    query = f'''
+        SELECT j.id, j.student_id, s.name, j.date, j.week_number, j.content_raw
+        FROM journals j JOIN students s ON j.student_id = s.id
+        WHERE {where} AND j.id > ?
+        ORDER BY j.id
+        LIMIT {PAGE_SIZE}
+    '''
+    last_id = 0
+    while True:
+        # 1ページずつ読み切るので、書き込みのトランザクションと読み出しが重ならない
+        rows = conn.execute(query, params + [last_id]).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        last_id = rows[-1][0]
+
+
+def count_journals(conn, student=None, week=None, force=False):
+    where, params = journal_filter(student, week, force)
+    return conn.execute(f'''
+        SELECT COUNT(*) FROM journals j JOIN students s ON j.student_id = s.id WHERE {where}
+    ''', params).fetchone()[0]
+
+
+def analyze(row, provider=None, force_refresh=False):
+    journal_id, student_id, name, date, week, content_raw = row
+    log_achieved, log_unachieved = split_content(content_raw)
+    trace = {}
+    result = ai_bridge.analyze_journal(week or 1, log_achieved, log_unachieved,
+                                       provider=provider, force_refresh=force_refresh, trace=trace)
+    return row, result, trace
+
+
+def user_prompt_for(row):
+    """analyze_journal と同じユーザープロンプト（バッチAPI用）"""
+    log_achieved, log_unachieved = split_content(row[5])
+    return ai_bridge.build_user_prompt(row[4] or 1, log_achieved, log_unachieved)
+
+
+def write_batch(conn, finished):
+    """解析済みの日誌をまとめて1トランザクションで書き込む（同じ日誌の以前の結果は置き換える）
+
+    置き換えるのはこの CLI が書いた行だけ。insert_analysis_batch.py などで手入力した
+    insights（type が STEP0_TYPE_PREFIX で始まらない）と growth_triggers（journal_id が空）は残す。
+    """
+    analyzed_at = datetime.now().isoformat(timespec='seconds')
+    with conn:
+        for (journal_id, student_id, name, date, week, _), result, trace in finished:
+            conn.execute('DELETE FROM insights WHERE journal_id = ? AND type LIKE ?',
+                         (journal_id, STEP0_TYPE_PREFIX + '%'))
+            conn.execute('DELETE FROM growth_triggers WHERE journal_id = ?', (journal_id,))
+            conn.executemany(
+                'INSERT INTO insights (journal_id, type, snippet, reason) VALUES (?, ?, ?, ?)',
+                [(journal_id, f"{STEP0_TYPE_PREFIX}{draft.get('level', '')}", draft['evidence'], draft.get('notes', ''))
+                 for draft in result.get('step0_drafts') or [] if isinstance(draft, dict) and draft.get('evidence')]
+            )
+            growth = (result.get('translation_for_instructor') or {}).get('growth_evidence')
+            if growth:
+                conn.execute('INSERT INTO growth_triggers (student_id, date, description, journal_id) VALUES (?, ?, ?, ?)',
+                             (student_id, date, growth, journal_id))
+            conn.execute(
+                'INSERT OR REPLACE INTO journal_analyses (journal_id, provider, result_json, analyzed_at) '
+                'VALUES (?, ?, ?, ?)',
+                (journal_id, trace.get('provider'), json.dumps(result, ensure_ascii=False), analyzed_at)
+            )
+
+
+def run(args):
+    conn = sqlite3.connect(args.db)
+    ensure_schema(conn)
+    total = count_journals(conn, args.student, args.week, args.force)
+    if args.limit:
+        total = min(total, args.limit)
+    print(f"解析対象: {total} 件（同時実行 {args.workers}、{args.batch} 件ごとに保存）")
+    if args.dry_run or not total:
+        conn.close()
+        return 0
+
+    started = time.perf_counter()
+    done = failed = 0
+    finished = []
+    in_flight = set()
+    rows = iter_journals(conn, args.student, args.week, args.force)
+    executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='cohort')
+    try:
+        submitted = 0
+        while True:
+            # 読み出しは同時実行数の2倍までに抑える（全件を先読みしない）
+            while submitted < total and len(in_flight) < args.workers * 2:
+                row = next(rows, None)
+                if row is None:
+                    total = submitted
+                    break
+                in_flight.add(executor.submit(analyze, row, args.provider, args.force_refresh))
+                submitted += 1
+            if not in_flight:
+                break
+            completed, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in completed:
+                row, result, trace = future.result()
+                if result.get('error'):
+                    failed += 1
+                    print(f"  ⚠ {row[2]} {row[3]}: {result.get('message')}")
+                    continue
+                finished.append((row, result, trace))
+                done += 1
+            if len(finished) >= args.batch:
+                write_batch(conn, finished)
+                finished = []
+            elapsed = time.perf_counter() - started
+            processed = done + failed
+            if processed:
+                eta = elapsed / processed * (total - processed)
+                print(f"\r  {processed}/{total} 件（失敗 {failed}）経過 {elapsed:.0f}秒 残り約 {eta:.0f}秒",
+                      end='', flush=True)
+    except KeyboardInterrupt:
+        print("\n中断しました。解析が終わった分を保存します...")
+        executor.shutdown(wait=False, cancel_futures=True)
+        return_code = 130
+    else:
+        return_code = 0 if not failed else 1
+    finally:
+        if finished:
+            write_batch(conn, finished)
+        executor.shutdown(wait=False, cancel_futures=True)
+        conn.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"\n完了: {done} 件を保存、失敗 {failed} 件（{elapsed:.0f}秒）")
+    if failed:
+        print("  失敗した日誌は、もう一度実行すると再解析されます。")
+    return return_code
+
+
+def submit_batch(conn, args, config):
+    """対象の日誌を1つのバッチとして送信し、analysis_batches に記録する"""
+    total = count_journals(conn, args.student, args.week, args.force)
+    if args.limit:
+        total = min(total, args.limit)
+    print(f"バッチ送信の対象: {total} 件（{config.provider} / {config.model_for(config.provider)}）")
+    if args.dry_run or not total:
+        return None
+    rows = list(islice(iter_journals(conn, args.student, args.week, args.force), total))
+    batch_id = ai_bridge.submit_batch(
+        [(f'journal-{row[0]}', ai_bridge.SYSTEM_PROMPT, user_prompt_for(row)) for row in rows], config)
+    submitted_at = datetime.now().isoformat(timespec='seconds')
+    with conn:
+        conn.executemany(
+            'INSERT INTO analysis_batches (batch_id, journal_id, provider, submitted_at) VALUES (?, ?, ?, ?)',
+            [(batch_id, row[0], config.provider, submitted_at) for row in rows]
+        )
+    print(f"送信しました: {batch_id}")
+    return batch_id, config.provider
+
+
+def collect_batch(conn, args, config, batch_id):
+    """終わったバッチの結果を書き込む。戻り値は (保存した件数, 失敗した件数)"""
+    def show(status):
+        counts = ', '.join(f'{key} {value}' for key, value in status['counts'].items())
+        print(f"\r  {batch_id}: {status['status']}（{counts}）", end='', flush=True)
+
+    status = ai_bridge.wait_for_batch(batch_id, config, args.poll_interval, on_poll=show)
+    print()
+    rows = {row[0]: row for row in conn.execute('''
+        SELECT j.id, j.student_id, s.name, j.date, j.week_number, j.content_raw
+        FROM journals j JOIN students s ON j.student_id = s.id
+        WHERE j.id IN (SELECT journal_id FROM analysis_batches WHERE batch_id = ?)
+    ''', (batch_id,))}
+
+    done = failed = 0
+    finished = []
+    for custom_id, result, error in ai_bridge.fetch_batch_results(status, config, ai_bridge.validate_journal_result):
+        row = rows.get(int(custom_id.rpartition('-')[2])) if custom_id else None
+        if row is None:
+            continue
+        if error:
+            failed += 1
+            print(f"  ⚠ {row[2]} {row[3]}: {error}")
+            continue
+        # 画面から同じ日誌を解析したときに使えるよう、AI応答キャッシュにも入れておく
+        ai_bridge.store_cached_response(config, config.provider, ai_bridge.SYSTEM_PROMPT, user_prompt_for(row), result)
+        finished.append((row, result, {'provider': config.provider}))
+        done += 1
+        if len(finished) >= args.batch:
+            write_batch(conn, finished)
+            finished = []
+    if finished:
+        write_batch(conn, finished)
+    # 結果の無かった日誌は journal_analyses に入らないため、次回の実行で再送される
+    failed += len(rows) - done - failed
+    with conn:
+        conn.execute('UPDATE analysis_batches SET collected_at = ? WHERE batch_id = ?',
+                     (datetime.now().isoformat(timespec='seconds'), batch_id))
+    return done, failed
+
+
+def run_batch_api(args):
+    try:
+        config = ai_bridge.resolve_config(provider=args.provider)
+    except ValueError as e:
+        print(e)
+        return 1
+    if config.provider not in ai_bridge.BATCH_PROVIDERS:
+        print(f"--batch-api は {', '.join(ai_bridge.BATCH_PROVIDERS)} のみ対応しています（--provider で指定）")
+        return 1
+
+    conn = sqlite3.connect(args.db)
+    ensure_schema(conn)
+    try:
+        pending = conn.execute(
+            'SELECT batch_id, provider FROM analysis_batches WHERE collected_at IS NULL '
+            'GROUP BY batch_id ORDER BY MIN(submitted_at)'
+        ).fetchall()
+        if pending:
+            print(f"回収待ちのバッチ: {', '.join(batch_id for batch_id, _ in pending)}")
+            if args.dry_run:
+                return 0
+        else:
+            submitted = submit_batch(conn, args, config)
+            if not submitted:
+                return 0
+            pending = [submitted]
+            if args.no_wait:
+                print("結果は、あとで同じコマンドを実行すると取り込みます。")
+                return 0
+
+        started = time.perf_counter()
+        done = failed = 0
+        for batch_id, provider in pending:
+            batch_config = config.with_overrides(provider)
+            if args.no_wait and not ai_bridge.batch_status(batch_id, batch_config)['ended']:
+                print(f"  {batch_id}: まだ完了していません")
+                continue
+            saved, errors = collect_batch(conn, args, batch_config, batch_id)
+            done += saved
+            failed += errors
+    except KeyboardInterrupt:
+        print("\n中断しました。送信済みのバッチは、次回の実行で回収します。")
+        return 130
+    finally:
+        conn.close()
+
+    print(f"完了: {done} 件を保存、失敗 {failed} 件（{time.perf_counter() - started:.0f}秒）")
+    if failed:
+        print("  失敗した日誌は、もう一度実行すると再送されます。")
+    return 0 if not failed else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=DEFAULT_DB, help='SQLite データベース（既定: リポジトリ直下の kizuki_log.db）')
+    parser.add_argument('--workers', type=int, default=4, help='同時に解析する件数')
+    parser.add_argument('--batch', type=int, default=20, help='何件ごとに書き込むか')
+    parser.add_argument('--student', help='この学生の日誌だけ解析する（students.name）')
+    parser.add_argument('--week', type=int, help='この実習週の日誌だけ解析する')
+    parser.add_argument('--limit', type=int, help='最大件数')
+    parser.add_argument('--provider', help='使用するプロバイダ（既定: AI_PROVIDER）')
+    parser.add_argument('--force', action='store_true', help='解析済みの日誌も解析し直す')
+    parser.add_argument('--force-refresh', action='store_true', help='AI応答キャッシュを使わない')
+    parser.add_argument('--dry-run', action='store_true', help='対象件数を表示するだけ')
+    parser.add_argument('--batch-api', action='store_true', help='OpenAI / Anthropic のバッチAPIで一括送信する')
+    parser.add_argument('--no-wait', action='store_true', help='（--batch-api）送信だけして終了する')
+    parser.add_argument('--poll-interval', type=float, default=60.0, help='（--batch-api）完了を確認する間隔（秒）')
+    args = parser.parse_args(argv)
+    args.workers = max(1, args.workers)
+    args.batch = max(1, args.batch)
+
+    if not os.path.exists(args.db):
+        print(f"データベースが見つかりません: {args.db}")
+        return 1
+    ai_bridge.get_config()  # .env を読み込む
+    return run_batch_api(args) if args.batch_api else run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,6 +6,8 @@ def init_db(db_path):
     cursor = conn.cursor()
     
     # Drop tables to ensure clean state
+    cursor.execute('DROP TABLE IF EXISTS analysis_batches')
+    cursor.execute('DROP TABLE IF EXISTS journal_analyses')
     cursor.execute('DROP TABLE IF EXISTS growth_triggers')
     cursor.execute('DROP TABLE IF EXISTS insights')
     cursor.execute('DROP TABLE IF EXISTS feedbacks')
@@ -63,10 +65,40 @@ def init_db(db_path):
         student_id INTEGER,
         date TEXT,
         description TEXT,
-        FOREIGN KEY (student_id) REFERENCES students (id)
+        journal_id INTEGER,  -- analyze_cohort.py が書いた行だけ。手入力の行は空
+        FOREIGN KEY (student_id) REFERENCES students (id),
+        FOREIGN KEY (journal_id) REFERENCES journals (id)
+    )
+    ''')
+
+    # 6. AI Analyses (scripts/data/analyze_cohort.py の解析結果。ここにある日誌は解析済み)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS journal_analyses (
+        journal_id INTEGER PRIMARY KEY,
+        provider TEXT,
+        result_json TEXT NOT NULL,
+        analyzed_at TEXT NOT NULL,
+        FOREIGN KEY (journal_id) REFERENCES journals (id)
+    )
+    ''')
+
+    # 7. バッチAPIで送信した日誌（collected_at が空のものは回収待ち）
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS analysis_batches (
+        batch_id TEXT NOT NULL,
+        journal_id INTEGER NOT NULL,
+        provider TEXT NOT NULL,
+        submitted_at TEXT NOT NULL,
+        collected_at TEXT,
+        PRIMARY KEY (batch_id, journal_id)
     )
     ''')
 
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_journals_student ON journals (student_id, date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_insights_journal ON insights (journal_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_growth_triggers_student ON growth_triggers (student_id, date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_growth_triggers_journal ON growth_triggers (journal_id)')
+
     conn.commit()
     conn.close()
     print(f"Database initialized at {db_path}")
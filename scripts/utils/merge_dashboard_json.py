@@ -0,0 +1,160 @@
+"""
+dashboard_data.json / sync_data/**/*.json 用の git マージドライバ（3-way マージ）
+
+行単位ではなくレコード単位でマージする。
+  - students[] は id、students[].journals[] は date をキーに突き合わせる
+  - オブジェクトはフィールドごとにマージし、片側だけの変更はそのまま取り込む
+  - 両側で同じフィールドを別の値に変えた場合だけを「競合」とし、
+    この端末（ローカル）の値を残したうえで、フィールド単位の競合を
+    archive/reports/merge_conflicts.jsonl に記録する（start_server.py が画面に表示する）
+  - 通常のマージではローカルは %A だが、git rebase 中は %A が取り込む側（リモート）、
+    %B が付け直しているローカルのコミットになるため、rebase 中は %B を残す
+
+設定（start_server.py の同期処理が自動で行う）:
+    git config merge.kizuki-json.name "Kizuki-Log JSON merge"
+    git config merge.kizuki-json.driver "python3 scripts/utils/merge_dashboard_json.py %O %A %B %P"
+    # .gitattributes
+    dashboard_data.json merge=kizuki-json
+    sync_data/**/*.json merge=kizuki-json
+
+使い方（手動）:
+    python3 scripts/utils/merge_dashboard_json.py BASE CURRENT OTHER [PATH] [--strict]
+    結果は CURRENT に書き込む。--strict を付けると競合があったとき終了コード 1 を返す
+    （git は競合として扱い、手動での解決を求める）。
+"""
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+CONFLICT_REPORT = os.path.join('archive', 'reports', 'merge_conflicts.jsonl')
+
+# キーで突き合わせる配列（フィールド名 → キー）
+KEYED_LISTS = {'students': 'id', 'journals': 'date'}
+
+MISSING = object()
+
+
+def merge3(base, ours, theirs, path, conflicts, field=None, keep_theirs=False):
+    """base を共通祖先として ours と theirs をマージする（keep_theirs なら競合時に theirs を残す）"""
+    if ours == theirs:
+        return ours
+    if base == ours:
+        return theirs
+    if base == theirs:
+        return ours
+
+    if isinstance(ours, dict) and isinstance(theirs, dict):
+        return merge_dicts(base if isinstance(base, dict) else {}, ours, theirs, path, conflicts, keep_theirs)
+
+    key_field = KEYED_LISTS.get(field)
+    if key_field and is_keyed_list(ours, key_field) and is_keyed_list(theirs, key_field):
+        base_list = base if is_keyed_list(base, key_field) else []
+        return merge_keyed_list(base_list, ours, theirs, key_field, path, conflicts, keep_theirs)
+
+    local, remote = (theirs, ours) if keep_theirs else (ours, theirs)
+    conflicts.append({
+        "path": '/'.join(path),
+        "base": None if base is MISSING else base,
+        "local": None if local is MISSING else local,
+        "remote": None if remote is MISSING else remote,
+        "kept": "remote" if local is MISSING else "local",
+    })
+    # 片側で削除・もう片側で変更された場合は、データを失わないよう変更された側を残す
+    return remote if local is MISSING else local
+
+
+def merge_dicts(base, ours, theirs, path, conflicts, keep_theirs=False):
+    merged = {}
+    keys = list(ours) + [k for k in theirs if k not in ours]
+    for key in keys:
+        value = merge3(base.get(key, MISSING), ours.get(key, MISSING), theirs.get(key, MISSING),
+                       path + [str(key)], conflicts, field=key, keep_theirs=keep_theirs)
+        if value is not MISSING:
+            merged[key] = value
+    return merged
+
+
+def is_keyed_list(value, key_field):
+    return isinstance(value, list) and all(isinstance(item, dict) and key_field in item for item in value)
+
+
+def merge_keyed_list(base, ours, theirs, key_field, path, conflicts, keep_theirs=False):
+    """キーで突き合わせて配列をマージする（並びは現在の側を優先し、追加分は末尾へ）"""
+    def index(items):
+        return {str(item[key_field]): item for item in items}
+
+    base_map, ours_map, theirs_map = index(base), index(ours), index(theirs)
+    keys = list(ours_map) + [k for k in theirs_map if k not in ours_map]
+    merged = []
+    for key in keys:
+        label = f"{path[-1]}[{key_field}={key}]" if path else f"[{key_field}={key}]"
+        value = merge3(base_map.get(key, MISSING), ours_map.get(key, MISSING), theirs_map.get(key, MISSING),
+                       path[:-1] + [label], conflicts, keep_theirs=keep_theirs)
+        if value is not MISSING:
+            merged.append(value)
+    return merged
+
+
+def load_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    return json.loads(text) if text.strip() else MISSING
+
+
+def in_rebase():
+    """git rebase の途中で呼ばれているか（%A / %B のどちらがローカルかが入れ替わる）"""
+    for name in ('rebase-merge', 'rebase-apply'):
+        result = subprocess.run(['git', 'rev-parse', '--git-path', name], capture_output=True, text=True)
+        if result.returncode == 0 and os.path.isdir(result.stdout.strip()):
+            return True
+    return False
+
+
+def write_conflict_report(conflicts, pathname):
+    os.makedirs(os.path.dirname(CONFLICT_REPORT), exist_ok=True)
+    timestamp = datetime.now().isoformat(timespec='seconds')
+    with open(CONFLICT_REPORT, 'a', encoding='utf-8') as f:
+        for conflict in conflicts:
+            f.write(json.dumps(dict(conflict, file=pathname, merged_at=timestamp), ensure_ascii=False) + '\n')
+
+
+def main(argv):
+    strict = '--strict' in argv
+    args = [a for a in argv if a != '--strict']
+    if len(args) < 3:
+        print(__doc__)
+        return 2
+    base_path, current_path, other_path = args[:3]
+    pathname = args[3] if len(args) > 3 else current_path
+
+    try:
+        base = load_json(base_path)
+        ours = load_json(current_path)
+        theirs = load_json(other_path)
+    except json.JSONDecodeError as e:
+        print(f"⚠ {pathname}: JSON として読み込めないため自動マージできません: {e}", file=sys.stderr)
+        return 1
+
+    conflicts = []
+    merged = merge3(base, ours, theirs, [], conflicts, keep_theirs=in_rebase())
+
+    # 元のファイルと同じ書式で書き出す（sync_data/ のレコードはキー順・末尾改行あり）
+    is_record = pathname.replace(os.sep, '/').startswith('sync_data/')
+    text = json.dumps(merged, ensure_ascii=False, indent=2, sort_keys=is_record)
+    with open(current_path, 'w', encoding='utf-8') as f:
+        f.write(text + '\n' if is_record else text)
+
+    if conflicts:
+        write_conflict_report(conflicts, pathname)
+        for conflict in conflicts:
+            kept = 'この端末の値' if conflict['kept'] == 'local' else '他の端末の値'
+            print(f"⚠ 競合: {pathname} {conflict['path']}（{kept}を残しました）", file=sys.stderr)
+        print(f"  競合したフィールドの両方の値は {CONFLICT_REPORT} に記録しました", file=sys.stderr)
+        return 1 if strict else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
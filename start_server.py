@@ -2,78 +2,956 @@ import http.server
 import socketserver
 import webbrowser
 import os
+import io
+import re
+import copy
 import json
+import gzip
+import hashlib
+import logging
+import logging.handlers
+import queue
+import random
+import urllib.parse
+import zlib
 import subprocess
+import sys
 import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+try:
+    import brotli  # 任意: インストールされていれば br 圧縮も使う
+except ImportError:
+    brotli = None
+
 # Change directory to the script's directory
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 PORT = 8080
+DEFAULT_WORKERS = 16
+DEFAULT_AI_WORKERS = 4
+DATA_FILE = 'dashboard_data.json'
+# KIZUKI_SYNC_MODE=data のとき、レコード単位のファイルを置いて git で交換するフォルダ
+SYNC_DATA_DIR = 'sync_data'
+# 2台の端末で編集したデータをレコード単位でマージする git マージドライバ
+MERGE_DRIVER_SCRIPT = 'scripts/utils/merge_dashboard_json.py'
+# マージドライバがフィールド単位の競合を書き出すファイル（git管理外）
+MERGE_CONFLICT_REPORT = os.path.join('archive', 'reports', 'merge_conflicts.jsonl')
+
+# 構造化リクエストログ（1リクエスト1行、key=value 形式）
+logger = logging.getLogger('kizuki')
+# 受信ペイロードの保存先（KIZUKI_DEBUG_PAYLOAD_SAMPLE を指定したときだけ有効）
+payload_logger = logging.getLogger('kizuki.payload')
+payload_logger.propagate = False
+payload_sample_rate = 0.0
+DEBUG_PAYLOAD_FILE = os.path.join('archive', 'reports', 'payload_debug.log')
+
+# これより小さい応答は圧縮しない（ヘッダー分で逆に大きくなるため）
+MIN_COMPRESS_SIZE = 1024
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+# 受け付けるリクエスト本文の上限（圧縮された本文は展開後の大きさで判定する）
+MAX_REQUEST_BODY = 64 * 1024 * 1024
+# brotli は展開後の大きさを指定できないため、入力を少しずつ渡して上限を超えた時点で打ち切る
+BROTLI_INPUT_CHUNK = 1024
+
 
+def setup_logging():
+    """ログレベルとペイロードのサンプリング保存を環境変数から設定する
+
+    KIZUKI_LOG_LEVEL: DEBUG / INFO（既定）/ WARNING
+    KIZUKI_DEBUG_PAYLOAD_SAMPLE: 0〜1。指定した割合のリクエスト本文を
+        archive/reports/payload_debug.log（5MB×3世代でローテーション）に書き出す
+    """
+    global payload_sample_rate
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(os.environ.get('KIZUKI_LOG_LEVEL', 'INFO').upper())
 
-def auto_sync_pull():
-    """サーバー起動時にGitHubから最新データを取得する"""
     try:
-        print("=========================================")
-        print(" GitHub から最新データを取得しています...")
-        print("=========================================")
-        result = subprocess.run(
-            ['git', 'pull', 'origin', 'main', '--rebase'],
-            capture_output=True, text=True, timeout=30
-        )
-        if result.returncode == 0:
-            print(f"  ✓ 取得完了: {result.stdout.strip()}")
+        payload_sample_rate = min(max(float(os.environ.get('KIZUKI_DEBUG_PAYLOAD_SAMPLE', '0')), 0.0), 1.0)
+    except ValueError:
+        payload_sample_rate = 0.0
+    if payload_sample_rate > 0:
+        path = os.environ.get('KIZUKI_DEBUG_PAYLOAD_FILE', DEBUG_PAYLOAD_FILE)
+        file_handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8')
+        file_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        payload_logger.addHandler(file_handler)
+        payload_logger.setLevel(logging.DEBUG)
+        print(f"デバッグ: リクエスト本文の {payload_sample_rate:.0%} を {path} に保存します")
+
+
+def log_request(route, status, **fields):
+    """1リクエスト分の処理時間・サイズ・プロバイダを1行で記録する"""
+    parts = [f'route={route}', f'status={status}']
+    for key, value in fields.items():
+        if value is None:
+            continue
+        if isinstance(value, float):
+            value = f'{value:.1f}'
+        elif isinstance(value, str) and (not value or ' ' in value):
+            value = json.dumps(value, ensure_ascii=False)
+        parts.append(f'{key}={value}')
+    level = logging.WARNING if status >= 500 or 'error' in fields else logging.INFO
+    logger.log(level, ' '.join(parts))
+
+
+def sample_payload(route, body):
+    """サンプリング対象のリクエスト本文をローテーションファイルに書き出す"""
+    if payload_sample_rate and random.random() < payload_sample_rate:
+        payload_logger.debug('route=%s bytes=%d %s', route, len(body), body.decode('utf-8', 'replace'))
+
+
+def elapsed_ms(started):
+    return (time.perf_counter() - started) * 1000
+
+
+def content_etag(body):
+    """内容のハッシュから強い ETag を作る"""
+    return '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+
+
+_file_etags = {}
+_file_etags_lock = threading.Lock()
+
+
+def file_etag(path):
+    """ファイル内容の ETag を返す（更新時刻とサイズが同じ間はキャッシュを使う）"""
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+    with _file_etags_lock:
+        cached = _file_etags.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    etag = '"' + h.hexdigest()[:20] + '"'
+    with _file_etags_lock:
+        _file_etags[path] = (key, etag)
+    return etag
+
+
+class RequestTooLarge(Exception):
+    """リクエスト本文（展開後）が MAX_REQUEST_BODY を超えた"""
+
+
+def decompress_body(body, encoding, limit=MAX_REQUEST_BODY):
+    """gzip / br の本文を、展開後が limit バイトを超えない範囲で展開する（超えたら RequestTooLarge）"""
+    out = bytearray()
+    if encoding == 'gzip':
+        data = body
+        while data:
+            # 連結された複数の gzip メンバーにも対応する
+            decompressor = zlib.decompressobj(wbits=31)
+            out += decompressor.decompress(data, limit + 1 - len(out))
+            if len(out) > limit or decompressor.unconsumed_tail:
+                raise RequestTooLarge()
+            if not decompressor.eof:
+                raise ValueError("gzip の本文が途中で終わっています")
+            data = decompressor.unused_data
+        return bytes(out)
+    decompressor = brotli.Decompressor()
+    for start in range(0, len(body), BROTLI_INPUT_CHUNK):
+        out += decompressor.process(body[start:start + BROTLI_INPUT_CHUNK])
+        if len(out) > limit:
+            raise RequestTooLarge()
+    return bytes(out)
+
+
+def compress_body(body, encoding, level=6):
+    """指定された Content-Encoding で本文を圧縮する"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=min(level, 11))
+    return gzip.compress(body, compresslevel=level)
+
+
+_compressed_variants = {}
+_compressed_variants_lock = threading.Lock()
+COMPRESSED_VARIANTS_LIMIT = 64
+
+
+def compressed_variant(etag, encoding, body):
+    """静的ファイル・データファイルの圧縮結果を ETag ごとに一度だけ作って使い回す"""
+    key = (etag, encoding)
+    with _compressed_variants_lock:
+        cached = _compressed_variants.get(key)
+    if cached is not None:
+        return cached
+
+    compressed = compress_body(body, encoding, level=9)
+    with _compressed_variants_lock:
+        if len(_compressed_variants) >= COMPRESSED_VARIANTS_LIMIT:
+            # 古いものから捨てる（dict は挿入順）
+            _compressed_variants.pop(next(iter(_compressed_variants)))
+        _compressed_variants[key] = compressed
+    return compressed
+
+
+class DashboardStore:
+    """dashboard_data.json をメモリ上に保持し、差分更新を適用するストア
+
+    差分（journal / weekly_review / student）はメモリ上の該当レコードに適用したうえで
+    追記専用の変更ログ（dashboard_data.log）に1行ずつ fsync して記録する。
+    スナップショット（dashboard_data.json）への反映はバックグラウンドのコンパクションで
+    まとめて行い、起動時はスナップショット＋ログの末尾を再生して状態を復元する。
+    """
+
+    def __init__(self, path=DATA_FILE, log_path=None, compact_delay=30.0, compact_threshold=200):
+        self.path = path
+        self.log_path = log_path or os.path.splitext(path)[0] + '.log'
+        self.compact_delay = compact_delay
+        self.compact_threshold = compact_threshold
+        self._lock = threading.RLock()
+        self._data = None
+        self._students_by_id = {}
+        self._version = 0
+        self._snapshot = None
+        self._log_file = None
+        self._log_records = 0
+        self._compact_timer = None
+        # 保存のたびに呼ぶコールバック（git のバックアップ予約に使う）
+        self.on_change = None
+        # 前回の書き出し以降に変更されたレコードのキー（None は全件）
+        self._changed_records = set()
+
+    @property
+    def lock(self):
+        """外部からデータファイルの書き換えを止めるためのロック"""
+        return self._lock
+
+    def _ensure_loaded(self):
+        if self._data is not None:
+            return
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._data = json.load(f)
         else:
-            print(f"  ⚠ 取得に失敗しました（サーバーは通常通り起動します）")
-            print(f"    {result.stderr.strip()}")
-    except FileNotFoundError:
-        print("  ⚠ git が見つかりません。手動で同期してください。")
-    except subprocess.TimeoutExpired:
-        print("  ⚠ タイムアウトしました。ネットワーク接続を確認してください。")
-    except Exception as e:
-        print(f"  ⚠ 同期エラー: {e}")
-    print()
-
-
-def auto_sync_push():
-    """サーバー終了時に変更をGitHubへバックアップする"""
-    try:
-        print()
-        print("=========================================")
-        print(" 変更を GitHub へバックアップしています...")
-        print("=========================================")
-
-        # ステージング
-        subprocess.run(['git', 'add', '.'], capture_output=True, text=True, timeout=10)
-
-        # コミット（変更がない場合は何もしない）
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        commit_result = subprocess.run(
-            ['git', 'commit', '-m', f'Auto-sync on server shutdown: {timestamp}'],
-            capture_output=True, text=True, timeout=10
-        )
-        if commit_result.returncode != 0 and 'nothing to commit' in commit_result.stdout:
-            print("  ✓ 変更なし（バックアップ不要）")
+            self._data = {"students": []}
+        self._reindex()
+        if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > 0:
+            replayed = self._replay_log()
+            print(f"変更ログから {replayed} 件の差分を復元しました")
+            # 不完全な末尾行の後ろに追記しないよう、ここで畳み込んでおく
+            self._log_records = max(replayed, 1)
+            self.compact()
+
+    def _replay_log(self):
+        """前回のコンパクション以降に記録された差分を再生する"""
+        replayed = 0
+        with open(self.log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    # 書き込み途中で落ちた末尾の1行は捨てる
+                    print("  ⚠ 変更ログ末尾の不完全な記録を無視しました")
+                    break
+                try:
+                    entry = json.loads(line)
+                    # 複数の差分をまとめて保存した記録は1行にリストで入っている
+                    if isinstance(entry, list):
+                        self._apply_all(entry)
+                    else:
+                        self._apply(entry)
+                    replayed += 1
+                except (json.JSONDecodeError, ValueError) as e:
+                    print(f"  ⚠ 変更ログの記録を適用できませんでした: {e}")
+        return replayed
+
+    def reload(self):
+        """ディスク上のスナップショットを読み直す（git で更新されたとき）"""
+        with self._lock:
+            self._data = None
+            self._version += 1
+            self._ensure_loaded()
+
+    def _notify_change(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def to_bytes(self):
+        """現在のデータを dashboard_data.json と同じ形式のバイト列で返す"""
+        return self.snapshot()[0]
+
+    def snapshot(self):
+        """現在のデータのバイト列と ETag を返す（変更がなければ前回の結果を再利用）"""
+        with self._lock:
+            self._ensure_loaded()
+            if self._snapshot is None or self._snapshot[0] != self._version:
+                body = json.dumps(self._data, ensure_ascii=False, indent=2).encode('utf-8')
+                self._snapshot = (self._version, body, content_etag(body))
+            return self._snapshot[1], self._snapshot[2]
+
+    def replace(self, data):
+        """データ全体を置き換えてスナップショットを書き直す（従来の /save）"""
+        if not isinstance(data, dict) or not isinstance(data.get('students'), list):
+            raise ValueError("students 配列を含むデータではありません")
+        with self._lock:
+            self._data = data
+            self._reindex()
+            self._version += 1
+            self._changed_records = None
+            self._log_records = max(self._log_records, 1)
+            self.compact()
+        self._notify_change()
+
+    def apply_patch(self, patch):
+        """1件の差分を適用して変更ログに記録し、更新後のレコードを返す"""
+        with self._lock:
+            self._ensure_loaded()
+            record = self._apply(patch)
+            self._version += 1
+            self._append_log(patch)
+            if self._log_records >= self.compact_threshold:
+                threading.Thread(target=self.compact, daemon=True).start()
+            else:
+                self._schedule_compaction()
+        self._notify_change()
+        return record
+
+    def apply_patches(self, patches):
+        """
+        複数の差分をまとめて適用する。1件でも不正なら何も変えずに ValueError を送出し、
+        すべて適用できたときだけ変更ログに1行（リスト）で記録する。
+        """
+        with self._lock:
+            self._ensure_loaded()
+            records = self._apply_all(patches)
+            self._version += 1
+            self._append_log(patches)
+            if self._log_records >= self.compact_threshold:
+                threading.Thread(target=self.compact, daemon=True).start()
+            else:
+                self._schedule_compaction()
+        self._notify_change()
+        return records
+
+    def _apply_all(self, patches):
+        """差分を順に適用し、途中で失敗したら適用前の状態に戻す（ロック内で呼ぶ）"""
+        students = list(self._data['students'])
+        touched = {}
+        for patch in patches:
+            student = self._find_student(patch.get('student_id')) if isinstance(patch, dict) else None
+            if student is not None and id(student) not in touched:
+                touched[id(student)] = (student, copy.deepcopy(student))
+        changed = None if self._changed_records is None else set(self._changed_records)
+        try:
+            return [self._apply(patch) for patch in patches]
+        except ValueError:
+            self._data['students'][:] = students
+            for student, saved in touched.values():
+                student.clear()
+                student.update(saved)
+            self._changed_records = changed
+            self._reindex()
+            raise
+
+    def _apply(self, patch):
+        if not isinstance(patch, dict):
+            raise ValueError("差分はオブジェクトで指定してください")
+        patch_type = patch.get('type')
+        if patch_type == 'journal':
+            return self._patch_journal(patch)
+        if patch_type == 'weekly_review':
+            return self._patch_weekly_review(patch)
+        if patch_type == 'student':
+            return self._patch_student(patch)
+        raise ValueError(f"未対応の差分タイプです: {patch_type}")
+
+    def _append_log(self, patch):
+        if self._log_file is None:
+            self._log_file = open(self.log_path, 'a', encoding='utf-8')
+        self._log_file.write(json.dumps(patch, ensure_ascii=False) + '\n')
+        self._log_file.flush()
+        os.fsync(self._log_file.fileno())
+        self._log_records += 1
+
+    def _mark_changed(self, key):
+        if self._changed_records is not None:
+            self._changed_records.add(key)
+
+    def _reindex(self):
+        self._students_by_id = {str(s.get('id')): s for s in self._data['students']}
+
+    def _find_student(self, student_id):
+        return self._students_by_id.get(str(student_id))
+
+    # ─── 読み出しAPI（返り値はコピーなので、ロック外でシリアライズしてよい） ───
+
+    def list_students(self):
+        """初回表示用の学生一覧（日誌本文を含まない概要）"""
+        with self._lock:
+            self._ensure_loaded()
+            summaries = []
+            for student in self._data['students']:
+                journals = student.get('journals') or []
+                summaries.append({
+                    "id": student.get('id'),
+                    "name": student.get('name'),
+                    "settings": copy.deepcopy(student.get('settings')),
+                    "journal_count": len(journals),
+                    "weeks": sorted({j.get('week_number') for j in journals if j.get('week_number') is not None}),
+                    "weekly_review_weeks": sorted(int(w) for w in (student.get('weekly_reviews') or {})),
+                })
+            return summaries
+
+    def get_student(self, student_id):
+        with self._lock:
+            self._ensure_loaded()
+            student = self._find_student(student_id)
+            return copy.deepcopy(student) if student is not None else None
+
+    def get_journals(self, student_id, week=None, date=None):
+        with self._lock:
+            self._ensure_loaded()
+            student = self._find_student(student_id)
+            if student is None:
+                return None
+            journals = [
+                j for j in student.get('journals') or []
+                if (week is None or j.get('week_number') == week)
+                and (date is None or j.get('date') == date)
+            ]
+            return copy.deepcopy(journals)
+
+    def get_weekly_review(self, student_id, week):
+        with self._lock:
+            self._ensure_loaded()
+            student = self._find_student(student_id)
+            if student is None:
+                return None
+            review = (student.get('weekly_reviews') or {}).get(str(week))
+            return copy.deepcopy(review)
+
+    def _require_student(self, patch):
+        student = self._find_student(patch.get('student_id'))
+        if student is None:
+            raise ValueError(f"学生が見つかりません: {patch.get('student_id')}")
+        return student
+
+    def _patch_journal(self, patch):
+        student = self._require_student(patch)
+        date = patch.get('date')
+        fields = patch.get('fields') or {}
+        if not date or not isinstance(fields, dict):
+            raise ValueError("journal の差分には date と fields が必要です")
+
+        journals = student.setdefault('journals', [])
+        journal = next((j for j in journals if j.get('date') == date), None)
+        if journal is None:
+            # create: false の差分（AIの結果の保存など）は既存の日誌だけを更新する
+            if patch.get('create') is False:
+                raise ValueError(f"日誌が見つかりません: {patch.get('student_id')} {date}")
+            journal = {"date": date}
+            journals.append(journal)
+
+        for key, value in fields.items():
+            if key == 'date':
+                continue
+            if value is None:
+                journal.pop(key, None)
+            else:
+                journal[key] = value
+        self._mark_changed(('journal', str(student.get('id')), date))
+        return journal
+
+    def _patch_weekly_review(self, patch):
+        student = self._require_student(patch)
+        week = patch.get('week')
+        review = patch.get('review')
+        if week is None or not isinstance(review, dict):
+            raise ValueError("weekly_review の差分には week と review が必要です")
+        student.setdefault('weekly_reviews', {})[str(week)] = review
+        self._mark_changed(('weekly_review', str(student.get('id')), str(week)))
+        return review
+
+    def _patch_student(self, patch):
+        student = self._find_student(patch.get('student_id'))
+        if student is None:
+            name = patch.get('name')
+            if not name:
+                raise ValueError("新規学生の登録には name が必要です")
+            student = {
+                "id": patch.get('student_id'),
+                "name": name,
+                "settings": {},
+                "journals": [],
+                "growth_triggers": [],
+                "insights": []
+            }
+            self._data['students'].append(student)
+            self._reindex()
+        if patch.get('name'):
+            student['name'] = patch['name']
+        if isinstance(patch.get('settings'), dict):
+            student['settings'] = patch['settings']
+        self._mark_changed(('student', str(student.get('id'))))
+        return {key: value for key, value in student.items() if key != 'journals'}
+
+    # ─── レコード単位の同期（KIZUKI_SYNC_MODE=data） ───
+
+    def drain_changed_records(self):
+        """前回の呼び出し以降に変更されたレコードのキーを返す（None は全件）"""
+        with self._lock:
+            changed, self._changed_records = self._changed_records, set()
+            return changed
+
+    def get_records(self, keys=None):
+        """(キー, レコード) の一覧を返す。keys を省略すると全件（消えたレコードは None）"""
+        with self._lock:
+            self._ensure_loaded()
+            if keys is None:
+                keys = []
+                for student in self._data['students']:
+                    student_id = str(student.get('id'))
+                    keys.append(('student', student_id))
+                    keys.extend(('journal', student_id, j.get('date')) for j in student.get('journals') or [])
+                    keys.extend(('weekly_review', student_id, week) for week in student.get('weekly_reviews') or {})
+            return [(key, copy.deepcopy(self._get_record(key))) for key in keys]
+
+    def _get_record(self, key):
+        student = self._find_student(key[1])
+        if student is None:
+            return None
+        if key[0] == 'student':
+            return {k: v for k, v in student.items() if k not in ('journals', 'weekly_reviews')}
+        if key[0] == 'journal':
+            return next((j for j in student.get('journals') or [] if j.get('date') == key[2]), None)
+        return (student.get('weekly_reviews') or {}).get(str(key[2]))
+
+    def put_records(self, records):
+        """同期で受け取ったレコードを反映する
+
+        records は (キー, レコード) の列。日誌のキーは (journal, 学生ID, ファイル名の日付キー)、
+        レコードが None のものは削除として扱う。同期で受け取った変更は再送しない。
+        """
+        order = {'student': 0, 'weekly_review': 1, 'journal': 1}
+        with self._lock:
+            self._ensure_loaded()
+            # 学生の追加を先に、学生の削除を最後に行う
+            for key, record in sorted(records, key=lambda r: order[r[0][0]] if r[1] is not None else 2):
+                self._put_record(key, record)
+            self._reindex()
+            self._version += 1
+            self._log_records = max(self._log_records, 1)
+            self.compact()
+
+    def _put_record(self, key, record):
+        kind, student_id = key[0], key[1]
+        student = self._find_student(student_id)
+        if kind == 'student':
+            if record is None:
+                if student is not None:
+                    self._data['students'].remove(student)
+            elif student is None:
+                self._data['students'].append(dict(record, journals=[], weekly_reviews={}))
+            else:
+                for field in [k for k in student if k not in ('journals', 'weekly_reviews')]:
+                    del student[field]
+                student.update(record)
+            self._reindex()
+            return
+        if student is None:
+            print(f"  ⚠ 同期データの学生が見つかりません: {student_id}")
+            return
+        if kind == 'weekly_review':
+            reviews = student.setdefault('weekly_reviews', {})
+            if record is None:
+                reviews.pop(str(key[2]), None)
+            else:
+                reviews[str(key[2])] = record
             return
 
-        # プッシュ
-        push_result = subprocess.run(
-            ['git', 'push', 'origin', 'main'],
-            capture_output=True, text=True, timeout=30
-        )
-        if push_result.returncode == 0:
-            print("  ✓ バックアップ完了!")
+        journals = student.setdefault('journals', [])
+        if record is None:
+            journals[:] = [j for j in journals if record_file_key(j.get('date')) != key[2]]
+            return
+        for i, journal in enumerate(journals):
+            if journal.get('date') == record.get('date'):
+                journals[i] = record
+                break
         else:
-            print(f"  ⚠ プッシュに失敗しました")
-            print(f"    {push_result.stderr.strip()}")
-    except FileNotFoundError:
-        print("  ⚠ git が見つかりません。手動で同期してください。")
-    except subprocess.TimeoutExpired:
-        print("  ⚠ タイムアウトしました。ネットワーク接続を確認してください。")
-    except Exception as e:
-        print(f"  ⚠ バックアップエラー: {e}")
+            journals.append(record)
+
+    def _schedule_compaction(self):
+        if self._compact_timer is not None:
+            return
+        self._compact_timer = threading.Timer(self.compact_delay, self.compact)
+        self._compact_timer.daemon = True
+        self._compact_timer.start()
+
+    def compact(self):
+        """変更ログをスナップショットに畳み込み、ログを空にする
+
+        一時ファイルに書いて fsync してから置き換えるため、途中で落ちても
+        dashboard_data.json が壊れることはない（ログは置き換え後に消す）。
+        """
+        with self._lock:
+            if self._compact_timer is not None:
+                self._compact_timer.cancel()
+                self._compact_timer = None
+            if self._data is None or self._log_records == 0:
+                return
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._data, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+            if self._log_file is not None:
+                self._log_file.close()
+                self._log_file = None
+            with open(self.log_path, 'w', encoding='utf-8') as f:
+                f.flush()
+                os.fsync(f.fileno())
+            self._log_records = 0
+
+
+store = DashboardStore()
+
+
+def record_file_key(date):
+    """日誌の日付をファイル名に使えるキーにする
+
+    2025年05月19日 → 20250519、2025-05-19 → 2025-05-19（表記が違えば別の日誌として扱う）。
+    それ以外の表記は日付文字列のハッシュにする。
+    """
+    date = str(date)
+    match = re.fullmatch(r'(\d{4})年(\d{2})月(\d{2})日', date)
+    if match:
+        return ''.join(match.groups())
+    if re.fullmatch(r'\d{4}-\d{2}-\d{2}', date):
+        return date
+    return hashlib.sha1(date.encode('utf-8')).hexdigest()[:16]
+
+
+def record_path(key):
+    """レコードのキーから sync_data/ 以下のファイルパスを返す"""
+    kind, student_id = key[0], key[1]
+    if kind == 'student':
+        return f'{SYNC_DATA_DIR}/{student_id}/student.json'
+    if kind == 'journal':
+        return f'{SYNC_DATA_DIR}/{student_id}/journals/{record_file_key(key[2])}.json'
+    return f'{SYNC_DATA_DIR}/{student_id}/weekly_reviews/{key[2]}.json'
+
+
+def parse_record_path(path):
+    """sync_data/ 以下のファイルパスからレコードのキーを返す（対象外なら None）"""
+    parts = path.split('/')
+    if len(parts) == 3 and parts[0] == SYNC_DATA_DIR and parts[2] == 'student.json':
+        return ('student', parts[1])
+    if len(parts) == 4 and parts[0] == SYNC_DATA_DIR and parts[3].endswith('.json'):
+        kind = {'journals': 'journal', 'weekly_reviews': 'weekly_review'}.get(parts[2])
+        if kind:
+            return (kind, parts[1], parts[3][:-len('.json')])
+    return None
+
+
+class GitSyncWorker:
+    """GitHub との同期（取得・バックアップ）をバックグラウンドで行う
+
+    起動時の取得はサーバーが応答を始めてから行い、保存のたびにタイマーを張り直して
+    一定時間（既定60秒）保存が途絶えたらまとめてコミット・プッシュする。
+    git の操作は専用スレッド1本で順番に実行するため、リクエスト処理は待たされない。
+
+    mode='full' は dashboard_data.json をそのままコミットする。
+    mode='data' は日誌・週次レビュー・学生設定を sync_data/<学生ID>/ 以下の
+    レコード単位のファイルに書き出し、変更のあったファイルだけをコミットする。
+    取り込み時も git の差分に含まれるファイルだけを読むため、同期の時間と
+    リポジトリの増え方はデータ全体の大きさではなく編集量に比例する。
+    """
+
+    MODES = ('full', 'data')
+    # 画面に表示するために保持する直近の競合の件数
+    MAX_CONFLICTS = 50
+
+    def __init__(self, store, delay=60.0, mode='full'):
+        if mode not in self.MODES:
+            raise ValueError(f"未対応の同期モードです: {mode}")
+        self.store = store
+        self.delay = delay
+        self.mode = mode
+        self.sync_paths = (SYNC_DATA_DIR,) if mode == 'data' else (DATA_FILE,)
+        self._tasks = queue.Queue()
+        self._lock = threading.Lock()
+        self._timer = None
+        self._thread = None
+        self._dirty = False
+        self._unpushed = False
+        self._available = True
+        # data モードで起動後の全件突き合わせを済ませたか
+        self._records_checked = False
+        self._merge_driver_ready = False
+        # 取り込み時にマージドライバが記録したフィールド単位の競合（新しいものが後ろ）
+        self._conflicts = []
+
+    def start(self):
+        """同期スレッドを起動し、最新データの取得と、前回の起動で送れなかったコミットの確認を予約する"""
+        self._thread = threading.Thread(target=self._run, name='kizuki-git-sync', daemon=True)
+        self._thread.start()
+        self._tasks.put('pull')
+        self._tasks.put('resume')
+
+    def notify_saved(self):
+        """保存があったことを知らせる（最後の保存から delay 秒後にバックアップ）"""
+        with self._lock:
+            self._dirty = True
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.delay, self._tasks.put, args=('push',))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def stop(self, timeout=90):
+        """未送信の変更があればバックアップしてから同期スレッドを止める"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending = self._dirty or self._unpushed
+        if self._thread is None:
+            return
+        if pending:
+            print("未送信の変更を GitHub へバックアップしています...")
+            self._tasks.put('push')
+        self._tasks.put(None)
+        self._thread.join(timeout)
+
+    def sync_once(self):
+        """取得とバックアップを1回だけ同期的に行う（start_server.py --sync 用）"""
+        try:
+            return self._pull() and self._push()
+        except FileNotFoundError:
+            print("  ⚠ git が見つかりません。")
+        except subprocess.TimeoutExpired:
+            print("  ⚠ 同期がタイムアウトしました。ネットワーク接続を確認してください。")
+        return False
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            if not self._available:
+                continue
+            try:
+                if task == 'pull':
+                    self._pull()
+                elif task == 'resume':
+                    self._resume_unpushed()
+                else:
+                    self._push()
+            except FileNotFoundError:
+                self._available = False
+                print("  ⚠ git が見つかりません。自動同期を停止します（手動で同期してください）。")
+            except subprocess.TimeoutExpired:
+                print("  ⚠ 同期がタイムアウトしました。ネットワーク接続を確認してください。")
+            except Exception as e:
+                print(f"  ⚠ 同期エラー: {e}")
+
+    def status(self):
+        """画面表示用の同期の状態（直近のフィールド単位の競合を含む）"""
+        with self._lock:
+            return {"mode": self.mode, "unpushed": self._unpushed or self._dirty,
+                    "conflicts": copy.deepcopy(self._conflicts)}
+
+    def _collect_conflicts(self, offset):
+        """取り込み中にマージドライバが追記した競合を読み、状態に加える"""
+        if not os.path.exists(MERGE_CONFLICT_REPORT) or os.path.getsize(MERGE_CONFLICT_REPORT) <= offset:
+            return
+        with open(MERGE_CONFLICT_REPORT, 'r', encoding='utf-8') as f:
+            f.seek(offset)
+            conflicts = [json.loads(line) for line in f if line.strip()]
+        for conflict in conflicts:
+            kept = 'この端末の値' if conflict.get('kept') == 'local' else '他の端末の値'
+            print(f"  ⚠ 同期の競合: {conflict.get('file')} {conflict.get('path')}（{kept}を残しました）")
+        with self._lock:
+            self._conflicts = (self._conflicts + conflicts)[-self.MAX_CONFLICTS:]
+
+    def _resume_unpushed(self):
+        """origin/main より先行しているコミット（ネットワーク断などで前回送れなかった分）があればプッシュする"""
+        ahead = self._git('rev-list', '--count', 'origin/main..HEAD')
+        if ahead.returncode != 0 or not ahead.stdout.strip().isdigit() or int(ahead.stdout) == 0:
+            return
+        print(f"  前回送れなかったコミットが {int(ahead.stdout)} 件あります。GitHub へバックアップします")
+        with self._lock:
+            self._unpushed = True
+        self._push()
+
+    def _git(self, *args, timeout=10):
+        return subprocess.run(['git', *args], capture_output=True, text=True, timeout=timeout)
+
+    def _commit_local(self, message):
+        """データの変更をコミットする（ストアのロック内で呼ぶ）"""
+        self.store.compact()
+        if self.mode == 'data':
+            if not self._records_checked:
+                self._catch_up_records()
+            self._export_records()
+        self._git('add', '-A', '--', *self.sync_paths)
+        result = self._git('commit', '-m', message, '--', *self.sync_paths)
+        if result.returncode == 0:
+            with self._lock:
+                self._unpushed = True
+        return result.returncode == 0
+
+    # ─── data モード: レコード単位のファイルの書き出しと取り込み ───
+
+    def _state_path(self):
+        """最後に取り込んだコミットの記録先（.git の中なのでコミットされない）"""
+        return self._git('rev-parse', '--git-path', 'kizuki-sync-state').stdout.strip()
+
+    def _save_state(self):
+        head = self._git('rev-parse', 'HEAD').stdout.strip()
+        if head:
+            with open(self._state_path(), 'w', encoding='utf-8') as f:
+                f.write(head + '\n')
+
+    def _catch_up_records(self):
+        """起動後の初回に、手動の git pull などで取り込み漏れた変更を反映してから全件を突き合わせる"""
+        state_path = self._state_path()
+        last = ''
+        if os.path.exists(state_path):
+            with open(state_path, 'r', encoding='utf-8') as f:
+                last = f.read().strip()
+        if not last or not self._import_records(last):
+            # 初めて data モードで同期する端末: リポジトリにあるレコードを全件取り込む
+            listed = self._git('ls-files', '--', SYNC_DATA_DIR).stdout.splitlines()
+            self._read_records([('A', path) for path in listed])
+        self.store.drain_changed_records()
+        self._export_records(full=True)
+        self._records_checked = True
+
+    def _export_records(self, full=False):
+        """変更のあったレコードだけを sync_data/ に書き出す（full=True は全件を突き合わせる）"""
+        keys = self.store.drain_changed_records()
+        records = self.store.get_records(None if full or keys is None else sorted(keys))
+        written = set()
+        for key, record in records:
+            path = record_path(key)
+            written.add(path)
+            if record is None:
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            body = (json.dumps(record, ensure_ascii=False, indent=2, sort_keys=True) + '\n').encode('utf-8')
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    if f.read() == body:
+                        continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(body)
+                os.replace(path + '.tmp', path)
+            finally:
+                # 書き込みに失敗しても一時ファイルを sync_data/ に残さない（git add -A で拾われる）
+                if os.path.exists(path + '.tmp'):
+                    os.remove(path + '.tmp')
+
+        if full or keys is None:
+            # ストアに存在しないレコードのファイルを消す
+            for root, _dirs, files in os.walk(SYNC_DATA_DIR):
+                for name in files:
+                    path = os.path.join(root, name).replace(os.sep, '/')
+                    if name.endswith('.json') and path not in written:
+                        os.remove(path)
+
+    def _import_records(self, since):
+        """since から HEAD までに変わったレコードのファイルだけをストアに反映する"""
+        diff = self._git('diff', '--name-status', '--no-renames', since, 'HEAD', '--', SYNC_DATA_DIR)
+        if diff.returncode != 0:
+            return False
+        changes = [line.split('\t', 1) for line in diff.stdout.splitlines() if '\t' in line]
+        self._read_records(changes)
+        return True
+
+    def _read_records(self, changes):
+        records = []
+        for status, path in changes:
+            key = parse_record_path(path)
+            if key is None:
+                continue
+            if status.startswith('D'):
+                records.append((key, None))
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                records.append((key, json.load(f)))
+        if records:
+            self.store.put_records(records)
+            print(f"  ✓ {len(records)} 件のレコードを取り込みました")
+
+    def _ensure_merge_driver(self):
+        """.gitattributes の merge=kizuki-json が使うマージドライバをこのリポジトリに登録する"""
+        if self._merge_driver_ready:
+            return
+        python = sys.executable.replace('\\', '/')
+        self._git('config', 'merge.kizuki-json.name', 'Kizuki-Log JSON merge')
+        self._git('config', 'merge.kizuki-json.driver',
+                  f'"{python}" {MERGE_DRIVER_SCRIPT} %O %A %B %P')
+        self._merge_driver_ready = True
+
+    def _pull(self):
+        """リモートの変更を取り込み、データファイルが変わっていればストアを読み直す"""
+        self._ensure_merge_driver()
+        fetch = self._git('fetch', 'origin', 'main', timeout=30)
+        if fetch.returncode != 0:
+            print(f"  ⚠ 最新データの取得に失敗しました: {fetch.stderr.strip()}")
+            return False
+
+        # 取り込み中にコンパクションや保存でデータファイルが書き換わらないよう、ストアを止めておく
+        with self.store.lock:
+            with self._lock:
+                self._dirty = False
+            self._commit_local(f"Auto-sync before pull: {datetime.now():%Y-%m-%d %H:%M:%S}")
+            before_head = self._git('rev-parse', 'HEAD').stdout.strip()
+            before = self._git('rev-parse', 'HEAD:' + DATA_FILE).stdout.strip()
+            report_offset = os.path.getsize(MERGE_CONFLICT_REPORT) if os.path.exists(MERGE_CONFLICT_REPORT) else 0
+            rebase = self._git('rebase', '--autostash', 'FETCH_HEAD', timeout=30)
+            self._collect_conflicts(report_offset)
+            if rebase.returncode != 0:
+                self._git('rebase', '--abort')
+                print(f"  ⚠ 最新データを取り込めませんでした（競合）: {rebase.stderr.strip() or rebase.stdout.strip()}")
+                return False
+            if self.mode == 'data':
+                self._import_records(before_head)
+                self._save_state()
+                return True
+            after = self._git('rev-parse', 'HEAD:' + DATA_FILE).stdout.strip()
+            if before != after:
+                self.store.reload()
+                print("  ✓ GitHub の最新データを取り込みました")
+        return True
+
+    def _push(self):
+        """ローカルの変更をコミットして GitHub へ送る"""
+        with self.store.lock:
+            with self._lock:
+                self._dirty = False
+            if self._commit_local(f"Auto-sync: {datetime.now():%Y-%m-%d %H:%M:%S}") and self.mode == 'data':
+                self._save_state()
+        with self._lock:
+            if not self._unpushed:
+                return True
+
+        push = self._git('push', 'origin', 'main', timeout=30)
+        if push.returncode != 0 and self._pull():
+            # 他の端末が先にプッシュしていた場合は取り込んでから1度だけやり直す
+            push = self._git('push', 'origin', 'main', timeout=30)
+        if push.returncode == 0:
+            with self._lock:
+                self._unpushed = False
+            print(f"  ✓ GitHub へバックアップしました ({datetime.now():%H:%M:%S})")
+            return True
+        print(f"  ⚠ プッシュに失敗しました: {push.stderr.strip()}")
+        return False
+
 
 # AI Bridge を遅延インポート（起動時のエラーを防ぐ）
 ai_bridge = None
@@ -84,6 +962,7 @@ def get_ai_bridge():
         try:
             import ai_bridge as _ai_bridge
             ai_bridge = _ai_bridge
+            register_http_metrics(ai_bridge)
             print("AI Bridge モジュールを読み込みました")
         except ImportError as e:
             print(f"AI Bridge の読み込みに失敗: {e}")
@@ -91,15 +970,472 @@ def get_ai_bridge():
     return ai_bridge
 
 
+def register_http_metrics(bridge):
+    """HTTPリクエストの計測項目を登録する（集計は ai_bridge.metrics に一本化）"""
+    metrics = bridge.metrics
+    metrics.counter('kizuki_http_requests_total', 'HTTPリクエスト数（ルート・ステータス別）')
+    metrics.histogram('kizuki_http_request_duration_seconds', 'HTTPリクエストの処理時間')
+    metrics.histogram('kizuki_http_request_bytes', 'リクエスト本文のサイズ', bridge.SIZE_BUCKETS)
+    metrics.histogram('kizuki_http_response_bytes', 'レスポンス本文のサイズ', bridge.SIZE_BUCKETS)
+
+
+def record_http_request(method, route, status, duration, request_bytes, response_bytes):
+    """1リクエスト分の計測値を記録する"""
+    bridge = get_ai_bridge()
+    if bridge is None:
+        return
+    metrics = bridge.metrics
+    metrics.inc('kizuki_http_requests_total', method=method, route=route, status=str(status))
+    metrics.observe('kizuki_http_request_duration_seconds', duration, method=method, route=route)
+    if request_bytes:
+        metrics.observe('kizuki_http_request_bytes', request_bytes, method=method, route=route)
+    metrics.observe('kizuki_http_response_bytes', response_bytes, method=method, route=route)
+
+
+def missing_target(kind, target):
+    """AIの結果の保存先（学生・日誌）が無ければその旨のメッセージを返す（保存先の指定が無ければ None）"""
+    target = target or {}
+    if not target.get('student_id'):
+        return None
+    if kind in ('analyze', 'generate_daily_comment') and target.get('date'):
+        if not store.get_journals(target['student_id'], date=target['date']):
+            return f"保存先の日誌が見つかりません: {target['student_id']} {target['date']}"
+    elif store.get_student(target['student_id']) is None:
+        return f"学生が見つかりません: {target['student_id']}"
+    return None
+
+
+def persist_ai_result(kind, target, result):
+    """AIの結果を対象の日誌・週次レビューに保存する（日誌は新規に作らず、見つからなければ ValueError）"""
+    target = target or {}
+    if not target.get('student_id'):
+        return
+    if kind == 'analyze' and target.get('date'):
+        store.apply_patch({"type": "journal", "student_id": target['student_id'], "create": False,
+                           "date": target['date'], "fields": {"ai_analysis": result}})
+    elif kind == 'generate_daily_comment' and target.get('date'):
+        store.apply_patch({"type": "journal", "student_id": target['student_id'], "create": False,
+                           "date": target['date'],
+                           "fields": {"ai_suggested_comment": result.get('daily_comment')}})
+    elif kind == 'review_weekly' and target.get('week') is not None:
+        store.apply_patch({"type": "weekly_review", "student_id": target['student_id'],
+                           "week": target['week'], "review": result})
+
+
+def day_analysis_saver(student_id):
+    """週次分析（map_reduce）の途中で解析した日誌の結果を、その日誌の ai_analysis に保存する関数"""
+    if not student_id:
+        return None
+
+    def save(journal, analysis):
+        try:
+            persist_ai_result('analyze', {'student_id': student_id, 'date': journal.get('date')}, analysis)
+        except ValueError as e:
+            print(f"  ⚠ 日ごとの解析結果を保存できませんでした: {e}")
+    return save
+
+
+class AIJobQueue:
+    """AI解析をサーバー側で実行するジョブキュー
+
+    投稿するとすぐにジョブIDを返し、結果は同時実行数を制限したワーカーで計算する。
+    完了した結果は対象の日誌（または週次レビュー）にストア経由で保存されるため、
+    ブラウザのタブを閉じたり再読み込みしたりしても失われない。
+    """
+
+    KINDS = ('analyze', 'review_weekly', 'generate_daily_comment')
+    # 完了済みジョブをメモリに残す件数
+    MAX_FINISHED_JOBS = 200
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            try:
+                workers = max(1, int(os.environ.get('KIZUKI_AI_WORKERS', DEFAULT_AI_WORKERS)))
+            except ValueError:
+                workers = DEFAULT_AI_WORKERS
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='kizuki-ai')
+        return self._executor
+
+    def shutdown(self):
+        """未着手のジョブを取り消す（実行中のジョブは終わり次第ストアに保存される）"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, kind, params, target=None, provider='', force_refresh=False):
+        """ジョブを登録してジョブ情報を返す（force_refresh なら AI 応答のキャッシュを使わない）"""
+        if kind not in self.KINDS:
+            raise ValueError(f"未対応のジョブ種別です: {kind}")
+        if not isinstance(params, dict):
+            raise ValueError("params はオブジェクトで指定してください")
+
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "kind": kind,
+            "status": "queued",
+            "target": target or {},
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+        }
+        with self._lock:
+            self._jobs[job['job_id']] = job
+            self._prune()
+            executor = self._get_executor()
+        executor.submit(self._run, job['job_id'], params, provider, bool(force_refresh))
+        return self.get(job['job_id'])
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return copy.deepcopy(job) if job is not None else None
+
+    def list(self, student_id=None):
+        with self._lock:
+            return [
+                copy.deepcopy(job) for job in self._jobs.values()
+                if student_id is None or str(job['target'].get('student_id')) == str(student_id)
+            ]
+
+    def _prune(self):
+        finished = [j for j in self._jobs.values() if j['finished_at'] is not None]
+        if len(finished) > self.MAX_FINISHED_JOBS:
+            finished.sort(key=lambda j: j['finished_at'])
+            for job in finished[:len(finished) - self.MAX_FINISHED_JOBS]:
+                del self._jobs[job['job_id']]
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+
+    def _run(self, job_id, params, provider, force_refresh=False):
+        self._update(job_id, status="running", started_at=time.time())
+        job = self.get(job_id)
+        print(f"AIジョブを開始... ({job['kind']} {job_id[:8]})")
+        started = time.perf_counter()
+        trace = {}
+        missing = missing_target(job['kind'], job['target'])
+        if missing:
+            # 存在しない日誌に結果を書き込まない（AIも呼ばない）
+            result = {"error": True, "not_found": True, "message": missing}
+        else:
+            try:
+                result = self._call_bridge(job['kind'], params, provider, trace, force_refresh, job['target'])
+            except Exception as e:
+                print(f"AI job error: {e}")
+                result = {"error": True, "message": f"ジョブの実行中にエラーが発生しました: {str(e)}"}
+
+        status = "error" if result.get('error') else "done"
+        if status == "done":
+            try:
+                persist_ai_result(job['kind'], job['target'], result)
+            except ValueError as e:
+                # 実行中に日誌が削除された場合など
+                print(f"  ⚠ AIの結果を保存できませんでした: {e}")
+                status = "error"
+                result = {"error": True, "not_found": True, "message": f"AIの結果を保存できませんでした: {e}"}
+        self._update(job_id, status=status, result=result, finished_at=time.time())
+        code = 200 if status == "done" else 404 if result.get('not_found') else 500
+        log_request(f"/jobs:{job['kind']}", code, job=job_id[:8],
+                    queue_ms=(job['started_at'] - job['created_at']) * 1000,
+                    total_ms=elapsed_ms(started), **trace)
+
+    def _call_bridge(self, kind, params, provider, trace=None, force_refresh=False, target=None):
+        bridge = get_ai_bridge()
+        if bridge is None:
+            return {"error": True, "message": "AI Bridge の読み込みに失敗しました。"}
+        provider = provider or None
+
+        if kind == 'analyze':
+            return bridge.analyze_journal(
+                week=params.get('week', 1),
+                log_achieved=params.get('log_achieved', ''),
+                log_unachieved=params.get('log_unachieved', ''),
+                instructor_notes=params.get('instructor_notes', ''),
+                provider=provider,
+                force_refresh=force_refresh,
+                trace=trace
+            )
+        if kind == 'review_weekly':
+            return bridge.analyze_weekly(params.get('week_number'), params.get('journals', []),
+                                         provider=provider, force_refresh=force_refresh, trace=trace,
+                                         mode=params.get('mode') or None,
+                                         on_day_analysis=day_analysis_saver((target or {}).get('student_id')))
+        return bridge.generate_daily_comment(params.get('current_step0', []), params.get('student_summary', {}),
+                                             provider=provider, trace=trace, force_refresh=force_refresh)
+
+
+
+jobs = AIJobQueue()
+
+
 class KizukiHandler(http.server.SimpleHTTPRequestHandler):
+    # 再検証付きキャッシュを許可するレスポンスの ETag（None のときは no-store）
+    _etag = None
+    # 計測用：このリクエストで返したステータスと本文サイズ
+    _status = None
+    # do_POST / do_PATCH で先に読み込んだ本文（読み込みに失敗したときはその例外）
+    _body = None
+    _body_error = None
+    _response_bytes = 0
+
+    # /metrics に出すルート名（学生IDや日付はラベルに含めない）
+    ROUTES = ('/save', '/analyze', '/analyze_stream', '/review_weekly', '/generate_daily_comment',
+              '/jobs', '/shutdown', '/metrics', '/sync_status', '/' + DATA_FILE)
+
+    def handle_one_request(self):
+        """1リクエストを処理し、ルート別の件数・処理時間・サイズを記録する"""
+        self._status = None
+        self._body = self._body_error = None
+        self._response_bytes = 0
+        started = time.perf_counter()
+        super().handle_one_request()
+        if self._status is None:
+            return
+        # 不正なリクエスト行で parse_request が失敗した場合は path / headers / command が無い
+        headers = getattr(self, 'headers', None)
+        record_http_request(
+            getattr(self, 'command', None) or 'other', self.route_label(), self._status,
+            time.perf_counter() - started,
+            int(headers.get('Content-Length') or 0) if headers is not None else 0,
+            self._response_bytes
+        )
+
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'content-length':
+            self._response_bytes = int(value)
+        super().send_header(keyword, value)
+
+    def route_label(self):
+        """計測用のルート名を返す"""
+        path = getattr(self, 'path', None)
+        if path is None:
+            return 'other'
+        url_path = urllib.parse.urlsplit(path).path
+        if url_path in self.ROUTES:
+            return url_path
+        if url_path.startswith('/jobs/'):
+            return '/jobs/:id'
+        for pattern, name in self.API_ROUTES:
+            if pattern.match(url_path):
+                return f'/api/{name}'
+        if url_path.startswith('/api/'):
+            return '/api/unknown'
+        return 'static'
+
     def end_headers(self):
-        """すべてのレスポンスにキャッシュ無効化ヘッダーを追加（Safari対策）"""
-        self.send_header('Cache-Control', 'no-store, no-cache, must-revalidate, max-age=0')
-        self.send_header('Pragma', 'no-cache')
-        self.send_header('Expires', '0')
+        """キャッシュ制御ヘッダーを追加（Safari対策）
+
+        ETag 付きのレスポンスは no-cache とし、ブラウザに毎回サーバーへ再検証させる。
+        古い内容が表示され続けることはなく、変更がなければ 304 で本文の転送を省ける。
+        それ以外（API応答など）は従来どおりキャッシュを完全に無効化する。
+        """
+        if self._etag:
+            self.send_header('ETag', self._etag)
+            self.send_header('Cache-Control', 'no-cache')
+        else:
+            self.send_header('Cache-Control', 'no-store, no-cache, must-revalidate, max-age=0')
+            self.send_header('Pragma', 'no-cache')
+            self.send_header('Expires', '0')
         super().end_headers()
 
+    def send_head(self):
+        """静的ファイルとデータファイルに ETag を付け、変更がなければ 304 を返す"""
+        self._etag = None
+        url_path = urllib.parse.urlsplit(self.path).path
+
+        if url_path == '/' + DATA_FILE:
+            # 未反映の差分も含まれるよう、データファイルはストアから返す
+            body, etag = store.snapshot()
+            return self._send_cacheable(body, etag, 'application/json; charset=utf-8')
+        if url_path == '/metrics':
+            return self._handle_metrics()
+        if url_path == '/sync_status':
+            status = sync_worker.status() if sync_worker is not None else {"mode": None, "conflicts": []}
+            self._send_json(200, status)
+            return None
+        if url_path == '/jobs' or url_path.startswith('/jobs/'):
+            return self._handle_job_status(url_path, urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query))
+        if url_path.startswith('/api/'):
+            return self._handle_api_get(url_path, urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query))
+
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and url_path.endswith('/'):
+            path = os.path.join(path, 'index.html')
+        if os.path.isfile(path):
+            ctype = self.guess_type(path)
+            if ctype.startswith(COMPRESSIBLE_TYPES):
+                # 再検証で 304 を返すときはファイルを読まない
+                return self._send_cacheable(lambda: self._read_file(path), file_etag(path), ctype,
+                                            last_modified=os.path.getmtime(path), size=os.path.getsize(path))
+            self._etag = file_etag(path)
+            if self._etag_matches():
+                return self._send_not_modified()
+        return super().send_head()
+
+    # /api/students/<id>/... のルーティング
+    API_ROUTES = [
+        (re.compile(r'^/api/students/?$'), 'students'),
+        (re.compile(r'^/api/students/([^/]+)/?$'), 'student'),
+        (re.compile(r'^/api/students/([^/]+)/journals/?$'), 'journals'),
+        (re.compile(r'^/api/students/([^/]+)/journals/([^/]+)$'), 'journal'),
+        (re.compile(r'^/api/students/([^/]+)/weekly_reviews/(\d+)$'), 'weekly_review'),
+    ]
+
+    def _handle_api_get(self, url_path, query):
+        """学生単位・週単位の読み出しAPI（必要な分だけを返す）"""
+        for pattern, name in self.API_ROUTES:
+            match = pattern.match(url_path)
+            if match:
+                break
+        else:
+            self._send_json(404, {"error": True, "message": "APIが見つかりません。"})
+            return None
+
+        args = [urllib.parse.unquote(arg) for arg in match.groups()]
+        if name == 'students':
+            result = {"students": store.list_students()}
+        elif name == 'student':
+            result = store.get_student(args[0])
+        elif name == 'journals':
+            week = query.get('week', [None])[0]
+            if week is not None and not week.isdigit():
+                self._send_json(400, {"error": True, "message": "week は数値で指定してください。"})
+                return None
+            result = store.get_journals(args[0], week=int(week) if week else None)
+        elif name == 'journal':
+            journals = store.get_journals(args[0], date=args[1])
+            result = journals[0] if journals else None
+        else:
+            result = store.get_weekly_review(args[0], int(args[1]))
+
+        if result is None:
+            self._send_json(404, {"error": True, "message": "データが見つかりません。"})
+            return None
+        body = json.dumps(result, ensure_ascii=False).encode('utf-8')
+        return self._send_cacheable(body, content_etag(body), 'application/json; charset=utf-8')
+
+    @staticmethod
+    def _read_file(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _send_cacheable(self, body, etag, ctype, last_modified=None, size=None):
+        """
+        ETag 付きで本文を返す（圧縮可能なら圧縮済みの版を使う）。
+        body は読み込み関数でもよく、その場合は size を渡し、ETag が一致しなかったときだけ呼ぶ。
+        """
+        encoding = self._negotiate_encoding() if (len(body) if size is None else size) >= MIN_COMPRESS_SIZE else None
+        # 圧縮版は別の表現なので ETag も区別する
+        self._etag = etag if encoding is None else etag[:-1] + '-' + encoding + '"'
+        if self._etag_matches():
+            return self._send_not_modified(vary=True)
+        if callable(body):
+            body = body()
+        if encoding:
+            body = compressed_variant(etag, encoding, body)
+
+        self.send_response(200)
+        self.send_header('Content-type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if last_modified is not None:
+            self.send_header('Last-Modified', self.date_time_string(last_modified))
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def _negotiate_encoding(self):
+        """Accept-Encoding から使用する圧縮方式を選ぶ（br > gzip）"""
+        accepted = {}
+        for item in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = item.strip().partition(';')
+            quality = 1.0
+            if params.strip().startswith('q='):
+                try:
+                    quality = float(params.strip()[2:])
+                except ValueError:
+                    quality = 0.0
+            if name:
+                accepted[name.strip().lower()] = quality
+        if brotli is not None and accepted.get('br', 0) > 0:
+            return 'br'
+        if accepted.get('gzip', 0) > 0:
+            return 'gzip'
+        return None
+
+    def _read_body(self):
+        """リクエスト本文を読み込む（Content-Encoding: gzip / br で圧縮された本文にも対応）"""
+        if self._body_error is not None:
+            raise self._body_error
+        if self._body is not None:
+            return self._body
+        content_length = int(self.headers.get('Content-Length', 0))
+        if content_length > MAX_REQUEST_BODY:
+            raise RequestTooLarge()
+        body = self.rfile.read(content_length)
+        encoding = self.headers.get('Content-Encoding', '').strip().lower()
+        if encoding == 'gzip' or (encoding == 'br' and brotli is not None):
+            try:
+                return decompress_body(body, encoding)
+            except (zlib.error, getattr(brotli, 'error', zlib.error)) as e:
+                raise ValueError(f"圧縮された本文を展開できません: {e}") from None
+        if encoding not in ('', 'identity'):
+            raise ValueError(f"未対応の Content-Encoding です: {encoding}")
+        return body
+
+    def _etag_matches(self):
+        if_none_match = self.headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or self._etag in tags
+
+    def _send_not_modified(self, vary=False):
+        """304 を返す（ETag は end_headers が付ける。圧縮版を選び分けた応答なら 200 と同じく Vary も付ける）"""
+        self.send_response(304)
+        if vary:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        return None
+
+    def _load_body(self):
+        """本文を先に読み込んでおく（大きすぎれば 413 を返して False）"""
+        self._body = self._body_error = None
+        try:
+            self._body = self._read_body()
+        except RequestTooLarge:
+            self.close_connection = True
+            self._send_json(413, {"error": True,
+                                  "message": f"リクエストが大きすぎます（上限 {MAX_REQUEST_BODY // (1024 * 1024)}MB）。"})
+            return False
+        except Exception as e:
+            # 形式の誤りなどは各ハンドラーが _read_body() を呼んだときに従来どおり処理する
+            self._body_error = e
+        return True
+
+    def do_PATCH(self):
+        if not self._load_body():
+            return
+        if self.path == '/save':
+            self._handle_save_patch()
+        else:
+            self.send_response(404)
+            self.end_headers()
+
     def do_POST(self):
+        if not self._load_body():
+            return
         if self.path == '/save':
             self._handle_save()
         elif self.path == '/analyze':
@@ -108,6 +1444,10 @@ class KizukiHandler(http.server.SimpleHTTPRequestHandler):
             self._handle_review_weekly()
         elif self.path == '/generate_daily_comment':
             self._handle_generate_daily_comment()
+        elif self.path == '/jobs':
+            self._handle_job_submit()
+        elif self.path == '/analyze_stream':
+            self._handle_analyze_stream()
         elif self.path == '/shutdown':
             self._handle_shutdown()
         else:
@@ -116,13 +1456,10 @@ class KizukiHandler(http.server.SimpleHTTPRequestHandler):
 
     def _handle_save(self):
         """日誌データの保存"""
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-
         try:
+            post_data = self._read_body()
             data = json.loads(post_data.decode('utf-8'))
-            with open('dashboard_data.json', 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            store.replace(data)
 
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -136,12 +1473,32 @@ class KizukiHandler(http.server.SimpleHTTPRequestHandler):
             self.wfile.write(json.dumps({"error": str(e)}).encode('utf-8'))
             print(f"Error saving data: {e}")
 
+    def _handle_save_patch(self):
+        """1件の日誌・週次レビュー・学生設定だけを更新する差分保存"""
+        try:
+            post_data = self._read_body()
+            patch = json.loads(post_data.decode('utf-8'))
+            if isinstance(patch, list):
+                # まとめて送られた差分は全部適用するか、1件も適用しないか
+                store.apply_patches(patch)
+                applied = len(patch)
+            else:
+                store.apply_patch(patch)
+                applied = 1
+            self._send_json(200, {"status": "success", "applied": applied})
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": True, "message": "リクエストのJSON形式が不正です。"})
+        except ValueError as e:
+            self._send_json(400, {"error": True, "message": str(e)})
+        except Exception as e:
+            print(f"Error applying patch: {e}")
+            self._send_json(500, {"error": True, "message": str(e)})
+
     def _handle_analyze(self):
         """AI解析リクエストの処理"""
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-
+        started = time.perf_counter()
         try:
+            post_data = self._read_body()
             request = json.loads(post_data.decode('utf-8'))
 
             # 必須パラメータの検証
@@ -170,22 +1527,21 @@ class KizukiHandler(http.server.SimpleHTTPRequestHandler):
 
             print(f"AI解析を開始... (Week {week})")
             
-            # フロントエンドからのプロバイダ指定
-            provider_override = request.get('provider', '')
-            if provider_override:
-                import os as _os
-                _os.environ['AI_PROVIDER'] = provider_override
-                print(f"  プロバイダ: {provider_override}")
-            
+            # フロントエンドからのプロバイダ指定（このリクエストだけに適用）
+            trace = {}
             result = bridge.analyze_journal(
                 week=week,
                 log_achieved=log_achieved,
                 log_unachieved=log_unachieved,
-                instructor_notes=instructor_notes
+                instructor_notes=instructor_notes,
+                provider=request.get('provider') or None,
+                force_refresh=bool(request.get('force_refresh')),
+                trace=trace
             )
             print("AI解析が完了しました")
 
             self._send_json(200, result)
+            log_request('/analyze', 200, total_ms=elapsed_ms(started), **trace)
 
         except json.JSONDecodeError:
             self._send_json(400, {
@@ -199,12 +1555,65 @@ class KizukiHandler(http.server.SimpleHTTPRequestHandler):
                 "message": f"解析中にエラーが発生しました: {str(e)}"
             })
 
+    def _handle_analyze_stream(self):
+        """AI解析の途中経過を Server-Sent Events で逐次返す"""
+        try:
+            post_data = self._read_body()
+            request = json.loads(post_data.decode('utf-8'))
+        except (ValueError, OSError):
+            self._send_json(400, {"error": True, "message": "リクエストのJSON形式が不正です。"})
+            return
+
+        log_achieved = request.get('log_achieved', '')
+        log_unachieved = request.get('log_unachieved', '')
+        if not log_achieved and not log_unachieved:
+            self._send_json(400, {"error": True, "message": "日誌の内容が入力されていません。"})
+            return
+
+        bridge = get_ai_bridge()
+        if bridge is None:
+            self._send_json(500, {"error": True, "message": "AI Bridge モジュールの読み込みに失敗しました。"})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream; charset=utf-8')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.end_headers()
+
+        print(f"AI解析（ストリーミング）を開始... (Week {request.get('week', 1)})")
+        started = time.perf_counter()
+        trace = {}
+        client_connected = True
+        for event, payload in bridge.analyze_journal_stream(
+            week=request.get('week', 1),
+            log_achieved=log_achieved,
+            log_unachieved=log_unachieved,
+            instructor_notes=request.get('instructor_notes', ''),
+            provider=request.get('provider') or None,
+            force_refresh=bool(request.get('force_refresh')),
+            trace=trace
+        ):
+            if event == 'result' and not payload.get('error'):
+                try:
+                    persist_ai_result('analyze', request.get('target'), payload)
+                except ValueError as e:
+                    print(f"  ⚠ AIの結果を保存できませんでした: {e}")
+            if not client_connected:
+                continue
+            data = {"text": payload} if event == 'delta' else payload
+            try:
+                self.wfile.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8'))
+            except (BrokenPipeError, ConnectionResetError):
+                # タブが閉じられても最後まで生成し、結果は日誌に保存する
+                print("  ⚠ ストリーミング中にブラウザとの接続が切れました（結果は保存します）")
+                client_connected = False
+        print("AI解析（ストリーミング）が完了しました")
+        log_request('/analyze_stream', 200, total_ms=elapsed_ms(started), **trace)
+
     def _handle_review_weekly(self):
         """週次レビューリクエストの処理"""
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-
         try:
+            post_data = self._read_body()
             request = json.loads(post_data.decode('utf-8'))
             week_number = request.get('week_number')
             journals = request.get('journals', [])
@@ -220,13 +1629,12 @@ class KizukiHandler(http.server.SimpleHTTPRequestHandler):
 
             print(f"週次分析を開始... (Week {week_number})")
             
-            # プロバイダ指定対応
-            provider_override = request.get('provider', '')
-            if provider_override:
-                import os as _os
-                _os.environ['AI_PROVIDER'] = provider_override
-
-            result = bridge.analyze_weekly(week_number, journals)
+            # プロバイダ指定対応（このリクエストだけに適用）
+            result = bridge.analyze_weekly(week_number, journals,
+                                           provider=request.get('provider') or None,
+                                           force_refresh=bool(request.get('force_refresh')),
+                                           mode=request.get('mode') or None,
+                                           on_day_analysis=day_analysis_saver(request.get('student_id')))
             print("週次分析が完了しました")
 
             self._send_json(200, result)
@@ -237,11 +1645,12 @@ class KizukiHandler(http.server.SimpleHTTPRequestHandler):
 
     def _handle_generate_daily_comment(self):
         """二段構えAIコメントの生成リクエスト処理"""
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-
+        route = '/generate_daily_comment'
+        started = time.perf_counter()
         try:
+            post_data = self._read_body()
             request = json.loads(post_data.decode('utf-8'))
+            parse_ms = elapsed_ms(started)
             current_step0 = request.get('current_step0', [])
             student_summary = request.get('student_summary', {})
 
@@ -254,60 +1663,211 @@ class KizukiHandler(http.server.SimpleHTTPRequestHandler):
                 self._send_json(500, {"error": True, "message": "AI Bridge の読み込みに失敗しました。"})
                 return
 
-            print("\n" + "="*40)
-            print("🤖 指導コメントの生成を開始...")
-            print("▼ [DEBUG] APIサーバが受信したJSONペイロード (フロント→バック):")
-            print(json.dumps(request, ensure_ascii=False, indent=2))
-            print("="*40 + "\n")
-            
-            # プロバイダ指定対応
-            provider_override = request.get('provider', '')
-            if provider_override:
-                import os as _os
-                _os.environ['AI_PROVIDER'] = provider_override
+            sample_payload(route, post_data)
 
-            result = bridge.generate_daily_comment(current_step0, student_summary)
-            print("指導コメントの生成が完了しました")
+            # プロバイダ指定対応（このリクエストだけに適用）
+            trace = {}
+            result = bridge.generate_daily_comment(current_step0, student_summary,
+                                                   provider=request.get('provider') or None,
+                                                   trace=trace,
+                                                   force_refresh=bool(request.get('force_refresh')))
 
             self._send_json(200, result)
+            log_request(route, 200, parse_ms=parse_ms, request_bytes=len(post_data),
+                        response_bytes=self._response_bytes, total_ms=elapsed_ms(started), **trace)
 
         except Exception as e:
-            print(f"Daily comment generation API error: {e}")
             self._send_json(500, {"error": True, "message": f"指導コメントの生成中にエラーが発生しました: {str(e)}"})
+            log_request(route, 500, error=type(e).__name__, message=str(e), total_ms=elapsed_ms(started))
+
+    def _handle_job_submit(self):
+        """AIジョブの投稿（結果を待たずにジョブIDを返す）"""
+        try:
+            post_data = self._read_body()
+            request = json.loads(post_data.decode('utf-8'))
+            sample_payload(f"/jobs:{request.get('kind')}", post_data)
+            job = jobs.submit(
+                request.get('kind'),
+                request.get('params', {}),
+                target=request.get('target'),
+                provider=request.get('provider', ''),
+                force_refresh=request.get('force_refresh', False)
+            )
+            self._send_json(202, job)
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": True, "message": "リクエストのJSON形式が不正です。"})
+        except ValueError as e:
+            self._send_json(400, {"error": True, "message": str(e)})
+        except Exception as e:
+            print(f"Job submit error: {e}")
+            self._send_json(500, {"error": True, "message": f"ジョブの登録に失敗しました: {str(e)}"})
+
+    def _handle_job_status(self, url_path, query):
+        """ジョブの状態・結果の取得（/jobs/<id> または /jobs?student_id=...）"""
+        job_id = url_path[len('/jobs/'):].strip('/') if url_path.startswith('/jobs/') else ''
+        if job_id:
+            job = jobs.get(job_id)
+            if job is None:
+                self._send_json(404, {"error": True, "message": "ジョブが見つかりません。"})
+            else:
+                self._send_json(200, job)
+        else:
+            self._send_json(200, {"jobs": jobs.list(query.get('student_id', [None])[0])})
+        return None
+
+    def _handle_metrics(self):
+        """計測値を Prometheus のテキスト形式で返す"""
+        bridge = get_ai_bridge()
+        if bridge is None:
+            self._send_json(503, {"error": True, "message": "AI Bridge の読み込みに失敗しました。"})
+            return None
+        body = bridge.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        return io.BytesIO(body)
 
     def _handle_shutdown(self):
         """システム終了リクエストの処理"""
         print("\n🔴 システム終了リクエストを受信しました")
         self._send_json(200, {"status": "shutting_down", "message": "サーバーを停止します..."})
-        # レスポンス送信後にサーバーを停止
-        def delayed_shutdown():
-            auto_sync_push()
-            os._exit(0)
-        threading.Timer(1.0, delayed_shutdown).start()
+        # レスポンス送信後に serve_forever を抜け、main() で保存・バックアップを済ませて終了する
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
 
     def _send_json(self, status_code, data):
-        """JSONレスポンスを送信する共通メソッド"""
+        """JSONレスポンスを送信する共通メソッド（大きな応答はその場で圧縮する）"""
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        encoding = self._negotiate_encoding() if len(body) >= MIN_COMPRESS_SIZE else None
+        if encoding:
+            body = compress_body(body, encoding, level=5)
+
         self.send_response(status_code)
         self.send_header('Content-type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
         self.end_headers()
-        self.wfile.write(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        self.wfile.write(body)
 
 
-try:
-    # サーバー起動前にGitHubから最新データを取得
-    auto_sync_pull()
+class KizukiServer(socketserver.TCPServer):
+    """ワーカースレッドのプールでリクエストを並行処理するサーバー
 
-    with socketserver.TCPServer(("", PORT), KizukiHandler) as httpd:
-        print(f"Serving at http://localhost:{PORT}")
-        webbrowser.open(f"http://localhost:{PORT}")
+    AI呼び出し（最大60秒）の待ち時間中も、他の利用者の静的ファイル取得や
+    保存リクエストが待たされないようにする。
+    """
+
+    def __init__(self, server_address, handler_class, workers=DEFAULT_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='kizuki-worker')
+        super().__init__(server_address, handler_class)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request_worker, request, client_address)
+
+    def _process_request_worker(self, request, client_address):
         try:
-            httpd.serve_forever()
-        except KeyboardInterrupt:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_server(port=PORT):
+    """KIZUKI_SERVER_MODE / KIZUKI_WORKERS に応じてサーバーを生成する
+
+    threaded（既定）: ワーカースレッドで並行処理
+    single: 従来どおり1リクエストずつ逐次処理
+    """
+    mode = os.environ.get('KIZUKI_SERVER_MODE', 'threaded').lower()
+    if mode == 'single':
+        print("サーバーモード: single（逐次処理）")
+        return socketserver.TCPServer(("", port), KizukiHandler)
+
+    try:
+        workers = max(1, int(os.environ.get('KIZUKI_WORKERS', DEFAULT_WORKERS)))
+    except ValueError:
+        workers = DEFAULT_WORKERS
+    print(f"サーバーモード: threaded（ワーカー数 {workers}）")
+    return KizukiServer(("", port), KizukiHandler, workers=workers)
+
+
+# 起動中の同期ワーカー（自動同期が無効なら None）。/sync_status が参照する
+sync_worker = None
+
+
+def create_sync_worker():
+    """環境変数（KIZUKI_SYNC_MODE / KIZUKI_SYNC_DELAY）に従って同期ワーカーを作る"""
+    try:
+        delay = float(os.environ.get('KIZUKI_SYNC_DELAY', '60'))
+    except ValueError:
+        delay = 60.0
+    mode = os.environ.get('KIZUKI_SYNC_MODE', 'full').strip().lower()
+    if mode not in GitSyncWorker.MODES:
+        print(f"⚠ KIZUKI_SYNC_MODE={mode} は未対応のため full で同期します")
+        mode = 'full'
+    return GitSyncWorker(store, delay=delay, mode=mode)
+
+
+def run_sync():
+    """サーバーを起動せずに1回だけ同期する（sync/ のスクリプトから呼ぶ）"""
+    sync = create_sync_worker()
+    print("=========================================")
+    print(f" GitHub と同期しています（{sync.mode} モード）...")
+    print("=========================================")
+    ok = sync.sync_once()
+    print(" 同期が完了しました" if ok else " 同期に失敗しました")
+    return 0 if ok else 1
+
+
+def main():
+    global sync_worker
+    # .env を読み込み、AI設定のスナップショットを起動時に確定させる（KIZUKI_* もここで反映される）
+    bridge = get_ai_bridge()
+    if bridge is not None:
+        config = bridge.get_config()
+        print(f"AIプロバイダ: {config.provider}")
+    setup_logging()
+
+    sync = None
+    if os.environ.get('KIZUKI_SYNC', 'on').lower() not in ('off', '0', 'false'):
+        sync = create_sync_worker()
+
+    try:
+        with create_server(PORT) as httpd:
+            print(f"Serving at http://localhost:{PORT}")
+            # 最新データの取得・保存後のバックアップはバックグラウンドで行う
+            if sync is not None:
+                store.on_change = sync.notify_saved
+                sync_worker = sync
+                sync.start()
+            webbrowser.open(f"http://localhost:{PORT}")
+            try:
+                httpd.serve_forever()
+            except KeyboardInterrupt:
+                pass
             print("\nServer stopped.")
-            # サーバー終了時に変更をGitHubへバックアップ
-            auto_sync_push()
-except OSError as e:
-    if e.errno == 48 or (hasattr(e, 'winerror') and e.winerror == 10048):
-        print(f"Port {PORT} is already in use. Try closing other python servers or applications.")
-    else:
-        print(f"Error: {e}")
+        jobs.shutdown()
+        store.compact()
+        if sync is not None:
+            sync.stop()
+    except OSError as e:
+        if e.errno == 48 or (hasattr(e, 'winerror') and e.winerror == 10048):
+            print(f"Port {PORT} is already in use. Try closing other python servers or applications.")
+        else:
+            print(f"Error: {e}")
+
+
+if __name__ == '__main__':
+    if '--sync' in sys.argv[1:]:
+        bridge = get_ai_bridge()
+        if bridge is not None:
+            bridge.load_env()
+        sys.exit(run_sync())
+    main()
@@ -6,26 +6,12 @@ echo =========================================
 
 cd /d "%~dp0"
 
-echo [1/3] Fetching latest changes from GitHub...
-git pull origin main --rebase
+rem 取得・コミット・プッシュは start_server.py --sync が行う
+rem （データファイルだけを同期する。KIZUKI_SYNC_MODE=data ならレコード単位で同期する）
+python ..\start_server.py --sync
 if %ERRORLEVEL% neq 0 (
     echo.
-    echo [ERROR] Failed to pull changes. Please check your internet connection or resolve merge conflicts.
-    pause
-    exit /b %ERRORLEVEL%
-)
-
-echo.
-echo [2/3] Adding local changes...
-git add .
-git commit -m "Auto-sync from Windows: %date% %time%"
-
-echo.
-echo [3/3] Uploading changes to GitHub...
-git push origin main
-if %ERRORLEVEL% neq 0 (
-    echo.
-    echo [ERROR] Failed to push changes.
+    echo [ERROR] Sync failed. Please check your internet connection or resolve merge conflicts.
     pause
     exit /b %ERRORLEVEL%
 )